@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Compare restarting an interrupted package download with resuming it.
+
+Pushes a large generated package to a throwaway server, then simulates a
+download that fails part way through. The client either starts over or
+resumes with `Range` + `If-Range`. Prints the bytes sent and the time for
+each.
+
+Usage::
+
+    python benchmarks/download_resume.py [size_mb] [fail_at_percent]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+from zipfile import ZipFile
+from zipfile import ZIP_STORED
+
+from pynuget import commands
+from pynuget import logger
+from pynuget import default_config
+from pynuget.app_factory import create_app
+from pynuget.app_factory import init_db
+
+NUSPEC = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://schemas.microsoft.com/packaging/2012/06/nuspec.xsd">
+  <metadata>
+    <id>BigPackage</id>
+    <version>1.0.0</version>
+    <authors>bench</authors>
+    <description>Large package for the resume benchmark.</description>
+  </metadata>
+</package>
+"""
+
+
+def make_package(size):
+    out = BytesIO()
+    with ZipFile(out, 'w', ZIP_STORED) as zf:
+        zf.writestr("BigPackage.nuspec", NUSPEC)
+        zf.writestr("content/payload.bin", os.urandom(size))
+    return out.getvalue()
+
+
+def download(client, headers=None, fail_at=None):
+    """Download the package, stopping after `fail_at` bytes."""
+    rv = client.get("/download/1/1.0.0", headers=headers, buffered=False)
+    received = 0
+    for chunk in rv.response:
+        received += len(chunk)
+        if fail_at is not None and received >= fail_at:
+            break
+    rv.close()
+    return rv, received
+
+
+def main(size_mb=200, fail_at_percent=90):
+    logger.setLevel(logging.WARNING)
+    size = size_mb * 1024 * 1024
+    server_path = tempfile.mkdtemp(prefix="pynuget-bench-")
+    try:
+        app = create_app()
+        app.config['SERVER_PATH'] = server_path
+        app.config['API_KEYS'] = ['bench']
+        commands._create_directories(server_path, default_config.PACKAGE_DIR,
+                                     os.path.join(server_path, 'log'))
+        commands._create_db(default_config.DB_BACKEND,
+                            default_config.DB_NAME,
+                            server_path)
+        init_db(app)
+        client = app.test_client()
+
+        data = {'package': (BytesIO(make_package(size)), 'big.nupkg')}
+        rv = client.put('/api/v2/package/', data=data,
+                        headers={'X-Nuget-Apikey': 'bench'})
+        assert rv.status_code == 201, rv.data
+
+        rv, total = download(client)
+        etag = rv.headers['ETag']
+        fail_at = total * fail_at_percent // 100
+
+        start = time.perf_counter()
+        _, sent = download(client, fail_at=fail_at)
+        _, sent_again = download(client)
+        restart = time.perf_counter() - start, sent + sent_again
+
+        start = time.perf_counter()
+        _, sent = download(client, fail_at=fail_at)
+        headers = {'Range': 'bytes={}-'.format(sent), 'If-Range': etag}
+        rv, sent_again = download(client, headers=headers)
+        assert rv.status_code == 206
+        resume = time.perf_counter() - start, sent + sent_again
+
+        print("package size: {:.1f} MB, failing at {}%".format(
+            total / 2**20, fail_at_percent))
+        for name, (seconds, sent) in (("restart", restart),
+                                      ("resume", resume)):
+            print("{:8s} {:8.1f} MB sent  {:6.3f} s".format(
+                name, sent / 2**20, seconds))
+
+        app.extensions['pynuget']['download_counter'].stop()
+        app.extensions['pynuget']['db_engine'].dispose()
+    finally:
+        shutil.rmtree(server_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Time reading the .nuspec out of a package with many entries.
+
+Compares `core.extract_nuspec`, which reads the zip central directory
+directly, with the `zipfile` based reader it falls back to.
+
+Usage::
+
+    python benchmarks/extract_nuspec.py [entries]
+"""
+import logging
+import os
+import sys
+import tempfile
+import timeit
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+from pynuget import core
+from pynuget import logger
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "tests", "data")
+
+
+def make_package(path, entries):
+    """Build a copy of `good.nupkg` with `entries` extra files."""
+    good = os.path.join(DATA_DIR, "good.nupkg")
+    with ZipFile(good) as src, ZipFile(path, 'w', ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            dst.writestr(info, src.read(info.filename))
+        for n in range(entries):
+            name = "runtimes/rid-{}/native/lib{}.so".format(n % 50, n)
+            dst.writestr(name, b"")
+
+
+def main(entries=50000, repeat=5):
+    logger.setLevel(logging.WARNING)
+    fd, path = tempfile.mkstemp(suffix=".nupkg")
+    os.close(fd)
+    try:
+        make_package(path, entries)
+        size = os.path.getsize(path) / 2**20
+        print("{} entries, {:.1f} MB".format(entries, size))
+
+        for name, func in (("zipfile", core._read_root_nuspec_zipfile),
+                           ("extract_nuspec", core.extract_nuspec)):
+            times = timeit.repeat(lambda: func(path), number=1, repeat=repeat)
+            print("{:15s} best of {}: {:8.2f} ms".format(
+                name, repeat, min(times) * 1000))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -83,6 +83,10 @@ requires = [
     "requests>=2.20.1",
 ]
 
+extras_require = {
+    's3': ["boto3"],
+}
+
 entry_points = {
     'console_scripts': [
         'pynuget = pynuget.cli:main',
@@ -126,6 +130,7 @@ setup(
     # Versions and Requirements
     python_requires=">=3.5",
     install_requires=requires,
+    extras_require=extras_require,
     #tests_requires=
 
     entry_points=entry_points,
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 """
 """
+import atexit
 import os
 from pathlib import Path
 
 from flask import Flask
 from flask import g
+from sqlalchemy.orm import sessionmaker
 
+from pynuget import cache
+from pynuget import core
+from pynuget import db
 from pynuget import logger
+from pynuget import shared_cache
+from pynuget import storage
 from pynuget._logging import setup_logging
 from pynuget.routes import pages
 
@@ -25,6 +32,7 @@ def create_app():
     testing = os.getenv(ENV_VAR, None) == 'TESTING'
 
     app = Flask(__name__)
+    app.request_class = core.UploadRequest
     app.config.from_object('pynuget.default_config')
 
     # Override some default vars if we're running using the flask dev server.
@@ -42,6 +50,14 @@ def create_app():
         setup_logging(to_console=False, to_file=True,
                       log_path=app.config['LOG_PATH'])
 
+    init_db(app)
+    init_storage(app)
+    init_cache(app)
+
+    # Accept gzip compressed uploads, see `pynuget push --gzip`.
+    app.wsgi_app = core.GzipRequestMiddleware(
+        app.wsgi_app, max_size=app.config['MAX_CONTENT_LENGTH'])
+
     # Register blueprints
     app.register_blueprint(pages)
 
@@ -52,3 +68,96 @@ def create_app():
             session.close()
 
     return app
+
+
+def init_db(app):
+    """
+    Create the process-wide database engine and session factory.
+
+    This is called by :func:`create_app`. Call it again if `SERVER_PATH`,
+    `DB_NAME` or any of the `DB_POOL_*` values are changed afterwards.
+    """
+    ext = app.extensions.setdefault('pynuget', {})
+
+    old_counter = ext.get('download_counter', None)
+    if old_counter is not None:
+        old_counter.stop()
+        atexit.unregister(old_counter.stop)
+
+    old_engine = ext.get('db_engine', None)
+    if old_engine is not None:
+        old_engine.dispose()
+
+    # TODO: Handle MySQL/PostgreSQL backends.
+    db_path = Path(app.config['SERVER_PATH']) / Path(app.config['DB_NAME'])
+    url = "sqlite:///{}".format(str(db_path))
+
+    stats = db.PoolStats()
+    engine = db.create_db_engine(
+        url,
+        pool_size=app.config['DB_POOL_SIZE'],
+        max_overflow=app.config['DB_MAX_OVERFLOW'],
+        pool_recycle=app.config['DB_POOL_RECYCLE'],
+        pool_pre_ping=app.config['DB_POOL_PRE_PING'],
+        sqlite_thread_pool=app.config['DB_SQLITE_THREAD_POOL'],
+        stats=stats,
+    )
+
+    if db_path.exists():
+        # Existing databases may predate some tables, columns or indexes.
+        db.upgrade_schema(engine)
+
+    ext['db_path'] = db_path
+    ext['db_engine'] = engine
+    ext['db_session_factory'] = sessionmaker(bind=engine)
+    ext['db_pool_stats'] = stats
+
+    counter = db.DownloadCounter(
+        engine,
+        flush_interval=app.config['DOWNLOAD_COUNT_FLUSH_INTERVAL'],
+        flush_size=app.config['DOWNLOAD_COUNT_FLUSH_SIZE'],
+    )
+    # Write out the buffered counts when the process exits cleanly.
+    atexit.register(counter.stop)
+    ext['download_counter'] = counter
+
+
+def init_storage(app):
+    """
+    Create the package storage backend, see `STORAGE_BACKEND`.
+
+    This is called by :func:`create_app`. Call it again if any of the
+    storage settings are changed afterwards.
+    """
+    ext = app.extensions.setdefault('pynuget', {})
+    ext['storage'] = storage.create_storage(app.config)
+
+
+def init_cache(app):
+    """
+    Create the feed response cache and the request coalescing, see
+    `RESPONSE_CACHE_SIZE`, `SHARED_CACHE_BACKEND` and
+    `FEED_SINGLE_FLIGHT_TIMEOUT`.
+
+    This is called by :func:`create_app`. Call it again if any of the
+    cache settings are changed afterwards.
+    """
+    ext = app.extensions.setdefault('pynuget', {})
+    backend = shared_cache.create_backend(app.config)
+    if backend is not None:
+        ext['response_cache'] = shared_cache.SharedResponseCache(
+            backend,
+            ttl=app.config['RESPONSE_CACHE_TTL'],
+        )
+    elif app.config['RESPONSE_CACHE_SIZE'] > 0:
+        ext['response_cache'] = cache.ResponseCache(
+            max_entries=app.config['RESPONSE_CACHE_SIZE'],
+            ttl=app.config['RESPONSE_CACHE_TTL'],
+        )
+    else:
+        ext['response_cache'] = None
+
+    if app.config['FEED_SINGLE_FLIGHT_TIMEOUT'] > 0:
+        ext['single_flight'] = cache.SingleFlight()
+    else:
+        ext['single_flight'] = None
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+In-process cache for rendered feed responses, and coalescing of identical
+requests that are computed at the same time.
+"""
+import threading
+import time
+from collections import OrderedDict
+from collections import namedtuple
+
+from pynuget import logger
+
+
+#: The tag of entries that can change when any package changes, like
+#: search results.
+ALL_PACKAGES_TAG = "*"
+
+_Entry = namedtuple('_Entry', ['value', 'tags', 'expires'])
+
+
+def package_tag(package_name):
+    """The tag of entries that change when `package_name` changes."""
+    return "pkg:" + package_name.lower()
+
+
+class ResponseCache(object):
+    """
+    A bounded LRU cache whose entries expire after `ttl` seconds.
+
+    Each entry is stored with a set of tags. :meth:`invalidate` removes
+    every entry with any of the given tags, so a push or delete only evicts
+    the feeds of the package that changed (and the searches, which are
+    tagged with :data:`ALL_PACKAGES_TAG`).
+
+    A value computed while an invalidation happens may already be stale.
+    Take a :meth:`generation` before computing it and pass it to
+    :meth:`set`, which then drops the value if anything was invalidated in
+    the meantime.
+
+    Parameters
+    ----------
+    max_entries : int
+        The least recently used entries are evicted beyond this.
+    ttl : float
+        Seconds until an entry expires.
+    """
+
+    def __init__(self, max_entries=256, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def generation(self):
+        """Get a token that changes whenever entries are invalidated."""
+        return self._generation
+
+    def get(self, key):
+        """Return the cached value for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def set(self, key, value, tags=(), generation=None):
+        """
+        Cache a value.
+
+        Parameters
+        ----------
+        key : hashable
+        value : object
+        tags : iterable of str
+        generation : int or None
+            The value of :meth:`generation` from before `value` was
+            computed. If entries were invalidated since, `value` is not
+            cached.
+
+        Returns
+        -------
+        bool
+            True if the value was cached.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                logger.debug("Not caching %s: invalidated meanwhile" % key)
+                return False
+            if key in self._entries:
+                self._remove(key)
+            tags = frozenset(tags)
+            self._entries[key] = _Entry(value, tags,
+                                        time.monotonic() + self.ttl)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def invalidate(self, tags):
+        """
+        Remove all entries that have any of `tags`.
+
+        Returns
+        -------
+        int
+            The number of removed entries.
+        """
+        with self._lock:
+            self._generation += 1
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+        logger.debug("Invalidated %d cache entries for %s"
+                     % (len(keys), sorted(tags)))
+        return len(keys)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tags.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key):
+        """Remove an entry and its tags. The lock must be held."""
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+class _Call(object):
+    """A computation that other threads can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.followers = 0
+
+    def wait(self, timeout=None):
+        """Wait for the result. Returns None if there isn't one in time."""
+        if not self.done.wait(timeout):
+            return None
+        return self.result
+
+
+class SingleFlight(object):
+    """
+    Let concurrent identical requests share one computation.
+
+    The first thread to :meth:`begin` a key is the leader and computes the
+    result. Threads that begin the same key before the leader calls
+    :meth:`finish` are followers and wait for the leader's result instead
+    of computing it again.
+
+    Usage::
+
+        call, leader = flight.begin(key)
+        if leader:
+            result = None
+            try:
+                result = compute()
+            finally:
+                flight.finish(key, call, result)
+        else:
+            result = call.wait(timeout)
+            if result is None:
+                result = compute()
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.followers = 0
+
+    def begin(self, key):
+        """
+        Join the computation of `key`, or start it.
+
+        Returns
+        -------
+        call : :class:`_Call`
+        leader : bool
+            True if the caller must compute the result and :meth:`finish`.
+        """
+        with self._lock:
+            call = self._calls.get(key, None)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                return call, True
+            call.followers += 1
+            self.followers += 1
+            return call, False
+
+    def finish(self, key, call, result):
+        """
+        Publish the leader's result and wake up the followers.
+
+        `result` is None if the computation failed or can't be shared, in
+        which case each follower computes its own. Only the first call for
+        a computation has an effect.
+        """
+        with self._lock:
+            if call.done.is_set():
+                return
+            if self._calls.get(key, None) is call:
+                del self._calls[key]
+            call.result = result
+            call.done.set()
+        if call.followers:
+            logger.debug("Shared the result of %s with %d requests"
+                         % (key, call.followers))
+
+    def forget(self):
+        """
+        Make new requests start new computations.
+
+        Used when the data changes: computations in flight may already be
+        stale for requests that arrive afterwards. Their current followers
+        still get their results.
+        """
+        with self._lock:
+            self._calls.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'leaders': self.leaders,
+                'followers': self.followers,
+            }
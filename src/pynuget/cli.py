@@ -2,6 +2,7 @@
 """
 """
 
+import os
 import sys
 from argparse import ArgumentParser
 
@@ -113,8 +114,24 @@ def main():
               " removing NuGet package files."),
         parents=[parent_parser],
     )
+    parser_rebuild.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help=("The number of processes used to read package files."
+              " Default: the number of CPUs"),
+    )
     parser_rebuild.set_defaults(func=run_rebuild)
 
+    # Reindex
+    parser_reindex = subparser.add_parser(
+        "reindex",
+        help=("Rebuild the full-text search index from the package"
+              " database."),
+        parents=[parent_parser],
+    )
+    parser_reindex.set_defaults(func=run_reindex)
+
     # Push
     parser_push = subparser.add_parser(
         "push",
@@ -134,9 +151,32 @@ def main():
         default='',
         required=False,
     )
+    parser_push.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=commands.PUSH_JOBS,
+        help=("The number of packages to upload at the same time."
+              " Default: %(default)s"),
+    )
+    parser_push.add_argument(
+        "--retries",
+        type=int,
+        default=commands.PUSH_RETRIES,
+        help=("How many times to retry a failed upload."
+              " Default: %(default)s"),
+    )
+    parser_push.add_argument(
+        "--gzip",
+        dest='compress',
+        help=("Compress the uploads with gzip. The server must accept"
+              " `Content-Encoding: gzip` request bodies."),
+        action='store_true',
+    )
     parser_push.add_argument(
         "file",
-        help=("The file to upload."),
+        nargs='+',
+        help=("The files to upload. Directories are searched for .nupkg"
+              " files and glob patterns are expanded."),
     )
 
     # Parse the args
@@ -168,12 +208,20 @@ def run_clear(args):
 
 
 def run_rebuild(args):
-    success = commands.rebuild()
+    success = commands.rebuild(server_path=SERVER_PATH, jobs=args.jobs)
+    if not success:
+        sys.exit(1)
+
+
+def run_reindex(args):
+    success = commands.reindex(server_path=SERVER_PATH)
     if not success:
         sys.exit(1)
 
 
 def run_push(args):
-    success = commands.push(args.file, args.source, args.key)
+    success = commands.push_many(args.file, args.source, args.key,
+                                 jobs=args.jobs, retries=args.retries,
+                                 compress=args.compress)
     if not success:
         sys.exit(1)
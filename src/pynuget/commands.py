@@ -1,23 +1,51 @@
 # -*- coding: utf-8 -*-
 """
 """
+import base64
+import glob
+import gzip
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime as dt
+from functools import partial
+from io import BytesIO
 from pathlib import Path
+from uuid import uuid4
 
 import requests
 from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
 
+from pynuget import core
 from pynuget import db
 from pynuget import _logging
+from pynuget.feedwriter import render_entry_template
+from pynuget.storage import ObjectStat
 
 
 logger = _logging.setup_logging(True, False, "./pynuget-cli.log")
 
+#: The number of package files `rebuild` writes per transaction.
+REBUILD_BATCH_SIZE = 500
+
+#: Defaults for `push_many`: concurrent uploads, retries per package and the
+#: delay (seconds) before the first retry, doubled for each one after.
+PUSH_JOBS = 4
+PUSH_RETRIES = 3
+PUSH_RETRY_BACKOFF = 0.5
+#: The responses that mean the server (or a proxy in front of it) is
+#: temporarily unavailable, so the push can be retried.
+PUSH_RETRY_STATUS = (502, 503, 504)
+
 
 def init(server_path, package_dir, db_name, db_backend, apache_config,
          replace_wsgi=False, replace_apache=False):
@@ -117,28 +145,122 @@ def clear(server_path, force=False):
     return False
 
 
-def rebuild():
-    """Rebuild the package database."""
-    raise NotImplementedError
-    import config
-    # First let's get a list of all the packages in the database.
-    # TODO: create the session.
-    logger.debug("Getting database packages and versions.")
-    db_data = db.search_packages(session, include_prerelease=True)
-    db_data = _db_data_to_dict(db_data)
+def rebuild(server_path, jobs=None):
+    """
+    Rebuild the package database from the files in the package directory.
+
+    Only new and changed package files are opened: a file whose size,
+    modification time and inode match its :class:`db.PackageFile` row is
+    skipped. Those that need it are parsed and hashed in `jobs` worker
+    processes and the results are written in batches of
+    `REBUILD_BATCH_SIZE` files per transaction. Versions whose file no
+    longer exists are deleted, as are the content-addressed files (see
+    `CONTENT_ADDRESSABLE_STORE`) that no version uses any more.
 
-    # Then we'll get the list of all the packages in the package directory
-    # Same data structure as the db data.
+    Parameters
+    ----------
+    server_path : str
+    jobs : int or None
+        The number of worker processes. Defaults to the number of CPUs. If
+        1, everything is done in this process.
+    """
+    config = _load_config(server_path)
+    session = _create_session(config.DB_BACKEND, config.DB_NAME,
+                              config.SERVER_PATH)
+    db.upgrade_schema(session.bind)
     pkg_path = Path(config.SERVER_PATH) / Path(config.PACKAGE_DIR)
-    file_data = _get_packages_from_files(pkg_path)
+    try:
+        added, deleted = _rebuild(session, pkg_path, jobs)
+    finally:
+        session.close()
+    logger.info("Rebuild done: %d versions added or updated, %d deleted."
+                % (added, deleted))
+    return True
 
-    _add_packages_to_db(file_data)
-    _remove_packages_from_db(file_data, db_data)
 
-    return False
+def _rebuild(session, pkg_path, jobs=None):
+    """
+    Reconcile the database with the package directory.
+
+    Returns
+    -------
+    added : int
+    deleted : int
+    """
+    files = _scan_package_dir(pkg_path)
+    known = db.get_package_files(session)
+
+    # First let's get a list of all the packages in the database.
+    logger.debug("Getting database packages and versions.")
+    in_db = {core.get_package_path(pkg, version).as_posix()
+             for pkg, version in db.iter_package_versions(session)}
+
+    # Versions whose file is gone, and saved files that no longer exist.
+    removed = {}
+    for key in in_db - set(files):
+        pkg, version = _split_package_path(key)
+        removed[key] = (pkg, version, key)
+    for key, row in known.items():
+        if key not in files and key not in removed:
+            parsed = row.parsed
+            removed[key] = (parsed['id'], parsed['fields']['version'], key)
+
+    deleted = 0
+    removed = list(removed.values())
+    for start in range(0, len(removed), REBUILD_BATCH_SIZE):
+        batch = removed[start:start + REBUILD_BATCH_SIZE]
+        deleted += db.bulk_delete_versions(session, batch)
+
+    # Unchanged files only need to be re-added if their version is missing.
+    to_save = []
+    to_parse = []
+    for key, stat in files.items():
+        row = known.get(key)
+        if row is None or not row.is_unchanged(stat):
+            to_parse.append(key)
+        elif key not in in_db:
+            to_save.append((key, stat, row.package_hash, row.parsed))
+    logger.info("%d package files, %d new or changed."
+                % (len(files), len(to_parse)))
+
+    added = 0
+    start_time = time.monotonic()
+    paths = [str(pkg_path / key) for key in to_parse]
+    with _parse_pool(jobs) as map_:
+        results = map_(_parse_package_file, paths)
+        for count, (key, result) in enumerate(zip(to_parse, results), 1):
+            if result is not None:
+                parsed, hash_ = result
+                if _check_package_path(key, parsed):
+                    to_save.append((key, files[key], hash_, parsed))
+            if len(to_save) >= REBUILD_BATCH_SIZE:
+                added += _save_batch(session, to_save)
+                to_save = []
+                rate = count / (time.monotonic() - start_time)
+                logger.info("Parsed %d of %d package files (%.1f files/s)."
+                            % (count, len(to_parse), rate))
+    added += _save_batch(session, to_save)
+
+    # Deleted versions may have been the last ones to use a stored file.
+    _remove_unused_blobs(session, pkg_path)
+
+    return added, deleted
+
+
+def reindex(server_path):
+    """Rebuild the full-text search index from the package database."""
+    config = _load_config(server_path)
+    session = _create_session(config.DB_BACKEND, config.DB_NAME,
+                              config.SERVER_PATH)
+    try:
+        count = db.rebuild_search_index(session)
+    finally:
+        session.close()
+    logger.info("Rebuilt the search index for %d versions." % count)
+    return True
 
 
-def push(file, source, key):
+def push(file, source, key, session=None, compress=False):
     """
     Push a package to a nuget server.
 
@@ -152,6 +274,9 @@ def push(file, source, key):
     the spec), and the Content-Length apache direcive isn't available until
     Apache 2.5...
 
+    The multipart body is streamed from disk with a Content-Length that is
+    computed up front, so memory use doesn't grow with the package size.
+
     Parameters
     ----------
     file : str
@@ -160,6 +285,11 @@ def push(file, source, key):
         The URL for the (py)NuGet server to push to.
     key : str
         The ApiKey value.
+    session : :class:`requests.Session` or None
+        Send the request with this session, reusing its connections.
+    compress : bool
+        Send the body with `Content-Encoding: gzip`. It's compressed to a
+        temporary file first so that the Content-Length is known.
     """
     logger.debug("push('%s', '%s', '<redacted>')" % (file, source))
 
@@ -167,21 +297,240 @@ def push(file, source, key):
         logger.error("File '%s' does not exist. Aborting." % file)
         return
 
+    resp = _put_package(session or requests, file, _push_url(source), key,
+                        compress)
+    logger.debug("{} {}".format(resp, resp.text))
+
+    # 201 = Item Created. Means we were successful.
+    return resp.status_code == 201
+
+
+def push_many(files, source, key, jobs=PUSH_JOBS, retries=PUSH_RETRIES,
+              session=None, compress=False):
+    """
+    Push many packages to a nuget server.
+
+    The packages are uploaded by `jobs` threads sharing one keep-alive
+    :class:`requests.Session`. Uploads that fail with a connection error
+    or one of the `PUSH_RETRY_STATUS` responses are retried up to
+    `retries` times.
+
+    Parameters
+    ----------
+    files : iterable of str
+        Package files, directories (searched recursively for `*.nupkg`)
+        or glob patterns.
+    source : str
+        The URL for the (py)NuGet server to push to.
+    key : str
+        The ApiKey value.
+    jobs : int
+        The number of concurrent uploads.
+    retries : int
+        How many times a failed upload is retried.
+    session : :class:`requests.Session` or None
+        Defaults to a new session with a connection pool of size `jobs`.
+    compress : bool
+        Gzip the uploads, see :func:`push`.
+
+    Returns
+    -------
+    success : bool
+        True if all packages were pushed.
+    """
+    paths = _expand_push_paths(files)
+    if not paths:
+        logger.error("No package files found. Aborting.")
+        return False
+
+    logger.info("Pushing %d packages to %s" % (len(paths), source))
+    url = _push_url(source)
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=jobs)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    def push_one(path):
+        return path, _push_with_retries(session, path, url, key, retries,
+                                        compress)
+
+    start_time = time.monotonic()
+    pushed = []
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for path, ok in executor.map(push_one, paths):
+                (pushed if ok else failed).append(path)
+    finally:
+        if own_session:
+            session.close()
+    elapsed = time.monotonic() - start_time
+
+    _log_push_summary(pushed, failed, elapsed)
+    return not failed
+
+
+def _push_url(source):
+    """Get the package upload URL of a server."""
+    if source[-1] == "/":
+        source = source[:-1]
+    return source + '/api/v2/package/'
+
+
+class _MultipartBody(object):
+    """
+    A `multipart/form-data` request body that streams a file from disk.
+
+    The body's length is known up front, so it's sent with a
+    Content-Length instead of being read into memory or chunk encoded.
+
+    Parameters
+    ----------
+    file : str or :class:`pathlib.Path`
+    field : str
+        The form field name.
+    """
+
+    def __init__(self, file, field='package'):
+        boundary = uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        # Like NuGet, send a fixed file name: the server reads the package
+        # id and version from the nuspec, and a local file name could break
+        # the header with quotes or line breaks.
+        head = ('--{}\r\n'
+                'Content-Disposition: form-data; name="{}";'
+                ' filename="package.nupkg"\r\n'
+                'Content-Type: application/octet-stream\r\n'
+                '\r\n').format(boundary, field)
+        tail = '\r\n--{}--\r\n'.format(boundary)
+        self._file = open(str(file), 'rb')
+        self._parts = [BytesIO(head.encode('utf-8')),
+                       self._file,
+                       BytesIO(tail.encode('utf-8'))]
+        self._length = (len(head.encode('utf-8')) + len(tail)
+                        + os.fstat(self._file.fileno()).st_size)
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._file.close()
+
+
+def _gzip_body(body):
+    """
+    Compress a request body into a temporary file.
+
+    The result is a regular file, so its length (and the Content-Length) is
+    known before anything is sent.
+    """
+    compressed = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as gz:
+        shutil.copyfileobj(body, gz, core.CHUNK_SIZE)
+    compressed.seek(0)
+    return compressed
+
+
+def _put_package(session, file, url, key, compress=False):
+    """Upload a single package file, streaming it from disk."""
     header = {
         'X-Nuget-ApiKey': key,
         'User-Agent': 'PyNuGet',
     }
+    with _MultipartBody(file) as body:
+        header['Content-Type'] = body.content_type
+        if not compress:
+            return session.put(url, headers=header, data=body)
+        header['Content-Encoding'] = 'gzip'
+        with _gzip_body(body) as data:
+            return session.put(url, headers=header, data=data)
 
-    if source[-1] == "/":
-        source = source[:-1]
-    source += '/api/v2/package/'
 
-    files = {'package': open(file, 'rb')}
-    resp = requests.put(source, headers=header, files=files)
-    logger.debug("{} {}".format(resp, resp.text))
+def _push_with_retries(session, file, url, key, retries, compress=False):
+    """
+    Upload a package file, retrying on connection errors and on the 5xx
+    responses of `PUSH_RETRY_STATUS`.
 
-    # 201 = Item Created. Means we were successful.
-    return resp.status_code == 201
+    A push isn't idempotent: the server may have stored the package before
+    the error. So a `409 Conflict` (the version already exists) in answer
+    to a retry counts as success.
+
+    Returns
+    -------
+    success : bool
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(PUSH_RETRY_BACKOFF * 2 ** (attempt - 1))
+            logger.info("Retrying %s (attempt %d)" % (file, attempt + 1))
+        try:
+            resp = _put_package(session, file, url, key, compress)
+        except requests.exceptions.RequestException as err:
+            logger.warn("Unable to push %s: %s" % (file, err))
+            continue
+        if resp.status_code == 201:
+            logger.debug("Pushed %s" % file)
+            return True
+        if resp.status_code == 409 and attempt:
+            logger.info("%s already exists: an earlier attempt was saved"
+                        % file)
+            return True
+        logger.warn("Unable to push %s: %d %s"
+                    % (file, resp.status_code, resp.text))
+        if resp.status_code not in PUSH_RETRY_STATUS:
+            return False
+    return False
+
+
+def _expand_push_paths(files):
+    """
+    Expand directories and glob patterns into a list of package files.
+
+    Duplicates are removed. The order of `files` is kept.
+    """
+    paths = []
+    for file in files:
+        if os.path.isdir(file):
+            found = sorted(str(p) for p in Path(file).rglob('*.nupkg'))
+        else:
+            found = sorted(glob.glob(file, recursive=True))
+            if not found:
+                logger.warn("No files match '%s'" % file)
+        paths.extend(found)
+    return list(OrderedDict.fromkeys(paths))
+
+
+def _log_push_summary(pushed, failed, elapsed):
+    """Log how many packages were pushed and how fast."""
+    size = sum(os.path.getsize(path) for path in pushed)
+    elapsed = max(elapsed, 1e-6)
+    logger.info("Pushed %d of %d packages (%.1f MB) in %.2f s:"
+                " %.1f packages/s, %.2f MB/s"
+                % (len(pushed), len(pushed) + len(failed), size / 1e6,
+                   elapsed, len(pushed) / elapsed, size / 1e6 / elapsed))
+    for path in failed:
+        logger.error("Failed to push %s" % path)
 
 
 def _create_dir(path):
@@ -287,6 +636,135 @@ def _db_data_to_dict(db_data):
     return data
 
 
+def _remove_unused_blobs(session, pkg_path):
+    """
+    Delete the content-addressed files that no version refers to.
+
+    The package files of the versions are links to these, so they stay.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    pkg_path : :class:`pathlib.Path` or str
+
+    Returns
+    -------
+    count : int
+        The number of files that were deleted.
+    """
+    logger.debug("Removing unused files from %s" % core.BLOB_DIR)
+    blobs = sorted((Path(pkg_path) / core.BLOB_DIR).glob("*/*.nupkg"))
+    if not blobs:
+        return 0
+
+    used = db.get_package_hashes(session)
+    count = 0
+    for blob in blobs:
+        try:
+            hash_ = base64.b64encode(bytes.fromhex(blob.stem)).decode()
+        except ValueError:
+            continue
+        if hash_ not in used:
+            logger.info("Deleting unreferenced package file %s" % blob)
+            blob.unlink()
+            count += 1
+    return count
+
+
+def _scan_package_dir(pkg_path):
+    """
+    Find all package files in the package directory.
+
+    Package files are stored as `<id>/<version>.nupkg` (see
+    :func:`core.get_package_path`), so only two directory levels are
+    scanned. The upload and content-addressable store directories are
+    skipped.
+
+    Parameters
+    ----------
+    pkg_path : :class:`pathlib.Path` or str
+
+    Returns
+    -------
+    files : dict
+        Dict of {'<id>/<version>.nupkg': :class:`storage.ObjectStat`, ...}
+    """
+    logger.debug("Scanning package dir %s" % pkg_path)
+    files = {}
+    try:
+        pkg_dirs = list(os.scandir(str(pkg_path)))
+    except FileNotFoundError:
+        logger.warn("Path '%s' does not exist." % pkg_path)
+        return files
+
+    for pkg_dir in pkg_dirs:
+        if (pkg_dir.name in (core.TEMP_DIR, core.BLOB_DIR)
+                or not pkg_dir.is_dir()):
+            continue
+        for entry in os.scandir(pkg_dir.path):
+            if not entry.name.endswith(".nupkg") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            key = pkg_dir.name + "/" + entry.name
+            files[key] = ObjectStat(stat.st_size, stat.st_mtime, stat.st_ino)
+    return files
+
+
+def _split_package_path(key):
+    """Split a `<id>/<version>.nupkg` key into the id and version."""
+    pkg, filename = key.split("/", 1)
+    return pkg, filename[:-len(".nupkg")]
+
+
+def _check_package_path(key, parsed):
+    """Return True if a package file is stored where its nuspec says."""
+    expected = core.get_package_path(parsed['id'],
+                                     parsed['fields']['version']).as_posix()
+    if key != expected:
+        logger.warn("Skipping '%s': its nuspec says it should be '%s'."
+                    % (key, expected))
+        return False
+    return True
+
+
+def _parse_package_file(path):
+    """
+    Parse and hash a package file. Runs in the worker processes.
+
+    Returns
+    -------
+    (parsed, hash_) or None
+        See :func:`core.read_package_metadata`. None if the file isn't a
+        valid package.
+    """
+    try:
+        parsed = core.read_package_metadata(path)
+        hash_, _ = core.hash_and_encode_file(path)
+    except Exception as err:
+        logger.error("Unable to read package file '%s': %s" % (path, err))
+        return None
+    return parsed, hash_
+
+
+@contextmanager
+def _parse_pool(jobs):
+    """Yield a `map` function that runs in `jobs` processes."""
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        yield map
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield partial(executor.map, chunksize=16)
+
+
+def _save_batch(session, items):
+    """Write parsed package files to the database in one transaction."""
+    versions = db.bulk_save_versions(session, items,
+                                     render_entry=render_entry_template)
+    return len(versions)
+
+
 def _get_packages_from_files(pkg_path):
     """
     Get a list of packages from the package directory.
@@ -302,20 +780,10 @@ def _get_packages_from_files(pkg_path):
         Dict of {'pkg_name': ['vers1', 'vers2', ...], ...}
     """
     logger.debug("Getting list of packages in package dir.")
-    if not isinstance(pkg_path, Path):
-        pkg_path = Path(pkg_path)
-
     data = {}
-    # XXX: There's got to be a better way!
-    for root, dirs, _ in os.walk(str(pkg_path)):
-        rel_path = Path(root).relative_to(pkg_path)
-        pkg = str(rel_path.parent)
-        if pkg != '.':
-            try:
-                data[pkg]
-            except KeyError:
-                data[pkg] = []
-            data[pkg].append(rel_path.name)
+    for key in _scan_package_dir(pkg_path):
+        pkg, version = _split_package_path(key)
+        data.setdefault(pkg, []).append(version)
 
     logger.debug("Found %d packages." % len(data))
     logger.debug("Found %d versions." % sum(len(v) for v in data.values()))
@@ -323,33 +791,6 @@ def _get_packages_from_files(pkg_path):
     return data
 
 
-def _add_packages_to_db(file_data):
-    logger.debug("Adding packages to database.")
-    raise NotImplementedError
-    for pkg, versions in file_data.items():
-        # TODO
-        # Check that the package exists in the database.
-        if not package_in_db(pkg):
-            db.insert_or_update_package(session, None, pkg, versions[0])
-
-        for version in versions:
-            if not version_in_db(pkg, version):
-                db.insert_version(session, package_id=None, title=pkg,
-                                  version=version)
-
-
-def _remove_packages_from_db(file_data, db_data):
-    logger.debug("Removing packages from database.")
-    raise NotImplementedError
-    for pkg, versions in db_data.items():
-        if pkg not in file_data.keys():
-            db.delete_version(pkg)
-        else:
-            for version in versions:
-                if version not in file_data[pkg]:
-                    db.delete_version(pkg, version)
-
-
 def _check_permissions():
     """Raise PermissionError if we're not root/sudo."""
     if os.getuid() != 0:
@@ -403,6 +844,31 @@ def _create_directories(server_path, package_dir, log_dir):
     _create_dir(log_path)
 
 
+def _load_config(server_path):
+    """Import the server's config.py file."""
+    # TODO: I hate this...
+    sys.path.append(str(server_path))
+    import config
+    return config
+
+
+def _create_session(db_backend, db_name, server_path):
+    """Create a database session for an existing database."""
+    if db_backend != 'sqlite':
+        msg = "The backend '%s' is not yet implmented" % db_backend
+        logger.error('Other database backends are not yet supported')
+        raise NotImplementedError(msg)
+
+    db_name = Path(server_path) / Path(db_name)
+    if not db_name.exists():
+        msg = "'{}' does not exist. Did you forget to run pynuget init?"
+        raise FileNotFoundError(msg.format(str(db_name)))
+
+    url = "sqlite:///{}".format(str(db_name))
+    engine = create_engine(url, echo=False)
+    return Session(bind=engine)
+
+
 def _create_db(db_backend, db_name, server_path):
     """Create the database (file or schema) if it doesn't exist."""
     logger.info("Creating database.")
@@ -3,15 +3,40 @@
 """
 import base64
 import hashlib
+import io
 import os
 import re
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import namedtuple
 from pathlib import Path
+from uuid import uuid4
 from zipfile import ZipFile
 
 from flask import current_app
+from flask import Request
 from lxml import etree as et
+from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import get_input_stream
 
 from pynuget import logger
+from pynuget import semver
+
+
+# Files are read and written in chunks of this size so that memory use
+# doesn't depend on the package size.
+CHUNK_SIZE = 64 * 1024
+
+# Uploads are written here (relative to the package dir) until we know
+# which package they are.
+TEMP_DIR = "_temp"
+
+# With `CONTENT_ADDRESSABLE_STORE`, package files are stored here (relative
+# to the package dir) by hash.
+BLOB_DIR = "_blobs"
 
 
 class PyNuGetException(Exception):
@@ -51,6 +76,64 @@ def get_package_path(package_id, version):
     return result
 
 
+def format_skiptoken(values):
+    """
+    Format values as an OData `$skiptoken`.
+
+    Parameters
+    ----------
+    values : iterable of str, int or None
+
+    Returns
+    -------
+    str
+        Eg: `'NuGetTest','0.0.1'`
+    """
+    formatted = []
+    for value in values:
+        if value is None:
+            formatted.append('null')
+        elif isinstance(value, int):
+            formatted.append(str(value))
+        else:
+            formatted.append("'{}'".format(str(value).replace("'", "''")))
+    return ",".join(formatted)
+
+
+_SKIPTOKEN_PART = re.compile(r"\s*(?:'(?P<str>(?:[^']|'')*)'|(?P<int>-?\d+)|(?P<null>null))\s*(?:,|$)")
+
+
+def parse_skiptoken(token):
+    """
+    Parse a `$skiptoken` created by :func:`format_skiptoken`.
+
+    Returns
+    -------
+    tuple
+
+    Raises
+    ------
+    ApiException
+        If the token is malformed.
+    """
+    values = []
+    pos = 0
+    while pos < len(token):
+        match = _SKIPTOKEN_PART.match(token, pos)
+        if match is None or match.end() == pos:
+            raise ApiException("api_error: Invalid $skiptoken")
+        if match.group('str') is not None:
+            values.append(match.group('str').replace("''", "'"))
+        elif match.group('int') is not None:
+            values.append(int(match.group('int')))
+        else:
+            values.append(None)
+        pos = match.end()
+    if not values:
+        raise ApiException("api_error: Invalid $skiptoken")
+    return tuple(values)
+
+
 def et_to_str(node):
     """Get the text value of an Element, returning None if not found."""
     try:
@@ -126,7 +209,8 @@ def hash_file(file, algorithm=hashlib.md5):
     logger.debug("Hashing file %s" % file)
     m = algorithm()
     with open(file, 'rb') as openf:
-        m.update(openf.read())
+        for chunk in iter(lambda: openf.read(CHUNK_SIZE), b''):
+            m.update(chunk)
     hash_ = m.hexdigest()
 
     logger.debug("%s hash: %s, %s" % (algorithm.__name__, hash_, file))
@@ -157,6 +241,283 @@ def encode_file(file, hash_):
     return hash_.decode('utf-8'), filesize
 
 
+class HashingFile(object):
+    """
+    A file wrapper that hashes and counts everything written to it.
+
+    All other attributes are passed through to the wrapped file.
+
+    Parameters
+    ----------
+    file : file-like object
+        Opened for writing in binary mode.
+    algorithm : Hash algorithm constructor
+        One of the hash algorithms present in the `hashlib` module.
+    """
+
+    def __init__(self, file, algorithm=hashlib.sha512):
+        self.file = file
+        self.hash = algorithm()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def encoded_hash(self):
+        """Return the Base64 encoded digest and the number of bytes."""
+        return base64.b64encode(self.hash.digest()).decode('utf-8'), self.size
+
+
+class UploadRequest(Request):
+    """
+    Request class that hashes file uploads while they're received.
+
+    Werkzeug writes each chunk of the request body to the stream returned
+    by :meth:`_get_file_stream`. Using a :class:`HashingFile` there means
+    the upload is written to disk once and never needs to be read back
+    just to hash it.
+
+    The temporary files that are still there when the request is closed
+    (eg. the push was rejected, or extra files were sent) are deleted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._upload_paths = []
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        temp_dir = (Path(current_app.config['SERVER_PATH'])
+                    / Path(current_app.config['PACKAGE_DIR'])
+                    / TEMP_DIR)
+        os.makedirs(str(temp_dir), mode=0o0755, exist_ok=True)
+        # Not deleted on close: `push()` renames it into place.
+        file = tempfile.NamedTemporaryFile(dir=str(temp_dir),
+                                           suffix=".nupkg",
+                                           delete=False)
+        self._upload_paths.append(file.name)
+        return HashingFile(file)
+
+    def close(self):
+        """Close the uploaded files and delete those that were not stored."""
+        super().close()
+        for path in self._upload_paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            else:
+                logger.debug("Deleted unused upload %s" % path)
+        self._upload_paths = []
+
+
+class GzipDecodingStream(io.RawIOBase):
+    """
+    A readable stream that decompresses a gzip encoded request body.
+
+    Decompression is done one chunk at a time, so memory use doesn't depend
+    on the size of the body.
+
+    Parameters
+    ----------
+    stream : readable binary file-like object
+        The compressed request body.
+    max_size : int or None
+        Raise :class:`werkzeug.exceptions.RequestEntityTooLarge` if the
+        decompressed body is larger than this.
+    """
+
+    def __init__(self, stream, max_size=None):
+        self._stream = stream
+        self._max_size = max_size
+        # 16 + MAX_WBITS: expect a gzip header and trailer.
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = b''
+        self._size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            if self._decompressor.eof:
+                return 0
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._stream.read(CHUNK_SIZE)
+                if not data:
+                    raise BadRequest("Truncated gzip request body")
+            try:
+                self._buffer = self._decompressor.decompress(data, CHUNK_SIZE)
+            except zlib.error as err:
+                raise BadRequest("Invalid gzip request body: %s" % err)
+            self._size += len(self._buffer)
+            if self._max_size is not None and self._size > self._max_size:
+                raise RequestEntityTooLarge()
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class GzipRequestMiddleware(object):
+    """
+    WSGI middleware that accepts request bodies sent with
+    `Content-Encoding: gzip`.
+
+    The body is decompressed while the application reads it. Its
+    decompressed length isn't known up front, so `CONTENT_LENGTH` is
+    removed and `wsgi.input_terminated` is set so that Werkzeug reads the
+    stream to the end.
+
+    Parameters
+    ----------
+    app : WSGI application
+    max_size : int or None
+        The largest decompressed body that is accepted.
+    """
+
+    def __init__(self, app, max_size=None):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding == 'gzip':
+            logger.debug("Decompressing gzip request body.")
+            stream = GzipDecodingStream(get_input_stream(environ),
+                                        self.max_size)
+            environ['wsgi.input'] = io.BufferedReader(stream, CHUNK_SIZE)
+            environ['wsgi.input_terminated'] = True
+            environ.pop('CONTENT_LENGTH', None)
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
+
+
+def save_upload(file):
+    """
+    Save an uploaded package to the temp dir and hash it.
+
+    If the upload was received by :class:`UploadRequest` it is already on
+    disk and hashed, so nothing is copied. Otherwise the file is copied in
+    chunks and hashed along the way.
+
+    Parameters
+    ----------
+    file : :class:`werkzeug.datastructures.FileStorage` object
+        The file as retrieved by Flask.
+
+    Returns:
+    --------
+    local_path : :class:`pathlib.Path`
+        The path to the saved file.
+    hash_ : str
+        The Base64 encoded SHA512 hash.
+    filesize : int
+    """
+    stream = file.stream
+    if isinstance(stream, HashingFile):
+        stream.flush()
+        local_path = Path(stream.name)
+        # Temporary files are only readable by their owner.
+        os.chmod(str(local_path), 0o0644)
+    else:
+        server_path = Path(current_app.config['SERVER_PATH'])
+        package_dir = Path(current_app.config['PACKAGE_DIR'])
+        local_path = (server_path / package_dir / TEMP_DIR
+                      / (str(uuid4()) + ".nupkg"))
+        create_parent_dirs(local_path)
+        logger.debug("Saving uploaded file to filesystem.")
+        with open(str(local_path), 'wb') as openf:
+            stream = HashingFile(openf)
+            shutil.copyfileobj(file.stream, stream, CHUNK_SIZE)
+
+    hash_, filesize = stream.encoded_hash()
+    logger.debug("Saved upload to %s: %d bytes, SHA512 %s"
+                 % (str(local_path), filesize, hash_))
+    return local_path, hash_, filesize
+
+
+def get_storage():
+    """Get the :class:`storage.Storage` of the current app."""
+    return current_app.extensions['pynuget']['storage']
+
+
+def get_blob_path(hash_):
+    """
+    Get the content-addressed path for a package file.
+
+    Parameters
+    ----------
+    hash_ : str
+        The Base64 encoded SHA512 hash of the package file.
+
+    Returns
+    -------
+    :class:`pathlib.Path`
+        Path to the blob, relative to the package dir.
+    """
+    hex_hash = base64.b64decode(hash_).hex()
+    return Path(BLOB_DIR) / hex_hash[:2] / (hex_hash + ".nupkg")
+
+
+def store_package(file, key, hash_):
+    """
+    Move an uploaded package file into the package storage.
+
+    With `CONTENT_ADDRESSABLE_STORE`, the file is stored once per hash
+    under :data:`BLOB_DIR` and `key` is linked to it. Pushing the same
+    bytes again only adds another link.
+
+    Parameters
+    ----------
+    file : :class:`pathlib.Path`
+        The uploaded file, as returned by :func:`save_upload`.
+    key : :class:`pathlib.Path` or str
+        Where the package is looked up, see :func:`get_package_path`.
+    hash_ : str
+        The Base64 encoded SHA512 hash of the package file.
+    """
+    storage = get_storage()
+    key = Path(key).as_posix()
+    if not current_app.config['CONTENT_ADDRESSABLE_STORE']:
+        storage.put_file(key, file)
+        return
+
+    blob = get_blob_path(hash_).as_posix()
+    if storage.stat(blob) is not None:
+        logger.info("Package file already stored as %s" % blob)
+        file.unlink()
+    else:
+        storage.put_file(blob, file)
+    storage.link(blob, key)
+
+
+def remove_blob(hash_):
+    """
+    Delete the content-addressed file for a hash, if there is one.
+
+    Only call this once no version refers to the hash any more.
+
+    Parameters
+    ----------
+    hash_ : str
+        The Base64 encoded SHA512 hash of the package file.
+    """
+    blob = get_blob_path(hash_).as_posix()
+    logger.info("Deleting unreferenced package file %s" % blob)
+    get_storage().delete(blob)
+
+
 def save_file(file, pkg_name, version):
     """
     Parameters
@@ -168,29 +529,25 @@ def save_file(file, pkg_name, version):
 
     Returns:
     --------
-    local_path : :class:`pathlib.Path`
-        The path to the saved file.
+    local_path : :class:`pathlib.Path` or None
+        The path to the saved file, or None if the storage backend doesn't
+        keep files on the local filesystem.
     """
-    # Save the package file to the local package dir. Thus far it's
+    # Save the package file to the package storage. Thus far it's
     # just been floating around in magic Flask land.
-    server_path = Path(current_app.config['SERVER_PATH'])
-    package_dir = Path(current_app.config['PACKAGE_DIR'])
-    local_path = server_path / package_dir
-    local_path = local_path / pkg_name / (version + ".nupkg")
+    storage = get_storage()
+    key = get_package_path(pkg_name, version).as_posix()
 
-    # Check if the package's directory already exists. Create if needed.
-    create_parent_dirs(local_path)
-
-    logger.debug("Saving uploaded file to filesystem.")
+    logger.debug("Saving uploaded file to storage.")
     try:
-        file.save(str(local_path))
+        storage.put_stream(key, file.stream)
     except Exception as err:       # TODO: specify exceptions
         logger.error("Unknown exception: %s" % err)
         raise err
     else:
-        logger.info("Succesfully saved package to '%s'" % str(local_path))
+        logger.info("Succesfully saved package to '%s'" % key)
 
-    return local_path
+    return storage.local_path(key)
 
 
 def create_parent_dirs(path):
@@ -207,6 +564,139 @@ def create_parent_dirs(path):
                 )
 
 
+class _UnsupportedZip(Exception):
+    """The fast nuspec reader can't handle this archive."""
+
+
+# Zip record layouts. See section 4.3 of the PKWARE APPNOTE.
+_EOCD = struct.Struct('<4s4H2LH')
+_EOCD_SIGNATURE = b'PK\x05\x06'
+_CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+_CentralDirRecord = namedtuple('_CentralDirRecord', [
+    'signature', 'create_version', 'create_system', 'extract_version',
+    'reserved', 'flags', 'method', 'time', 'date', 'crc', 'compressed_size',
+    'file_size', 'name_len', 'extra_len', 'comment_len', 'disk_start',
+    'internal_attr', 'external_attr', 'header_offset',
+])
+_CENTRAL_DIR_SIGNATURE = b'PK\x01\x02'
+# The name, extra field and comment lengths, 28 bytes into the record.
+_CENTRAL_DIR_LENGTHS = struct.Struct('<3H')
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LocalHeader = namedtuple('_LocalHeader', [
+    'signature', 'extract_version', 'reserved', 'flags', 'method', 'time',
+    'date', 'crc', 'compressed_size', 'file_size', 'name_len', 'extra_len',
+])
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# The EOCD record is at the end, followed by a comment of up to 64 KiB.
+_EOCD_SEARCH_SIZE = _EOCD.size + 0xFFFF
+
+
+def _read_root_nuspec(openf):
+    """
+    Read the root-level .nuspec file of a zip archive.
+
+    Rather than building a `ZipInfo` for every member like `ZipFile`
+    does, the central directory is read in one go and only the name of
+    each record is looked at.
+
+    Parameters
+    ----------
+    openf : file object
+        The archive, opened in binary mode.
+
+    Returns
+    -------
+    bytes
+
+    Raises
+    ------
+    _UnsupportedZip
+        For archives that need the full `zipfile` module: ZIP64, encrypted
+        or unusually compressed entries, or anything unexpected.
+    ApiException
+        If there is no root-level .nuspec file, or more than one.
+    """
+    openf.seek(0, os.SEEK_END)
+    file_size = openf.tell()
+    openf.seek(max(file_size - _EOCD_SEARCH_SIZE, 0))
+    tail = openf.read()
+    eocd_pos = tail.rfind(_EOCD_SIGNATURE)
+    if eocd_pos < 0 or len(tail) - eocd_pos < _EOCD.size:
+        raise _UnsupportedZip("End of central directory not found")
+    (_, disk, cd_disk, _, count,
+     cd_size, cd_offset, _) = _EOCD.unpack_from(tail, eocd_pos)
+    if (disk or cd_disk or count == 0xFFFF or cd_size == 0xFFFFFFFF
+            or cd_offset == 0xFFFFFFFF):
+        raise _UnsupportedZip("Multi-disk or ZIP64 archive")
+
+    openf.seek(cd_offset)
+    central_dir = openf.read(cd_size)
+    if len(central_dir) != cd_size:
+        raise _UnsupportedZip("Truncated central directory")
+
+    # Only the name lengths are unpacked for each record. The whole record
+    # is only unpacked for the .nuspec file.
+    found = None
+    pos = 0
+    record_size = _CENTRAL_DIR.size
+    unpack_lengths = _CENTRAL_DIR_LENGTHS.unpack_from
+    for _ in range(count):
+        if central_dir[pos:pos + 4] != _CENTRAL_DIR_SIGNATURE:
+            raise _UnsupportedZip("Bad central directory record")
+        lengths = unpack_lengths(central_dir, pos + 28)
+        name_len, extra_len, comment_len = lengths
+        name_start = pos + record_size
+        name = central_dir[name_start:name_start + name_len]
+        record_pos = pos
+        pos = name_start + name_len + extra_len + comment_len
+
+        if not name.lower().endswith(b'.nuspec') or b'/' in name:
+            continue
+        if found is not None:
+            logger.error("Multiple NuSpec files found within the package.")
+            raise ApiException("api_error: multiple nuspec files found")
+        found = _CENTRAL_DIR.unpack_from(central_dir, record_pos)
+
+    if found is None:
+        logger.error("No NuSpec file found in the package.")
+        raise ApiException("api_error: nuspec file not found")      # TODO
+
+    found = _CentralDirRecord._make(found)
+    if found.flags & 0x1 or found.method not in (0, 8):
+        raise _UnsupportedZip("Encrypted or unsupported compression")
+
+    openf.seek(found.header_offset)
+    header = openf.read(_LOCAL_HEADER.size)
+    if len(header) != _LOCAL_HEADER.size:
+        raise _UnsupportedZip("Truncated local file header")
+    header = _LocalHeader._make(_LOCAL_HEADER.unpack(header))
+    if header.signature != _LOCAL_HEADER_SIGNATURE:
+        raise _UnsupportedZip("Bad local file header")
+    openf.seek(header.name_len + header.extra_len, os.SEEK_CUR)
+    data = openf.read(found.compressed_size)
+
+    if found.method == 8:
+        data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+    if len(data) != found.file_size:
+        raise _UnsupportedZip("Unexpected nuspec size")
+    return data
+
+
+def _read_root_nuspec_zipfile(file):
+    """Same as :func:`_read_root_nuspec`, using the `zipfile` module."""
+    with ZipFile(str(file), 'r') as pkg:
+        nuspec_file = [name for name in pkg.namelist()
+                       if '/' not in name
+                       and name.lower().endswith('.nuspec')]
+        if len(nuspec_file) > 1:
+            logger.error("Multiple NuSpec files found within the package.")
+            raise ApiException("api_error: multiple nuspec files found")
+        elif len(nuspec_file) == 0:
+            logger.error("No NuSpec file found in the package.")
+            raise ApiException("api_error: nuspec file not found")  # TODO
+        return pkg.read(nuspec_file[0])
+
+
 def extract_nuspec(file):
     """
     Parameters
@@ -214,23 +704,18 @@ def extract_nuspec(file):
     file : :class:`pathlib.Path` object or str
         The file as retrieved by Flask.
     """
-    pkg = ZipFile(str(file), 'r')
     logger.debug("Parsing uploaded file.")
-    nuspec_file = None
-    pattern = re.compile(r'^.*\.nuspec$', re.IGNORECASE)
-    nuspec_file = list(filter(pattern.search, pkg.namelist()))
-    if len(nuspec_file) > 1:
-        logger.error("Multiple NuSpec files found within the package.")
-        raise ApiException("api_error: multiple nuspec files found")
-    elif len(nuspec_file) == 0:
-        logger.error("No NuSpec file found in the package.")
-        raise ApiException("api_error: nuspec file not found")      # TODO
-    nuspec_file = nuspec_file[0]
-
-    with pkg.open(nuspec_file, 'r') as openf:
-        nuspec_string = openf.read()
-        logger.debug("NuSpec string:")
-        logger.debug(nuspec_string)
+    with open(str(file), 'rb') as openf:
+        try:
+            nuspec_string = _read_root_nuspec(openf)
+        except _UnsupportedZip as err:
+            logger.debug("Falling back to zipfile: %s" % err)
+            nuspec_string = None
+    if nuspec_string is None:
+        nuspec_string = _read_root_nuspec_zipfile(file)
+
+    logger.debug("NuSpec string:")
+    logger.debug(nuspec_string)
 
     logger.debug("Parsing NuSpec file XML")
     nuspec = et.fromstring(nuspec_string)
@@ -241,6 +726,74 @@ def extract_nuspec(file):
     return nuspec
 
 
+def version_fields(metadata, ns, version, dependencies):
+    """
+    Get the :class:`db.Version` column values from a nuspec's metadata.
+
+    Parameters
+    ----------
+    metadata : :class:`lxml.etree.Element`
+        As returned by :func:`parse_nuspec`.
+    ns : dict
+        The nuspec namespace.
+    version : str
+    dependencies : list of dict
+        As returned by :func:`determine_dependencies`.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for :func:`db.insert_version`, except for the
+        `package_id` and the package file's hash and size.
+    """
+    def text(tag):
+        return et_to_str(metadata.find('nuspec:' + tag, ns))
+
+    return {
+        'authors': text('authors'),
+        'copyright_': text('copyright'),
+        'dependencies': dependencies,
+        'description': text('description'),
+        'icon_url': text('iconUrl'),
+        'is_prerelease': semver.is_prerelease(version),
+        'license_url': text('licenseUrl'),
+        'owners': text('owners'),
+        'project_url': text('projectUrl'),
+        'release_notes': text('releaseNotes'),
+        'require_license_acceptance': (
+            text('requireLicenseAcceptance') == 'true'),
+        'tags': text('tags'),
+        'title': text('id'),
+        'version': version,
+    }
+
+
+def read_package_metadata(file):
+    """
+    Parse the nuspec of a package file.
+
+    Parameters
+    ----------
+    file : :class:`pathlib.Path` object or str
+
+    Returns
+    -------
+    dict
+        `id` and `title` of the package, and `fields`: the version's
+        column values, see :func:`version_fields`. This is what
+        :func:`db.save_package_file` stores.
+    """
+    nuspec = extract_nuspec(file)
+    ns = {'nuspec': extract_namespace(nuspec)}
+    metadata, pkg_name, version = parse_nuspec(nuspec, ns)
+    dependencies = determine_dependencies(metadata, ns)
+    return {
+        'id': pkg_name,
+        'title': et_to_str(metadata.find('nuspec:title', ns)),
+        'fields': version_fields(metadata, ns, version, dependencies),
+    }
+
+
 def extract_namespace(nuspec):
     """
     Extract the namespce from the NuSpec file.
@@ -7,19 +7,43 @@ human-friendly title of the package.
 
 import datetime as dt
 import json
-
-from sqlalchemy import Column, Integer, String, Text, Boolean
+import re
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import Column, Integer, String, Text, Boolean, Float
+from sqlalchemy import DateTime
+from sqlalchemy import LargeBinary
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import MetaData
+from sqlalchemy import Table
 from sqlalchemy import func
 from sqlalchemy import desc
+from sqlalchemy import and_
+from sqlalchemy import bindparam
 from sqlalchemy import or_
-from sqlalchemy import cast
+from sqlalchemy import column
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import true
 from sqlalchemy.dialects import sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm import deferred
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import undefer
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.pool import SingletonThreadPool
 
 from pynuget import logger
+from pynuget import semver
 
 
 Base = declarative_base()
@@ -41,6 +65,11 @@ class Package(Base):
         return "<Package({}, {})>".format(self.package_id, self.name)
 
 
+# Backs PACKAGE_DOWNLOAD_COUNT_ORDER.
+Index('ix_package_download_count_name',
+      Package.download_count.desc(), Package.name)
+
+
 class Version(Base):
     """
     """
@@ -69,21 +98,908 @@ class Version(Base):
     require_license_acceptance = Column(Boolean())
     copyright_ = Column(Text())
     is_prerelease = Column(Boolean())
+    # See semver.sort_key. Set automatically from `version`.
+    sort_key = Column(String(128))
+    # The highest release / the highest version of the package. Kept up to
+    # date automatically, see `_update_latest_versions`.
+    is_latest = Column(Boolean(), default=False)
+    is_absolute_latest = Column(Boolean(), default=False)
+    # The pre-rendered feed <entry>. See feedwriter.render_entry_template.
+    feed_entry = deferred(Column(LargeBinary()))
 
     package = relationship("Package", backref="versions")
 
+    __table_args__ = (
+        # Used to look up a version of a package.
+        Index('ix_version_package_id_version', 'package_id', 'version'),
+    )
+
     def __repr__(self):
         return "<Version({}, {}, {})>".format(self.version_id, self.package.name, self.version)
 
-    @hybrid_property
-    def thing(self):
-        return "{}~~{}".format(self.package_id, self.version)
 
-    @thing.expression
-    def thing(cls):
-        name = cast(cls.package_id, String)
-        version = cast(cls.version, String)
-        return name + "~~" + version
+# These back the sort orders that only use columns of the version table,
+# so that SQLite can walk the index and stop after $top rows.
+Index('ix_version_download_count_id',
+      Version.version_download_count.desc(), Version.version_id)
+Index('ix_version_created_id', Version.created.desc(), Version.version_id)
+Index('ix_version_sort_key_id', Version.sort_key, Version.version_id)
+# Used to find out if a package file is still referenced, see
+# `count_versions_by_hash`.
+Index('ix_version_package_hash', Version.package_hash)
+# Used to find the latest versions of a package, and by ID_ORDER.
+Index('ix_version_package_id_sort_key', Version.package_id, Version.sort_key)
+# Used by the IsLatestVersion / IsAbsoluteLatestVersion filters.
+Index('ix_version_is_latest', Version.is_latest)
+Index('ix_version_is_absolute_latest', Version.is_absolute_latest)
+
+
+class PackageFile(Base):
+    """
+    The parsed nuspec of a package file.
+
+    Saved at push time so that bulk operations (rebuilding the database,
+    checking the package files) don't have to open and parse every package
+    again. A file whose size, modification time and inode still match its
+    row hasn't changed, see :meth:`is_unchanged`.
+    """
+
+    __tablename__ = "package_file"
+
+    package_file_id = Column(Integer, primary_key=True)
+    # The storage key, e.g. "NuGetTest/0.0.1.nupkg"
+    path = Column(Text(), unique=True, nullable=False)
+    size = Column(Integer)
+    mtime = Column(Float)
+    inode = Column(Integer)
+    package_hash = Column(Text())
+    # JSON, see `core.read_package_metadata`
+    nuspec = Column(Text())
+
+    def __repr__(self):
+        return "<PackageFile({}, {})>".format(self.package_file_id,
+                                              self.path)
+
+    @property
+    def parsed(self):
+        """The parsed nuspec, see :func:`core.read_package_metadata`."""
+        return json.loads(self.nuspec)
+
+    def is_unchanged(self, stat):
+        """
+        Check if the file still matches this row.
+
+        Parameters
+        ----------
+        stat : :class:`storage.ObjectStat`
+        """
+        return (stat is not None
+                and stat.size == self.size
+                and stat.modified == self.mtime
+                and stat.inode == self.inode)
+
+
+class CatalogState(Base):
+    """
+    A single row that tracks changes to the package catalog.
+
+    `change_counter` is incremented every time a version is added or
+    removed. The feed routes use it for their ETags.
+    """
+
+    __tablename__ = "catalog_state"
+
+    catalog_id = Column(Integer, primary_key=True)
+    change_counter = Column(Integer, nullable=False, default=0)
+    last_modified = Column(DateTime())
+
+    def __repr__(self):
+        return "<CatalogState({}, {})>".format(self.change_counter,
+                                               self.last_modified)
+
+
+# Full-text search index ###################################################
+#
+# `version_search` is an SQLite FTS5 table with one row per Version (the
+# FTS rowid is the version_id). It's created along with the other tables,
+# kept up to date by the Version and Package mapper events below (inserts,
+# deletes and updates of the indexed columns) and can be rebuilt with
+# `pynuget reindex`. If the table is missing (an old database, or an SQLite
+# build without FTS5), searches fall back to LIKE.
+
+SEARCH_TABLE = "version_search"
+
+_CREATE_SEARCH_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(
+    name, title, tags, description, authors,
+    tokenize = 'unicode61'
+)""".format(SEARCH_TABLE)
+
+_INSERT_SEARCH_ROWS = """
+INSERT INTO {} (rowid, name, title, tags, description, authors)
+SELECT v.version_id, p.name, p.title, v.tags, v.description, v.authors
+FROM version v JOIN package p ON p.package_id = v.package_id
+""".format(SEARCH_TABLE)
+
+
+@event.listens_for(Version.__table__, 'after_create')
+def _create_search_index(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.execute(_CREATE_SEARCH_TABLE)
+    except OperationalError as err:
+        logger.warning("Unable to create the search index: %s" % err)
+
+
+@event.listens_for(Version.__table__, 'before_drop')
+def _drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute("DROP TABLE IF EXISTS {}".format(SEARCH_TABLE))
+
+
+def _has_search_index(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    sql = text("SELECT 1 FROM sqlite_master WHERE type = 'table'"
+               " AND name = :name")
+    return connection.execute(sql, name=SEARCH_TABLE).scalar() is not None
+
+
+@event.listens_for(Version, 'after_insert')
+def _index_version(mapper, connection, target):
+    if not _has_search_index(connection):
+        return
+    sql = text(_INSERT_SEARCH_ROWS + " WHERE v.version_id = :version_id")
+    connection.execute(sql, version_id=target.version_id)
+
+
+@event.listens_for(Version, 'after_delete')
+def _unindex_version(mapper, connection, target):
+    if not _has_search_index(connection):
+        return
+    sql = text("DELETE FROM {} WHERE rowid = :version_id"
+               .format(SEARCH_TABLE))
+    connection.execute(sql, version_id=target.version_id)
+
+
+# The columns that are copied into the search index.
+_INDEXED_VERSION_ATTRS = ('tags', 'description', 'authors')
+_INDEXED_PACKAGE_ATTRS = ('name', 'title')
+
+
+def _has_changes(target, attrs):
+    state = inspect(target)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+@event.listens_for(Version, 'after_update')
+def _reindex_version(mapper, connection, target):
+    if not _has_changes(target, _INDEXED_VERSION_ATTRS):
+        return
+    if not _has_search_index(connection):
+        return
+    _unindex_version(mapper, connection, target)
+    _index_version(mapper, connection, target)
+
+
+@event.listens_for(Package, 'after_update')
+def _reindex_package(mapper, connection, target):
+    if not _has_changes(target, _INDEXED_PACKAGE_ATTRS):
+        return
+    if not _has_search_index(connection):
+        return
+    where = (" WHERE rowid IN (SELECT version_id FROM version"
+             " WHERE package_id = :package_id)")
+    connection.execute(text("DELETE FROM {}".format(SEARCH_TABLE) + where),
+                       package_id=target.package_id)
+    connection.execute(text(_INSERT_SEARCH_ROWS
+                            + " WHERE v.package_id = :package_id"),
+                       package_id=target.package_id)
+
+
+# Latest versions ###########################################################
+#
+# `Version.sort_key` is set from the version string whenever a Version is
+# written. After each flush that adds, deletes or changes the version of
+# any Version, the `is_latest` / `is_absolute_latest` flags and
+# `Package.latest_version` of the affected packages are recomputed in the
+# same transaction.
+
+_LATEST_PENDING = 'pynuget_latest_pending'
+
+
+@event.listens_for(Version, 'before_insert')
+@event.listens_for(Version, 'before_update')
+def _set_sort_key(mapper, connection, target):
+    if target.version is not None:
+        target.sort_key = semver.sort_key(target.version)
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_deleted_versions(session, flush_context, instances):
+    # Deleted rows can't be read after the flush.
+    pending = session.info.setdefault(_LATEST_PENDING, set())
+    pending.update(obj.package_id for obj in session.deleted
+                   if isinstance(obj, Version))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_versions(session, flush_context):
+    # New rows only have their package_id after the flush.
+    pending = session.info.setdefault(_LATEST_PENDING, set())
+    pending.update(obj.package_id for obj in session.new
+                   if isinstance(obj, Version))
+    for obj in session.dirty:
+        if not isinstance(obj, Version):
+            continue
+        attrs = inspect(obj).attrs
+        if any(attrs[name].history.has_changes()
+               for name in ('version', 'is_prerelease', 'package_id')):
+            pending.add(obj.package_id)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _update_pending_latest_versions(session, flush_context):
+    pending = session.info.pop(_LATEST_PENDING, set())
+    pending.discard(None)
+    if not pending:
+        return
+    _update_latest_versions(session.connection(), pending)
+
+    # The loaded objects still have the old values.
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Version) and obj.package_id in pending:
+            session.expire(obj, ['is_latest', 'is_absolute_latest'])
+        elif isinstance(obj, Package) and obj.package_id in pending:
+            session.expire(obj, ['latest_version'])
+
+
+def _latest_version_query(package_id, release_only):
+    """The highest version of a package as a scalar subquery."""
+    other = Version.__table__.alias('other')
+    query = select([other.c.version_id]).where(other.c.package_id == package_id)
+    if release_only:
+        query = query.where(other.c.is_prerelease.isnot(True))
+    return (query.order_by(other.c.sort_key.desc(),
+                           other.c.version_id.desc())
+            .limit(1)
+            .as_scalar())
+
+
+def _update_latest_versions(connection, package_ids):
+    """
+    Recompute the latest version flags and `Package.latest_version`.
+
+    Uses one UPDATE per table for all of `package_ids`, each looking up the
+    highest version with the `ix_version_package_id_sort_key` index.
+    """
+    logger.debug("db._update_latest_versions(%s)" % sorted(package_ids))
+    package_ids = list(package_ids)
+    version = Version.__table__
+    latest = _latest_version_query(version.c.package_id, True)
+    absolute = _latest_version_query(version.c.package_id, False)
+    connection.execute(
+        version.update()
+        .where(version.c.package_id.in_(package_ids))
+        .values(is_latest=func.coalesce(version.c.version_id == latest,
+                                        False),
+                is_absolute_latest=func.coalesce(
+                    version.c.version_id == absolute, False))
+    )
+
+    package = Package.__table__
+    latest_version = (select([version.c.version])
+                      .where(version.c.package_id == package.c.package_id)
+                      .where(version.c.is_absolute_latest == true())
+                      .limit(1)
+                      .as_scalar())
+    connection.execute(
+        package.update()
+        .where(package.c.package_id.in_(package_ids))
+        .values(latest_version=func.coalesce(latest_version,
+                                             package.c.latest_version))
+    )
+
+
+def _backfill_sort_keys(connection):
+    """Set the sort key and latest flags of versions that don't have them."""
+    version = Version.__table__
+    rows = connection.execute(
+        select([version.c.version_id, version.c.package_id,
+                version.c.version])
+        .where(version.c.sort_key.is_(None))
+    ).fetchall()
+    if not rows:
+        return
+    logger.info("Computing the sort keys of %d versions" % len(rows))
+    connection.execute(
+        version.update()
+        .where(version.c.version_id == bindparam('id_'))
+        .values(sort_key=bindparam('key')),
+        [{'id_': row.version_id, 'key': semver.sort_key(row.version or "")}
+         for row in rows],
+    )
+    _update_latest_versions(connection, {row.package_id for row in rows})
+
+
+def rebuild_search_index(session):
+    """
+    Drop and recreate the full-text search index from the version table.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+
+    Returns
+    -------
+    int
+        The number of indexed versions.
+    """
+    logger.debug("db.rebuild_search_index()")
+    connection = session.connection()
+    connection.execute("DROP TABLE IF EXISTS {}".format(SEARCH_TABLE))
+    connection.execute(_CREATE_SEARCH_TABLE)
+    connection.execute(_INSERT_SEARCH_ROWS)
+    session.commit()
+    count = session.query(func.count(Version.version_id)).scalar()
+    logger.info("Indexed %d versions." % count)
+    return count
+
+
+def _search_match_expression(search_query):
+    """
+    Convert a user's search terms into an FTS5 MATCH expression.
+
+    Every word must match, and the last word in the query can be
+    a partial word. Returns None if there are no words to search for.
+    """
+    words = re.findall(r'\w+', search_query)
+    if not words:
+        return None
+    terms = ['"{}"'.format(word) for word in words]
+    terms[-1] += '*'
+    return " ".join(terms)
+
+
+# Sort the search results by relevance (bm25 rank of the full-text search).
+# If there's no search term, DOWNLOAD_COUNT_ORDER is used instead.
+RELEVANCE = 'relevance'
+
+
+SortKey = namedtuple('SortKey', ['column', 'descending', 'attr'])
+SortKey.__doc__ = """
+One column of a sort order.
+
+`attr` is the dotted attribute path used to read the value of `column` from
+a :class:`Version` result row, eg: 'package.name'.
+"""
+
+# Sort orders are tuples of SortKey. They always end with columns that make
+# each row unique so that they can be used for keyset ($skiptoken) paging.
+# Orders on version columns break ties with `version_id` rather than the
+# package name so that a single index covers the whole ORDER BY. Versions
+# are sorted by `sort_key`, so "1.10.0" comes after "1.9.0".
+DOWNLOAD_COUNT_ORDER = (
+    SortKey(Version.version_download_count, True, 'version_download_count'),
+    SortKey(Version.version_id, False, 'version_id'),
+)
+
+PACKAGE_VERSION_ORDER = (
+    SortKey(Package.name, False, 'package.name'),
+    SortKey(Version.sort_key, False, 'sort_key'),
+    SortKey(Version.version_id, False, 'version_id'),
+)
+ID_ORDER = PACKAGE_VERSION_ORDER
+
+PACKAGE_DOWNLOAD_COUNT_ORDER = (
+    SortKey(Package.download_count, True, 'package.download_count'),
+    SortKey(Package.name, False, 'package.name'),
+    SortKey(Version.sort_key, False, 'sort_key'),
+    SortKey(Version.version_id, False, 'version_id'),
+)
+
+PUBLISHED_ORDER = (
+    SortKey(Version.created, True, 'created'),
+    SortKey(Version.version_id, False, 'version_id'),
+)
+
+VERSION_ORDER = (
+    SortKey(Version.sort_key, False, 'sort_key'),
+    SortKey(Version.version_id, False, 'version_id'),
+)
+
+# OData `$orderby` values, lowercased and without whitespace after commas,
+# and the sort order they map to. Clients often add ",Id" as a tie-breaker;
+# every order here already ends with unique columns so it's ignored.
+ODATA_ORDERS = {
+    'id': ID_ORDER,
+    'concat(title,id)': ID_ORDER,
+    'downloadcount desc': PACKAGE_DOWNLOAD_COUNT_ORDER,
+    'published desc': PUBLISHED_ORDER,
+    'version': VERSION_ORDER,
+}
+
+
+# `$filter` values and the flag column they select.
+LATEST_FILTERS = {
+    'IsLatestVersion': Version.is_latest,
+    'is_latest_version': Version.is_latest,
+    'IsAbsoluteLatestVersion': Version.is_absolute_latest,
+    'is_absolute_latest_version': Version.is_absolute_latest,
+}
+
+
+def parse_odata_order(order_by):
+    """
+    Get the sort order for an OData `$orderby` value.
+
+    Parameters
+    ----------
+    order_by : str
+        Eg: 'DownloadCount desc,Id'
+
+    Returns
+    -------
+    tuple of :class:`SortKey` or None
+        None if the ordering is not supported.
+    """
+    normalized = re.sub(r'\s+', ' ', order_by.strip().lower())
+    normalized = re.sub(r'\s*,\s*', ',', normalized)
+    if normalized.endswith(',id'):
+        normalized = normalized[:-len(',id')]
+    return ODATA_ORDERS.get(normalized, None)
+
+
+def is_sort_order(order_by):
+    """Return True if `order_by` is a tuple of :class:`SortKey`."""
+    return (isinstance(order_by, tuple)
+            and all(isinstance(key, SortKey) for key in order_by))
+
+
+def sort_values(row, order_by):
+    """
+    Get the values of the sort columns for a result row.
+
+    Parameters
+    ----------
+    row : :class:`Version`
+    order_by : tuple of :class:`SortKey`
+
+    Returns
+    -------
+    tuple
+    """
+    values = []
+    for key in order_by:
+        value = row
+        for name in key.attr.split('.'):
+            value = getattr(value, name)
+        values.append(value)
+    return tuple(values)
+
+
+def _order_clauses(order_by):
+    return [desc(key.column) if key.descending else key.column
+            for key in order_by]
+
+
+def _keyset_filter(order_by, values):
+    """
+    Build a predicate that matches the rows after `values` in `order_by`.
+
+    This is the expanded form of the row-value comparison
+    ``(a, b, c) > (x, y, z)``, which lets the database seek straight to the
+    start of the page using the index on the leading sort column instead
+    of reading and discarding the preceding rows like OFFSET does.
+    """
+    if len(values) != len(order_by):
+        msg = "Expected {} keyset values, got {}"
+        raise ValueError(msg.format(len(order_by), len(values)))
+
+    clauses = []
+    for i, key in enumerate(order_by):
+        equal = [k.column == v for k, v in zip(order_by[:i], values[:i])]
+        if key.descending:
+            after = key.column < values[i]
+        else:
+            after = key.column > values[i]
+        clauses.append(and_(*(equal + [after])))
+    return or_(*clauses)
+
+
+class PoolStats(object):
+    """
+    Thread-safe connection pool statistics.
+
+    Counters are updated by SQLAlchemy pool events (see
+    :func:`create_db_engine`) and by :meth:`record_wait`, which the routes
+    call with the time it took to get a connection for a request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out,
+                                        self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def record_wait(self, seconds):
+        """Record how long a caller waited to check out a connection."""
+        with self._lock:
+            self.wait_count += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def as_dict(self):
+        with self._lock:
+            avg = self.wait_total / self.wait_count if self.wait_count else 0
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'wait_count': self.wait_count,
+                'wait_total_ms': self.wait_total * 1000,
+                'wait_avg_ms': avg * 1000,
+                'wait_max_ms': self.wait_max * 1000,
+            }
+
+
+def create_db_engine(url, pool_size=5, max_overflow=10, pool_recycle=-1,
+                     pool_pre_ping=False, sqlite_thread_pool=False,
+                     stats=None):
+    """
+    Create a pooled engine. Meant to be called once per process.
+
+    Parameters
+    ----------
+    url : str
+        The SQLAlchemy database URL.
+    pool_size : int
+        Number of connections to keep open. For SQLite with
+        `sqlite_thread_pool`, this is the number of per-thread connections
+        to keep and must be at least the number of threads that use the
+        engine: beyond it, the connections of other threads are closed even
+        if they are in use.
+    max_overflow : int
+        Number of connections that can be opened beyond `pool_size`. Not
+        used by the per-thread SQLite pool.
+    pool_recycle : int
+        Recycle connections after this many seconds. -1 disables.
+    pool_pre_ping : bool
+        Test connections for liveness when they are checked out.
+    sqlite_thread_pool : bool
+        If True and `url` is a SQLite URL, reuse a single connection per
+        worker thread instead of using a queue of shared connections.
+        In-memory SQLite databases always use the per-thread pool, since
+        each connection would otherwise get its own database.
+    stats : :class:`PoolStats`
+        If given, it will be hooked up to the pool events.
+
+    Returns
+    -------
+    :class:`sqlalchemy.engine.Engine`
+    """
+    logger.debug("db.create_db_engine('%s')" % url)
+    kwargs = {
+        'echo': False,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': pool_pre_ping,
+        'pool_size': pool_size,
+    }
+
+    if url.startswith('sqlite'):
+        # Connections may be returned to the pool from a different thread
+        # than the one that opened them.
+        kwargs['connect_args'] = {'check_same_thread': False}
+        in_memory = url.rstrip('/') in ('sqlite:', 'sqlite:///:memory:')
+        if sqlite_thread_pool or in_memory:
+            kwargs['poolclass'] = SingletonThreadPool
+        else:
+            kwargs['poolclass'] = QueuePool
+            kwargs['max_overflow'] = max_overflow
+    else:
+        kwargs['max_overflow'] = max_overflow
+
+    engine = create_engine(url, **kwargs)
+
+    if stats is not None:
+        event.listen(engine, 'connect', stats.on_connect)
+        event.listen(engine, 'checkout', stats.on_checkout)
+        event.listen(engine, 'checkin', stats.on_checkin)
+
+    return engine
+
+
+def upgrade_schema(engine):
+    """
+    Add the tables, columns and indexes that are missing from an existing
+    database.
+
+    New columns are added with `ALTER TABLE ... ADD COLUMN`, so they must
+    be nullable. Nothing is ever removed or altered.
+
+    Every worker process runs this when it starts. The schema is inspected
+    and changed in one write transaction, so the workers wait for each
+    other instead of all adding the same columns.
+
+    Parameters
+    ----------
+    engine : :class:`sqlalchemy.engine.Engine`
+    """
+    logger.debug("db.upgrade_schema()")
+    with engine.begin() as connection:
+        if engine.dialect.name == 'sqlite':
+            # pysqlite only starts a transaction before DML statements.
+            connection.execute("BEGIN IMMEDIATE")
+        Base.metadata.create_all(connection)
+
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                logger.info("Adding column %s.%s" % (table.name, col.name))
+                col_type = col.type.compile(dialect=engine.dialect)
+                sql = "ALTER TABLE {} ADD COLUMN {} {}"
+                connection.execute(sql.format(table.name, col.name, col_type))
+
+            existing = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    logger.info("Creating index %s" % index.name)
+                    index.create(connection)
+
+        _backfill_sort_keys(connection)
+
+
+def checkout_connection(session, stats=None):
+    """
+    Make `session` check out its connection now, recording the wait time.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    stats : :class:`PoolStats` or None
+    """
+    start = time.perf_counter()
+    session.connection()
+    if stats is not None:
+        stats.record_wait(time.perf_counter() - start)
+
+
+class DownloadCounter(object):
+    """
+    Buffer download counts in memory and write them in batches.
+
+    Incrementing the counts in every `/download` request means a write
+    transaction per download, and SQLite only allows one writer at a time.
+    Instead, :meth:`add` only updates an in-memory tally. A background
+    thread writes the tally with one batched UPDATE per table every
+    `flush_interval` seconds, or sooner once `flush_size` downloads are
+    pending.
+
+    Call :meth:`stop` on shutdown to write out whatever is left.
+
+    Parameters
+    ----------
+    engine : :class:`sqlalchemy.engine.Engine`
+    flush_interval : float
+        Seconds between flushes. If 0, every download is written right away.
+    flush_size : int
+        Flush early once this many downloads are pending.
+    """
+
+    def __init__(self, engine, flush_interval=5.0, flush_size=100):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._lock = threading.Lock()
+        # {(package_id, version_id): count}
+        self._pending = {}
+        self._pending_total = 0
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.flushes = 0
+        self.flushed = 0
+        self.errors = 0
+
+    def add(self, package_id, version_id, count=1):
+        """Count a download of a package version."""
+        with self._lock:
+            key = (package_id, version_id)
+            self._pending[key] = self._pending.get(key, 0) + count
+            self._pending_total += count
+            pending = self._pending_total
+            write_now = not self.flush_interval or self._stopping
+            # Started lazily so that no thread exists before a forking
+            # server forks its workers.
+            if not write_now and self._thread is None:
+                self._start()
+
+        if write_now:
+            self.flush()
+        elif pending >= self.flush_size:
+            self._wake.set()
+
+    def flush(self):
+        """
+        Write the pending counts to the database.
+
+        Returns
+        -------
+        count : int
+            The number of downloads that were written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_total = 0
+        if not pending:
+            return 0
+
+        by_package = {}
+        for (package_id, _), count in pending.items():
+            by_package[package_id] = by_package.get(package_id, 0) + count
+
+        version_table = Version.__table__
+        package_table = Package.__table__
+        update_versions = (
+            version_table.update()
+            .where(version_table.c.version_id == bindparam('id_'))
+            .values(version_download_count=(
+                version_table.c.version_download_count + bindparam('count')))
+        )
+        update_packages = (
+            package_table.update()
+            .where(package_table.c.package_id == bindparam('id_'))
+            .values(download_count=(
+                package_table.c.download_count + bindparam('count')))
+        )
+
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(update_versions, [
+                    {'id_': version_id, 'count': count}
+                    for (_, version_id), count in pending.items()
+                ])
+                connection.execute(update_packages, [
+                    {'id_': package_id, 'count': count}
+                    for package_id, count in by_package.items()
+                ])
+        except Exception as err:
+            logger.error("Unable to write download counts: %s" % err)
+            # Put them back so that the next flush tries again.
+            with self._lock:
+                self.errors += 1
+                for key, count in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + count
+                    self._pending_total += count
+            return 0
+
+        total = sum(pending.values())
+        with self._lock:
+            self.flushes += 1
+            self.flushed += total
+        logger.debug("Wrote %d download counts" % total)
+        return total
+
+    def stop(self):
+        """Stop the background thread and write the remaining counts."""
+        with self._lock:
+            self._stopping = True
+            thread = self._thread
+        self._wake.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'pending': self._pending_total,
+                'flushes': self.flushes,
+                'flushed': self.flushed,
+                'errors': self.errors,
+            }
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="pynuget-download-counter",
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+# Number of rows fetched from the cursor at a time for streamed results.
+STREAM_BATCH_SIZE = 100
+
+
+def _feed_query(session):
+    """
+    Query for Version rows that are going to be rendered in a feed.
+
+    The feed needs columns from both tables, so the Package is loaded by
+    the same statement via the join instead of being lazy loaded for each
+    row as `row.package` is accessed. The same goes for the pre-rendered
+    feed entry, which is otherwise deferred.
+    """
+    return (session.query(Version)
+            .join(Package)
+            .options(contains_eager(Version.package),
+                     undefer(Version.feed_entry))
+            )
+
+
+def get_catalog_state(session):
+    """
+    Get the catalog change counter and last modified time.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+
+    Returns
+    -------
+    change_counter : int
+    last_modified : :class:`datetime.datetime` or None
+        Naive UTC datetime.
+    """
+    row = (session.query(CatalogState.change_counter,
+                         CatalogState.last_modified)
+           .filter(CatalogState.catalog_id == 1)
+           .one_or_none())
+    if row is None:
+        return 0, None
+    return row.change_counter, row.last_modified
+
+
+def _bump_catalog(session):
+    """
+    Increment the catalog change counter. Does not commit.
+
+    The increment is done in SQL so that concurrent writers can't lose
+    an update.
+    """
+    now = dt.datetime.utcnow()
+    updated = (session.query(CatalogState)
+               .filter(CatalogState.catalog_id == 1)
+               .update({CatalogState.change_counter:
+                        CatalogState.change_counter + 1,
+                        CatalogState.last_modified: now},
+                       synchronize_session=False))
+    if not updated:
+        session.add(CatalogState(catalog_id=1, change_counter=1,
+                                 last_modified=now))
 
 
 def count_packages(session):
@@ -104,23 +1020,53 @@ def count_packages(session):
 
 def search_packages(session,
                     include_prerelease=False,
-                    order_by=desc(Version.version_download_count),
+                    order_by=DOWNLOAD_COUNT_ORDER,
                     filter_=None,
-                    search_query=None):
+                    search_query=None,
+                    top=None,
+                    skip=0,
+                    after=None):
     """
     Parameters
     ----------
     session : :class:`sqlalchemy.orm.session.Session`
     include_prerelease : bool
-    order_by : :class:`sqlalchemy.sql.operators.ColumnOperators`
-    filder_ : str
-        One of ('is_absolute_latest_version', 'is_latest_version').
+    order_by : tuple of :class:`SortKey`, :data:`RELEVANCE` or :class:`sqlalchemy.sql.operators.ColumnOperators`
+        Keyset paging (`after`) is only supported for tuples of SortKey.
+    filter_ : str
+        One of the keys of :data:`LATEST_FILTERS`.
     search_query : str
+        Words to search for in the package id, title, tags, description
+        and authors. Uses the full-text search index if it exists.
+    top : int or None
+        The maximum number of results to return. If `None`, return all
+        results.
+    skip : int
+        The number of results to skip.
+    after : tuple or None
+        Only return rows that sort after these values of the `order_by`
+        columns. See :func:`sort_values`.
     """
     logger.debug("db.search_packages(...)")
-    query = session.query(Version).join(Package)
+    query = _feed_query(session)
 
-    if search_query is not None:
+    rank = None
+    if not search_query:
+        pass
+    elif _has_search_index(session.connection()):
+        match = _search_match_expression(search_query)
+        if match is not None:
+            sql = text("SELECT rowid AS version_id, rank AS rank"
+                       " FROM {} WHERE {} MATCH :match"
+                       .format(SEARCH_TABLE, SEARCH_TABLE))
+            matches = (sql.bindparams(match=match)
+                       .columns(column('version_id', Integer),
+                                column('rank', Float))
+                       .alias('matches'))
+            query = query.join(matches,
+                               matches.c.version_id == Version.version_id)
+            rank = matches.c.rank
+    else:
         search_query = "%" + search_query + "%"
         query = query.filter(
             or_(Package.name.like(search_query),
@@ -128,61 +1074,118 @@ def search_packages(session,
                 )
         )
 
+    if order_by == RELEVANCE:
+        if rank is None:
+            order_by = DOWNLOAD_COUNT_ORDER
+        else:
+            order_by = (rank, Package.name, Version.version)
+
     if not include_prerelease:
         query = query.filter(Version.is_prerelease.isnot(True))
 
-    known_filters = ('is_absolute_latest_version', 'IsLatestVersion')
     if filter_ is None:
         pass
-    elif filter_ in known_filters:
-        query = query.filter(Version.version == Package.latest_version)
+    elif filter_ in LATEST_FILTERS:
+        query = query.filter(LATEST_FILTERS[filter_] == true())
     else:
         raise ValueError("Unknown filter '{}'".format(filter_))
 
-    if order_by is not None:
+    if after is not None:
+        if not is_sort_order(order_by):
+            raise ValueError("Keyset paging requires a SortKey order.")
+        query = query.filter(_keyset_filter(order_by, after))
+
+    if is_sort_order(order_by):
+        query = query.order_by(*_order_clauses(order_by))
+    elif isinstance(order_by, tuple):
+        query = query.order_by(*order_by)
+    elif order_by is not None:
         query = query.order_by(order_by)
 
+    if top is not None:
+        query = query.limit(top)
+    if skip:
+        query = query.offset(skip)
+
     results = query.all()
     logger.debug("Found %d results." % len(results))
 
     return results
 
 
-def package_updates(session, packages_dict, include_prerelease=False):
+# The (id, version) pairs of a GetUpdates request. A temporary table, so
+# each connection has its own, and a request with thousands of packages is
+# answered with one join instead of a huge IN (...) list.
+_update_request = Table(
+    'update_request', MetaData(),
+    Column('name', String(256), primary_key=True),
+    Column('sort_key', String(128)),
+    prefixes=['TEMPORARY'],
+)
+
+
+def package_updates(session, packages, include_prerelease=False):
     """
-    I *think* this returns a list of packages that need updating...
+    Find the available updates for a list of installed packages.
 
-    Seems like the route for this fuction expects args from a url that look
-    like:
-        /updates?packageids='pkg1'|'pkg2'&versions='vers1'|'vers2'
-    where "|" might be encoded as %7C
+    For each installed package, the latest version (see
+    :attr:`Version.is_latest`) is returned if it's newer than the installed
+    one by SemVer precedence. Packages that don't exist on the server are
+    ignored.
 
     Parameters
     ----------
     session : :class:`sqlalchemy.orm.session.Session`
-    packages_dict : dict
-        Dict of {package.name, version}.
+    packages : dict or iterable of (name, version) tuples
+        The installed package names (the "id" tag in the NuSpec file) and
+        versions.
     include_prerelease : bool
+        If True, compare against the latest version including
+        pre-releases (:attr:`Version.is_absolute_latest`).
+
+    Returns
+    -------
+    results : list of :class:`Version`
+        Sorted by package name.
     """
     logger.debug("db.package_updates(...)")
-    package_versions = ["{}~~{}".format(pkg, vers)
-                        for pkg, vers
-                        in packages_dict.items()]
-
-    query = (session.query(Version)
-             .join(Package)
-             .filter(Version.version == Package.latest_version)
-             .filter(Version.package_id.in_(packages_dict.keys()))
-             .filter(~Version.thing.in_(package_versions))
+    if isinstance(packages, dict):
+        packages = packages.items()
+    rows = {name: semver.sort_key(version) for name, version in packages}
+    if not rows:
+        return []
+
+    connection = session.connection()
+    _update_request.create(connection, checkfirst=True)
+    connection.execute(_update_request.delete())
+    connection.execute(_update_request.insert(),
+                       [{'name': name, 'sort_key': key}
+                        for name, key in rows.items()])
+
+    if include_prerelease:
+        latest = Version.is_absolute_latest
+    else:
+        latest = Version.is_latest
+    query = (_feed_query(session)
+             .join(_update_request,
+                   _update_request.c.name == Package.name)
+             .filter(latest == true())
+             .filter(Version.sort_key > _update_request.c.sort_key)
+             .order_by(Package.name)
              )
+    try:
+        return query.all()
+    finally:
+        connection.execute(_update_request.delete())
 
-    return query.order_by(Version.package_id).all()
 
-
-def find_by_pkg_name(session, package_name, version=None):
+def find_by_pkg_name(session, package_name, version=None, top=None,
+                     after=None, stream=False):
     """
     Find a package by name. If version is `None`, returns all versions.
 
+    Results are sorted by :data:`PACKAGE_VERSION_ORDER`.
+
     Parameters
     ----------
     session : :class:`sqlalchemy.orm.session.Session`
@@ -191,6 +1194,13 @@ def find_by_pkg_name(session, package_name, version=None):
     version : str
         The version of the package to download. If `None`, then return all
         versions.
+    top : int or None
+        The maximum number of results to return.
+    after : tuple or None
+        (package_name, version) of the last row of the previous page.
+    stream : bool
+        If True, return an iterator that fetches the rows from the
+        database cursor in batches instead of loading them all at once.
 
     Returns
     -------
@@ -198,8 +1208,7 @@ def find_by_pkg_name(session, package_name, version=None):
     """
     logger.debug("db.find_by_pkg_name('%s', version='%s')" % (package_name,
                                                               version))
-    query = (session.query(Version)
-             .join(Package)
+    query = (_feed_query(session)
              .filter(Package.name == package_name)
              )
 
@@ -209,7 +1218,14 @@ def find_by_pkg_name(session, package_name, version=None):
 
     if version:
         query = query.filter(Version.version == version)
-    query.order_by(desc(Version.version))
+    if after is not None:
+        query = query.filter(_keyset_filter(PACKAGE_VERSION_ORDER, after))
+    query = query.order_by(*_order_clauses(PACKAGE_VERSION_ORDER))
+    if top is not None:
+        query = query.limit(top)
+
+    if stream:
+        return iter(query.yield_per(STREAM_BATCH_SIZE))
 
     results = query.all()
     logger.info("Found %d results." % len(results))
@@ -252,6 +1268,257 @@ def validate_id_and_version(session, package_name, version):
     return session.query(query.exists()).scalar()
 
 
+def find_version(session, package_id, version):
+    """
+    Get a single package version.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    package_id : int
+    version : str
+
+    Returns
+    -------
+    :class:`Version` or None
+        None if the version doesn't exist.
+    """
+    return (session.query(Version)
+            .filter(Version.package_id == package_id)
+            .filter(Version.version == version)
+            .one_or_none())
+
+
+def save_package_file(session, path, stat, package_hash, parsed):
+    """
+    Save the parsed nuspec of a package file, replacing any existing row.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    path : str
+        The package's storage key.
+    stat : :class:`storage.ObjectStat`
+    package_hash : str
+        The Base64 encoded SHA512 hash of the package file.
+    parsed : dict
+        See :func:`core.read_package_metadata`.
+
+    Returns
+    -------
+    :class:`PackageFile`
+    """
+    logger.debug("db.save_package_file(%s)" % path)
+    row = (session.query(PackageFile)
+           .filter(PackageFile.path == path)
+           .one_or_none())
+    row = _set_package_file(session, row, path, stat, package_hash, parsed)
+    session.commit()
+    return row
+
+
+def _set_package_file(session, row, path, stat, package_hash, parsed):
+    """Update (or add, if `row` is None) a PackageFile. Does not commit."""
+    if row is None:
+        row = PackageFile(path=path)
+        session.add(row)
+    row.size = stat.size
+    row.mtime = stat.modified
+    row.inode = stat.inode
+    row.package_hash = package_hash
+    row.nuspec = json.dumps(parsed, sort_keys=True, separators=(',', ':'))
+    return row
+
+
+def iter_package_versions(session):
+    """
+    Iterate over the (package name, version) pairs of all versions.
+
+    Only the two columns are loaded, in batches, so this is cheap even for
+    large databases.
+    """
+    query = (session.query(Package.name, Version.version)
+             .join(Version.package)
+             .yield_per(1000))
+    for name, version in query:
+        yield name, version
+
+
+def get_package_files(session):
+    """
+    Get all saved package files.
+
+    Returns
+    -------
+    dict of {path: :class:`PackageFile`}
+    """
+    return {row.path: row for row in session.query(PackageFile)}
+
+
+def delete_package_file(session, path):
+    """Delete the saved nuspec of a package file, if there is one."""
+    logger.debug("db.delete_package_file(%s)" % path)
+    (session.query(PackageFile)
+     .filter(PackageFile.path == path)
+     .delete(synchronize_session=False))
+    session.commit()
+
+
+def bulk_save_versions(session, items, render_entry=None):
+    """
+    Add or update many package versions in a single transaction.
+
+    Used by `pynuget rebuild`. New versions are inserted and existing ones
+    are updated from their (changed) package file. The
+    :class:`PackageFile` rows are saved as well.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    items : list of (path, stat, package_hash, parsed) tuples
+        See :func:`save_package_file`.
+    render_entry : callable or None
+        Called with each saved :class:`Version` to render its feed entry,
+        see :func:`feedwriter.render_entry_template`.
+
+    Returns
+    -------
+    versions : list of :class:`Version`
+    """
+    logger.debug("db.bulk_save_versions(%d items)" % len(items))
+    if not items:
+        return []
+
+    names = {parsed['id'] for _, _, _, parsed in items}
+    packages = {pkg.name: pkg for pkg in
+                session.query(Package).filter(Package.name.in_(names))}
+    existing = {(v.package.name, v.version): v for v in
+                _feed_query(session).filter(Package.name.in_(names))}
+    files = {row.path: row for row in
+             session.query(PackageFile)
+             .filter(PackageFile.path.in_([item[0] for item in items]))}
+
+    now = dt.datetime.utcnow()
+    versions = []
+    for path, stat, package_hash, parsed in items:
+        fields = dict(parsed['fields'])
+        fields['dependencies'] = json.dumps(fields['dependencies'])
+        name, version = parsed['id'], fields['version']
+
+        pkg = packages.get(name)
+        if pkg is None:
+            pkg = packages[name] = Package(name=name, title=parsed['title'],
+                                           latest_version=version)
+            session.add(pkg)
+
+        row = existing.get((name, version))
+        if row is None:
+            row = Version(package=pkg, created=now)
+            session.add(row)
+        for key, value in fields.items():
+            setattr(row, key, value)
+        row.package_hash = package_hash
+        row.package_hash_algorithm = 'SHA512'
+        row.package_size = stat.size
+        versions.append(row)
+
+        _set_package_file(session, files.get(path), path, stat,
+                          package_hash, parsed)
+
+    if render_entry is not None:
+        session.flush()
+        for row in versions:
+            row.feed_entry = render_entry(row)
+
+    _bump_catalog(session)
+    session.commit()
+    return versions
+
+
+def bulk_delete_versions(session, items):
+    """
+    Delete many package versions in a single transaction.
+
+    Used by `pynuget rebuild`. Packages without any remaining versions
+    are deleted too.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    items : list of (package_name, version, path) tuples
+        `path` is the storage key of the package file.
+
+    Returns
+    -------
+    count : int
+        The number of versions that were deleted.
+    """
+    logger.debug("db.bulk_delete_versions(%d items)" % len(items))
+    if not items:
+        return 0
+
+    names = {name for name, _, _ in items}
+    wanted = {(name, version) for name, version, _ in items}
+    rows = (session.query(Version).join(Package)
+            .options(contains_eager(Version.package))
+            .filter(Package.name.in_(names))
+            .all())
+
+    deleted = 0
+    remaining = set()
+    for row in rows:
+        if (row.package.name, row.version) in wanted:
+            session.delete(row)
+            deleted += 1
+        else:
+            remaining.add(row.package.name)
+
+    for pkg in {row.package for row in rows}:
+        if pkg.name not in remaining:
+            logger.info("No more versions exist. Deleting package %s" % pkg)
+            session.delete(pkg)
+
+    (session.query(PackageFile)
+     .filter(PackageFile.path.in_([path for _, _, path in items]))
+     .delete(synchronize_session=False))
+
+    _bump_catalog(session)
+    session.commit()
+    return deleted
+
+
+def count_versions_by_hash(session, package_hash):
+    """
+    Count the versions whose package file has the given hash.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    package_hash : str
+        The Base64 encoded SHA512 hash of the package file.
+
+    Returns
+    -------
+    int
+    """
+    return (session.query(func.count(Version.version_id))
+            .filter(Version.package_hash == package_hash)
+            .scalar())
+
+
+def get_package_hashes(session):
+    """
+    Get the hashes of the package files of all versions.
+
+    Returns
+    -------
+    set of str
+        Base64 encoded SHA512 hashes.
+    """
+    query = session.query(Version.package_hash).distinct()
+    return {hash_ for hash_, in query if hash_ is not None}
+
+
 def increment_download_count(session, package_name, version):
     """
     Increment the download count for a given package version.
@@ -286,6 +1553,9 @@ def insert_or_update_package(session, package_name, title, latest_version):
         The NuGet name of the package - the "id" tag in the NuSpec file.
     title : str
     latest_version : str
+        Only replaces the package's latest version if it's higher. The
+        latest version is also recomputed whenever versions are added or
+        deleted.
     """
     logger.debug("db.insert_or_update_package(...)")
     sql = session.query(Package).filter(Package.name == package_name)
@@ -295,14 +1565,30 @@ def insert_or_update_package(session, package_name, title, latest_version):
                       latest_version=latest_version)
         session.add(pkg)
     else:
-        sql.update({Package.name: package_name,
-                    Package.title: title,
-                    Package.latest_version: latest_version})
+        # Set on the instance rather than with a bulk update, so that the
+        # mapper events (eg. the search index) see the change.
+        obj.title = title
+        if (obj.latest_version is None
+                or (semver.sort_key(latest_version)
+                    > semver.sort_key(obj.latest_version))):
+            obj.latest_version = latest_version
     session.commit()
 
 
-def insert_version(session, **kwargs):
-    """Insert a new version of an existing package."""
+def insert_version(session, render_entry=None, **kwargs):
+    """
+    Insert a new version of an existing package.
+
+    Parameters
+    ----------
+    session : :class:`sqlalchemy.orm.session.Session`
+    render_entry : callable or None
+        If given, `render_entry(row)` is stored as the version's feed entry
+        in the same transaction, see
+        :func:`feedwriter.render_entry_template`.
+    kwargs :
+        The column values.
+    """
     logger.debug("db.insert_version(...)")
     kwargs['created'] = dt.datetime.utcnow()
     if 'dependencies' in kwargs:
@@ -314,8 +1600,14 @@ def insert_version(session, **kwargs):
 
     version = Version(**kwargs)
     session.add(version)
+    if render_entry is not None:
+        # The entry needs the version_id and the package.
+        session.flush()
+        version.feed_entry = render_entry(version)
+    _bump_catalog(session)
     session.commit()
     logger.debug(version)
+    return version
 
 
 def delete_version(session, package_name, version):
@@ -327,6 +1619,11 @@ def delete_version(session, package_name, version):
     package_name : str
         The NuGet name of the package - the "id" tag in the NuSpec file.
     version : str
+
+    Returns
+    -------
+    package_hash : str
+        The hash of the deleted version's package file.
     """
     msg = "db.delete_version({}, {})"
     logger.debug(msg.format(package_name, version))
@@ -336,17 +1633,18 @@ def delete_version(session, package_name, version):
            )
     version = sql.one()
     pkg = version.package
+    package_hash = version.package_hash
 
     session.delete(version)
 
-    # update the Package.latest_version value, or delete the Package
-    versions = (session.query(Version)
-                .join(Package)
-                .filter(Package.name == package_name)
-                ).all()
-    if len(versions) > 0:
-        pkg.latest_version = max(v.version for v in versions)
-    else:
+    # Package.latest_version is updated when the delete is flushed. Delete
+    # the Package if that was its last version.
+    remaining = (session.query(func.count(Version.version_id))
+                 .filter(Version.package_id == pkg.package_id)
+                 ).scalar()
+    if remaining == 0:
         logger.info("No more versions exist. Deleting package %s" % pkg)
         session.delete(pkg)
+    _bump_catalog(session)
     session.commit()
+    return package_hash
@@ -29,6 +29,83 @@ SERVER_PATH = "/var/www/pynuget"
 # Can be absolute or relative. Defaults to $SERVER_PATH\$PACAKGE_DIR
 PACKAGE_DIR = "nuget_packages"
 
+# Where package files are stored:
+#   "local": in PACKAGE_DIR.
+#   "s3": in an S3 compatible object store (requires boto3). Lets several
+#         servers share one package store.
+STORAGE_BACKEND = "local"
+# S3 settings. Credentials are read by boto3 from the usual places
+# (environment variables, ~/.aws/credentials, instance roles).
+S3_BUCKET = "pynuget"
+S3_PREFIX = "nuget_packages/"
+# For other S3 compatible stores such as MinIO, e.g. "http://minio:9000".
+S3_ENDPOINT_URL = None
+S3_REGION = None
+# Downloads are redirected to a presigned URL that is valid for this many
+# seconds. Set to 0 to send the files through the server instead.
+S3_PRESIGN_EXPIRES = 300
+
+# Store each distinct package file once, keyed by its SHA512 hash, and
+# link `<PACKAGE_DIR>/<id>/<version>.nupkg` to it. With "local" storage the
+# links are hard links, so identical packages pushed under several versions
+# only use the disk space once. Requires "local" storage. `pynuget rebuild`
+# deletes the files that no version refers to any more.
+CONTENT_ADDRESSABLE_STORE = False
+
+# The maximum number of entries returned in a single page of a feed. Clients
+# follow the feed's "next" link to get the rest.
+MAX_PAGE_SIZE = 100
+
+# How `/download` sends package files. Set this to let the web server send
+# the file (with sendfile) instead of streaming it through Python:
+#   None: Flask sends the file.
+#   "x-sendfile": Apache with mod_xsendfile. See apache-example.conf.
+#   "x-accel-redirect": nginx.
+DOWNLOAD_OFFLOAD = None
+# For "x-accel-redirect": the `internal` nginx location that serves
+# PACKAGE_DIR.
+DOWNLOAD_ACCEL_PREFIX = "/nuget_packages_internal/"
+
+# Download counts are kept in memory and written to the database in batches
+# every DOWNLOAD_COUNT_FLUSH_INTERVAL seconds, or sooner once
+# DOWNLOAD_COUNT_FLUSH_SIZE downloads are waiting. Set the interval to 0 to
+# write every download right away.
+DOWNLOAD_COUNT_FLUSH_INTERVAL = 5
+DOWNLOAD_COUNT_FLUSH_SIZE = 100
+
+# Rendered `Search()` and `FindPackagesById()` feeds are cached in memory.
+# RESPONSE_CACHE_SIZE is the number of feeds kept (0 disables the cache),
+# RESPONSE_CACHE_TTL how long (seconds) they are kept, and feeds larger than
+# RESPONSE_CACHE_MAX_ENTRY_BYTES are not cached. Pushes and deletes evict
+# the affected feeds right away; download counts in cached feeds may be up
+# to RESPONSE_CACHE_TTL seconds old.
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 60
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 1048576
+
+# Identical feed requests that arrive while the first one is still being
+# computed wait for its result instead of running the same query again.
+# FEED_SINGLE_FLIGHT_TIMEOUT is how long (seconds) they wait before giving
+# up and computing the feed themselves; 0 disables the coalescing. Feeds
+# larger than RESPONSE_CACHE_MAX_ENTRY_BYTES are not shared.
+FEED_SINGLE_FLIGHT_TIMEOUT = 30
+
+# A cache shared by all worker processes, for servers that run several of
+# them (eg. `WSGIDaemonProcess pynuget processes=4`). It is used instead of
+# the per-process response cache for the feeds, `/count` and the package
+# lookups of downloads, and pushes and deletes invalidate its entries for
+# every process. Entries expire after RESPONSE_CACHE_TTL seconds.
+#   None: no shared cache.
+#   "redis": a Redis compatible server at SHARED_CACHE_URL (requires redis).
+#            Keys start with SHARED_CACHE_PREFIX.
+#   "sqlite": an SQLite file at SHARED_CACHE_PATH, relative to SERVER_PATH.
+#             Use an absolute path on a tmpfs such as /dev/shm to keep it
+#             in memory.
+SHARED_CACHE_BACKEND = None
+SHARED_CACHE_URL = "redis://localhost:6379/0"
+SHARED_CACHE_PREFIX = "pynuget:"
+SHARED_CACHE_PATH = "shared_cache.sqlite"
+
 # The name of the Apache configuration file
 APACHE_CONFIG = "pynuget.conf"
 
@@ -40,3 +117,20 @@ API_KEYS = {
 # These are only used for non-SQLite backends like MySQL or PostgreSQL.
 DB_USER = None
 DB_PASSWORD = None
+
+# Database connection pool. The engine is created once per process when
+# the app starts, and every request borrows a connection from it.
+DB_POOL_SIZE = 5
+# Extra connections allowed when the pool is exhausted. Ignored by the
+# per-thread SQLite pool.
+DB_MAX_OVERFLOW = 10
+# Recycle connections after this many seconds. -1 disables recycling.
+DB_POOL_RECYCLE = 3600
+# Check that a connection is alive before handing it out.
+DB_POOL_PRE_PING = True
+# For SQLite: keep one connection per worker thread and reuse it for every
+# request handled by that thread, instead of sharing a queue of connections.
+# DB_POOL_SIZE must then be at least the number of threads (mod_wsgi runs 15
+# per process by default, plus the download counter's flush thread), or the
+# connections of busy threads get closed.
+DB_SQLITE_THREAD_POOL = False
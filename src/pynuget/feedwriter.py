@@ -5,6 +5,8 @@
 import datetime as dt
 import json
 import re
+from uuid import uuid4
+from xml.sax.saxutils import escape
 
 from lxml import etree as et
 
@@ -32,6 +34,15 @@ ADO_BASE_URL = "http://schemas.microsoft.com/ado/2007/08/dataservices"
 ADO_SCHEMA_URL = ADO_BASE_URL + "/scheme"
 ADO_METADATA_URL = ADO_BASE_URL + "/metadata"
 
+# Placeholders used in pre-rendered entries, see `render_entry_template`.
+# They are delimited by NUL bytes, which can't be part of XML text, so no
+# value from a nuspec can ever look like a placeholder.
+TEMPLATE_FIELD = b"\x00%s\x00"
+_TEMPLATE_FIELD_RE = re.compile(rb"\x00(\w+)\x00")
+# The placeholders of entries rendered by older versions, which are
+# rendered again from the row instead.
+_OLD_TEMPLATE_FIELD = b"{{pynuget:"
+
 
 class FeedWriter(object):
 
@@ -40,8 +51,8 @@ class FeedWriter(object):
         self.feed_name = feed_name
         self.base_url = base_url
 
-    def write(self, results):
-        self.begin_feed()
+    def write(self, results, next_link=None):
+        self.begin_feed(next_link)
         try:
             for result in results:
                 self.add_entry(result)
@@ -49,15 +60,88 @@ class FeedWriter(object):
             pass
         return et.tostring(self.feed)
 
-    def write_to_output(self, results):
+    def write_to_output(self, results, next_link=None):
         """
         results : list of dicts, I think.
+        next_link : str or None
+            URL of the next page of results. See :meth:`begin_feed`.
         """
         logger.debug("FeedWriter.write_to_output(%d)" % len(results))
         # TODO: header line
-        return self.write(results)
+        return self.write(results, next_link)
+
+    def write_stream(self, results, next_link=None):
+        """
+        Generate the feed as chunks of bytes.
+
+        Unlike :meth:`write`, the whole feed is never held in memory: the
+        feed header is sent first and then each entry is serialized as soon
+        as it's read from `results`, so `results` can be a database cursor.
+
+        Parameters
+        ----------
+        results : iterable of :class:`pynuget.db.Version`
+        next_link : str or None
+            See :meth:`begin_feed`.
+
+        Yields
+        ------
+        bytes
+        """
+        logger.debug("FeedWriter.write_stream()")
+        self.begin_feed(next_link)
+
+        # lxml's incremental writer (`etree.xmlfile`) can't write the
+        # `xml:base` attribute of <feed>, so serialize the feed header
+        # ourselves and split it at the closing tag. The entries are then
+        # sent between the two halves.
+        header = et.tostring(self.feed, xml_declaration=True,
+                             encoding='utf-8')
+        header, footer = header.rsplit(b'</feed>', 1)
+        yield header
+
+        for row in results:
+            if getattr(row, 'feed_entry', None):
+                yield self.fill_entry_template(row)
+            else:
+                yield et.tostring(self.make_entry(row))
+
+        yield b'</feed>' + footer
+
+    def fill_entry_template(self, row):
+        """
+        Create the `<entry>` for a row from its pre-rendered template.
+
+        Parameters
+        ----------
+        row : :class:`pynuget.db.Version`
+            A row with a `feed_entry` created by :func:`render_entry_template`.
 
-    def begin_feed(self):
+        Returns
+        -------
+        bytes
+            Same as `et.tostring(self.make_entry(row))`.
+        """
+        entry = row.feed_entry
+        if b"\x00" not in entry and _OLD_TEMPLATE_FIELD in entry:
+            return et.tostring(self.make_entry(row))
+        values = {name.encode(): escape(meta['value']).encode('utf-8')
+                  for name, meta in self.volatile_meta(row).items()}
+        values[b'base_url'] = escape(self.base_url,
+                                     {'"': '&quot;'}).encode('utf-8')
+        return _TEMPLATE_FIELD_RE.sub(
+            lambda m: values.get(m.group(1), m.group(0)),
+            entry,
+        )
+
+    def begin_feed(self, next_link=None):
+        """
+        Parameters
+        ----------
+        next_link : str or None
+            If given, a `<link rel="next">` element pointing to this URL is
+            added so that clients can request the next page of results.
+        """
         logger.debug("FeedWriter.begin_feed()")
         self.feed = et.fromstring(BASE)
         node = et.Element('id')
@@ -78,6 +162,13 @@ class FeedWriter(object):
             None,
             {'rel': 'self', 'title': self.feed_name, 'href': self.feed_name},
         )
+        if next_link is not None:
+            self.add_with_attributes(
+                self.feed,
+                'link',
+                None,
+                {'rel': 'next', 'href': next_link},
+            )
 
     def add_entry(self, row):
         """
@@ -87,10 +178,24 @@ class FeedWriter(object):
             SQLAlchemy result set object
         """
         logger.debug("FeedWriter.add_entry(%s)" % row)
+        self.feed.append(self.make_entry(row))
+
+    def make_entry(self, row):
+        """
+        Create the `<entry>` element for a result row.
+
+        Parameters
+        ----------
+        row :
+            SQLAlchemy result set object
+
+        Returns
+        -------
+        :class:`lxml.etree.Element`
+        """
         entry_id = 'Packages(Id="{}",Version="{}")'.format(row.package_id,
                                                            row.version)
         entry = et.Element('entry')
-        self.feed.append(entry)
         node = et.Element('id')
         node.text = self.base_url + entry_id
         entry.append(node)
@@ -140,6 +245,7 @@ class FeedWriter(object):
             {'type': 'application/zip', 'src': url},
         )
         self.add_entry_meta(entry, row)
+        return entry
 
     def add_entry_meta(self, entry, row):
         """
@@ -164,11 +270,8 @@ class FeedWriter(object):
             'Created': self.render_meta_date(row.created),
             'Dependencies': self.render_dependencies_xml(row.dependencies),
             'Description': row.description,  # TODO: htmlspecialchars
-            'DownloadCount': {'value': str(row.package.download_count), 'type': 'Edm.Int32'},
             'GalleryDetailsUrl': gallery_details_url,
             'IconUrl': row.icon_url,  #TODO: htmlspecialchars
-            'IsLatestVersion': self.render_meta_boolean(row.package.latest_version == row.version),
-            'IsAbsoluteLatestVersion': self.render_meta_boolean(row.package.latest_version == row.version),
             'IsPrerelease': self.render_meta_boolean(row.is_prerelease),
             'Language': None,
             'Published': self.render_meta_date(row.created),
@@ -182,13 +285,13 @@ class FeedWriter(object):
             'Summary': None,
             'Tags': row.tags,
             'Title': row.title,
-            'VersionDownloadCount': {'value': str(row.version_download_count), 'type': 'Edm.Int32'},
             'MinClientVersion': '',
             'LastEdited': {'value': None, 'type': 'Edm.DateTime'},
             'LicenseUrl': row.license_url,
             'LicenseNames': '',
             'LicenseReportUrl': '',
         }
+        meta.update(self.volatile_meta(row))
 
         for name, data in sorted(meta.items()):
             if isinstance(data, et._Element):
@@ -204,6 +307,19 @@ class FeedWriter(object):
 
             self.add_meta(properties, name, value, type_)
 
+    def volatile_meta(self, row):
+        """
+        The metadata values of an entry that can change after a push.
+
+        These are left as placeholders in pre-rendered entries.
+        """
+        return {
+            'DownloadCount': {'value': str(row.package.download_count), 'type': 'Edm.Int32'},
+            'IsLatestVersion': self.render_meta_boolean(bool(row.is_latest)),
+            'IsAbsoluteLatestVersion': self.render_meta_boolean(bool(row.is_absolute_latest)),
+            'VersionDownloadCount': {'value': str(row.version_download_count), 'type': 'Edm.Int32'},
+        }
+
     def render_meta_date(self, date):
         return {'value': self.format_date(date) + "Z", 'type': 'Edm.DateTime'}
 
@@ -327,6 +443,54 @@ class FeedWriter(object):
             child.set('null', 'true')
 
 
+class _TemplateFeedWriter(FeedWriter):
+    """
+    Renders entries with markers for the volatile values.
+
+    lxml only writes valid XML text, so the markers are random tokens that
+    :func:`render_entry_template` replaces with the NUL-delimited
+    placeholders once the entry is serialized.
+    """
+
+    def __init__(self):
+        self.token = uuid4().hex
+        super(_TemplateFeedWriter, self).__init__(
+            None, self.marker('base_url'))
+
+    def marker(self, name):
+        return "{}:{}:".format(self.token, name)
+
+    def volatile_meta(self, row):
+        meta = super(_TemplateFeedWriter, self).volatile_meta(row)
+        for name, data in meta.items():
+            data['value'] = self.marker(name)
+        return meta
+
+
+def render_entry_template(row):
+    """
+    Pre-render the `<entry>` for a Version.
+
+    Everything that is fixed once a version is pushed is rendered. The base
+    URL (which depends on the request) and the values in
+    :meth:`FeedWriter.volatile_meta` are left as placeholders that
+    :meth:`FeedWriter.fill_entry_template` replaces.
+
+    Parameters
+    ----------
+    row : :class:`pynuget.db.Version`
+
+    Returns
+    -------
+    bytes
+    """
+    logger.debug("render_entry_template(%s)" % row)
+    writer = _TemplateFeedWriter()
+    entry = et.tostring(writer.make_entry(row))
+    marker_re = re.compile(writer.token.encode() + rb":(\w+):")
+    return marker_re.sub(lambda m: TEMPLATE_FIELD % m.group(1), entry)
+
+
 def group_dependencies(data):
     """
     Groups each dependency into a dict of items with the same framework.
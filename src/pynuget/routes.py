@@ -1,34 +1,48 @@
 # -*- coding: utf-8 -*-
 """
 """
+import datetime as dt
+import json
 import re
+from functools import wraps
 from pathlib import Path
+from urllib.parse import quote
+from urllib.parse import urlencode
 from uuid import uuid4
 
 # Third-Party
 from flask import current_app
 from flask import g
+from flask import jsonify
 from flask import render_template
 from flask import request
 from flask import send_file
 from flask import make_response
+from flask import redirect
+from flask import stream_with_context
 from flask import Blueprint
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from flask import Response
 from sqlalchemy.orm.exc import NoResultFound
 
+from werkzeug.datastructures import ContentRange
 from werkzeug.local import LocalProxy
 
 from pynuget import db
 from pynuget import core
+from pynuget.cache import ALL_PACKAGES_TAG
+from pynuget.cache import package_tag
 from pynuget import logger
 from pynuget.feedwriter import FeedWriter
+from pynuget.feedwriter import render_entry_template
 from pynuget.core import et_to_str
 from pynuget.core import ApiException
 
 
 FEED_CONTENT_TYPE_HEADER = 'application/atom+xml; type=feed; charset=UTF-8'
 
+# Requests for more byte ranges than this get the whole package file.
+MAX_RANGES = 16
+
 
 pages = Blueprint('pages', __name__)
 
@@ -36,8 +50,8 @@ pages = Blueprint('pages', __name__)
 def get_db_session():
     session = getattr(g, 'session', None)
     if session is None:
-        # TODO: Handle MySQL/PostgreSQL backends.
-        db_name = Path(current_app.config['SERVER_PATH']) / Path(current_app.config['DB_NAME'])
+        ext = current_app.extensions['pynuget']
+        db_name = ext['db_path']
 
         # TODO: Move this check so that it gets run on server start, not
         # just when a route that uses the session is called.
@@ -47,16 +61,543 @@ def get_db_session():
             logger.critical(msg)
             raise FileNotFoundError(msg)
 
-        url = "sqlite:///{}".format(str(db_name))
-        engine = create_engine(url, echo=False)
-        Session = sessionmaker(bind=engine)
-        session = g.session = Session()
+        # The engine and its connection pool are shared by the whole
+        # process. See `app_factory.init_db`.
+        session = g.session = ext['db_session_factory']()
+        db.checkout_connection(session, ext['db_pool_stats'])
     return session
 
 
 session = LocalProxy(get_db_session)
 
 
+def _get_int_arg(name, default):
+    """Get a non-negative integer query argument or raise ApiException."""
+    value = request.args.get(name, default=default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ApiException("api_error: '{}' must be an integer".format(name))
+    if value < 0:
+        raise ApiException("api_error: '{}' must not be negative".format(name))
+    return value
+
+
+def _get_bool_arg(name, default=False):
+    """Get a boolean query argument. The name is case-insensitive."""
+    for key, value in request.args.items():
+        if key.lower() == name.lower():
+            return value.strip("'").lower() == 'true'
+    return default
+
+
+def _next_page_url(**overrides):
+    """
+    Build the URL of the next page of the current request.
+
+    The current query arguments are kept, with `overrides` replacing
+    (or adding) arguments.
+    """
+    args = request.args.copy()
+    for key, value in overrides.items():
+        if value is None:
+            args.pop(key, None)
+        else:
+            args[key] = value
+    query = urlencode(list(args.items(multi=True)), safe="$'(),")
+    return "{}?{}".format(request.base_url, query)
+
+
+def _feed_response(feed, results, next_link=None):
+    """
+    Create a streamed response for a feed.
+
+    The feed is sent entry by entry as `results` is iterated, so the client
+    starts receiving data right away and the whole document is never held
+    in memory.
+
+    Parameters
+    ----------
+    feed : :class:`FeedWriter`
+    results : iterable of :class:`db.Version`
+    next_link : str or None
+    """
+    # Keep the request context (and with it the db session) around until
+    # the generator is done.
+    body = stream_with_context(feed.write_stream(results, next_link))
+    return Response(body, content_type=FEED_CONTENT_TYPE_HEADER)
+
+
+def _get_skiptoken_arg():
+    """Parse the `$skiptoken` query argument. Returns None if not given."""
+    token = request.args.get('$skiptoken', default=None)
+    if not token:
+        return None
+    return core.parse_skiptoken(token)
+
+
+def _get_updates_args():
+    """Get the (id, version) pairs of a `GET /updates` request."""
+    ids = request.args.get('packageids', default='')
+    versions = request.args.get('versions', default='')
+    ids = [i.strip("'") for i in ids.split('|') if i.strip("'")]
+    versions = [v.strip("'") for v in versions.split('|') if v.strip("'")]
+    if len(ids) != len(versions):
+        raise ApiException("api_error: 'packageids' and 'versions' must"
+                           " have the same length")
+    include_prerelease = _get_bool_arg('includePrerelease')
+    return list(zip(ids, versions)), include_prerelease
+
+
+def _get_updates_body():
+    """Get the (id, version) pairs of a `POST /updates` request."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('packages'),
+                                                    list):
+        raise ApiException("api_error: Expected a JSON object with a"
+                           " 'packages' list")
+    try:
+        packages = [(str(p['id']), str(p['version']))
+                    for p in data['packages']]
+    except (KeyError, TypeError):
+        raise ApiException("api_error: Each package needs an 'id' and a"
+                           " 'version'")
+    return packages, bool(data.get('includePrerelease', False))
+
+
+def _page_results(results, top, order_by=None, skip=0):
+    """
+    Trim a page of results and build the link to the next page.
+
+    The paged queries are run with a limit of `top + 1` so that we know if
+    there's another page without having to count the results.
+
+    If `order_by` is a :data:`db.SortKey` order, the next link uses a
+    `$skiptoken` holding the sort values of the last row so that the next
+    page can seek directly to its first row. Otherwise `$skip` is used.
+
+    Returns
+    -------
+    results : list
+    next_link : str or None
+    """
+    if top is None or len(results) <= top:
+        return results, None
+
+    results = results[:top]
+    if db.is_sort_order(order_by):
+        token = core.format_skiptoken(db.sort_values(results[-1], order_by))
+        next_link = _next_page_url(**{'$skiptoken': token,
+                                      '$skip': None,
+                                      '$top': top})
+    else:
+        next_link = _next_page_url(**{'$skip': skip + top, '$top': top})
+    return results, next_link
+
+
+def _catalog_etag(change_counter):
+    """Build the strong ETag for a catalog change counter."""
+    return "c{}".format(change_counter)
+
+
+def _conditional_feed(func):
+    """
+    Handle conditional requests for a feed route.
+
+    The feeds only change when a package version is pushed or deleted, so
+    the ETag and Last-Modified values come from the catalog change counter.
+    Requests that match get a `304 Not Modified` without running the query
+    or writing the feed.
+
+    Download counts are not tracked by the counter. Clients may see stale
+    counts until the next push or delete.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # Read the counter *before* the feed query. If a push lands in
+        # between, the client gets the newer feed with the older ETag and
+        # will simply fetch it again next time.
+        change_counter, last_modified = db.get_catalog_state(session)
+        etag = _catalog_etag(change_counter)
+
+        not_modified = False
+        if request.method not in ('GET', 'HEAD'):
+            pass
+        elif request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        elif request.if_modified_since and last_modified is not None:
+            # HTTP dates only have one-second resolution.
+            since = request.if_modified_since.replace(tzinfo=None)
+            not_modified = last_modified.replace(microsecond=0) <= since
+
+        if not_modified:
+            resp = Response(status=304)
+        else:
+            resp = make_response(func(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+
+        resp.set_etag(etag)
+        if last_modified is not None:
+            resp.last_modified = last_modified
+        return resp
+    return wrapper
+
+
+def _cached_feed(func):
+    """
+    Serve a feed route from the response cache.
+
+    The cache key is the request's base URL, path and sorted query
+    arguments. The route must set `g.feed_cache_tags` (see
+    :mod:`pynuget.cache`) for its response to be cached. The response is
+    still streamed; the chunks are collected as they're sent and cached
+    once the whole feed was sent.
+
+    Identical requests that arrive while the feed is being sent don't run
+    the query again: they wait for the collected feed and send a copy of
+    it, see `FEED_SINGLE_FLIGHT_TIMEOUT`.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        ext = current_app.extensions['pynuget']
+        cache = ext['response_cache']
+        flight = ext['single_flight']
+        # A HEAD response has no body to cache or share.
+        if (cache is None and flight is None) or request.method == 'HEAD':
+            return func(*args, **kwargs)
+
+        key = _feed_cache_key()
+        generation = None
+        if cache is not None:
+            body = cache.get(key)
+            if body is not None:
+                return Response(body, content_type=FEED_CONTENT_TYPE_HEADER)
+            generation = cache.generation()
+
+        call = None
+        if flight is not None:
+            call, leader = flight.begin(key)
+            if not leader:
+                timeout = current_app.config['FEED_SINGLE_FLIGHT_TIMEOUT']
+                body = call.wait(timeout)
+                if body is not None:
+                    return Response(body,
+                                    content_type=FEED_CONTENT_TYPE_HEADER)
+                # The leader failed, or its feed can't be shared.
+                logger.debug("Computing %s again" % key)
+                call = None
+
+        try:
+            resp = make_response(func(*args, **kwargs))
+        except Exception:
+            if call is not None:
+                flight.finish(key, call, None)
+            raise
+
+        tags = getattr(g, 'feed_cache_tags', None)
+        if resp.status_code != 200 or tags is None:
+            if call is not None:
+                flight.finish(key, call, None)
+            return resp
+
+        max_bytes = current_app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']
+        chunks = resp.response
+        resp.response = _fill_cache(cache, key, tags, generation, max_bytes,
+                                    chunks, flight, call)
+        if hasattr(chunks, 'close'):
+            # The streamed body holds the request context until it's
+            # closed, and Werkzeug only closes `resp.response`, which
+            # can't close `chunks` if it was never started.
+            resp.call_on_close(chunks.close)
+        if call is not None:
+            # In case the body is never sent, eg. for a HEAD request.
+            resp.call_on_close(lambda: flight.finish(key, call, None))
+        return resp
+    return wrapper
+
+
+def _feed_cache_key():
+    """The cache key of a feed request."""
+    args = sorted(request.args.items(multi=True))
+    return "{} {}?{}".format(request.url_root, request.path, urlencode(args))
+
+
+def _fill_cache(cache, key, tags, generation, max_bytes, chunks,
+                flight=None, call=None):
+    """
+    Pass the chunks of a response through and cache them at the end.
+
+    If `call` is given, the collected feed is also handed to the requests
+    waiting on it, or None if it is too large or sending it failed.
+    """
+    parts = []
+    size = 0
+    body = None
+    try:
+        for chunk in chunks:
+            if parts is not None:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    parts = None
+            yield chunk
+        if parts is not None:
+            body = b''.join(parts)
+            if cache is not None:
+                cache.set(key, body, tags, generation)
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+        if call is not None:
+            flight.finish(key, call, body)
+
+
+def _cached_value(key, compute):
+    """
+    Get a value from the response cache, or compute and cache it.
+
+    Parameters
+    ----------
+    key : str
+        Must not start with a URL, those are the keys of the feeds.
+    compute : callable
+        Returns the value as bytes and its tags. If the tags are None the
+        value is not cached.
+
+    Returns
+    -------
+    bytes
+    """
+    cache = current_app.extensions['pynuget']['response_cache']
+    if cache is None:
+        return compute()[0]
+    value = cache.get(key)
+    if value is None:
+        generation = cache.generation()
+        value, tags = compute()
+        if tags is not None:
+            cache.set(key, value, tags, generation)
+    return value
+
+
+def _download_lookup(pkg_id, version):
+    """
+    Find the package and version rows of a download.
+
+    Cached, because downloads are the most frequent requests.
+
+    Returns
+    -------
+    dict
+        The package's `name` and `package_id` and the version's
+        `version_id` and `package_hash`, which are None if the version
+        doesn't exist.
+    """
+    def compute():
+        pkg = db.find_pkg_by_id(session, pkg_id)
+        version_row = db.find_version(session, pkg.package_id, version)
+        data = {'name': pkg.name, 'package_id': pkg.package_id,
+                'version_id': None, 'package_hash': None}
+        if version_row is None:
+            return json.dumps(data).encode(), None
+        data['version_id'] = version_row.version_id
+        data['package_hash'] = version_row.package_hash
+        return json.dumps(data).encode(), [package_tag(pkg.name)]
+
+    key = "download {} {}".format(pkg_id, version)
+    return json.loads(_cached_value(key, compute).decode())
+
+
+def _invalidate_feeds(package_name):
+    """Evict the cached feeds and lookups of a package that changed."""
+    ext = current_app.extensions['pynuget']
+    if ext['response_cache'] is not None:
+        ext['response_cache'].invalidate([package_tag(package_name),
+                                          ALL_PACKAGES_TAG])
+    if ext['single_flight'] is not None:
+        ext['single_flight'].forget()
+
+
+def _offload_download(key, abs_path, filename):
+    """
+    Create a response that tells the web server to send a package file.
+
+    Returns None if `DOWNLOAD_OFFLOAD` is not set, in which case the file
+    should be sent by Flask.
+
+    Parameters
+    ----------
+    key : str
+        The package's storage key, i.e. its path in the package dir.
+    abs_path : :class:`pathlib.Path`
+        Path to the package file.
+    filename : str
+        The name to download the file as.
+    """
+    offload = current_app.config['DOWNLOAD_OFFLOAD']
+    if not offload:
+        return None
+
+    # No body: the web server replaces it with the file's contents.
+    resp = Response(None, mimetype="application/zip")
+    resp.headers.set('Content-Disposition', 'attachment', filename=filename)
+
+    offload = offload.lower()
+    if offload == 'x-sendfile':
+        resp.headers['X-Sendfile'] = str(abs_path)
+    elif offload == 'x-accel-redirect':
+        prefix = current_app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/')
+        location = "{}/{}".format(prefix, quote(key))
+        resp.headers['X-Accel-Redirect'] = location
+    else:
+        msg = "Unknown DOWNLOAD_OFFLOAD '%s'. Sending the file with Flask."
+        logger.error(msg % offload)
+        return None
+    return resp
+
+
+def _requested_ranges(stat, package_hash):
+    """
+    Get the byte ranges of a package file that the client asked for.
+
+    The `Range` header is ignored if `If-Range` is given and doesn't match
+    the package's ETag (its hash) or modification time, or if it has more
+    than :data:`MAX_RANGES` ranges. Overlapping and adjacent ranges are
+    merged.
+
+    Parameters
+    ----------
+    stat : :class:`storage.ObjectStat`
+        The package file's size and modification time.
+    package_hash : str or None
+        The package's Base64 SHA512 hash, used as its ETag.
+
+    Returns
+    -------
+    ranges : list of (start, stop) tuples or None
+        None if the whole file should be sent. `stop` is exclusive. An empty
+        list means that none of the ranges can be satisfied.
+    """
+    rng = request.range
+    if rng is None or rng.units != 'bytes':
+        return None
+    if len(rng.ranges) > MAX_RANGES:
+        logger.debug("Ignoring Range with %d ranges" % len(rng.ranges))
+        return None
+
+    if_range = request.if_range
+    if if_range.etag is not None:
+        if package_hash is None or if_range.etag != package_hash:
+            return None
+    elif if_range.date is not None:
+        mtime = dt.datetime.fromtimestamp(int(stat.modified), dt.timezone.utc)
+        if mtime > if_range.date.replace(tzinfo=dt.timezone.utc):
+            return None
+
+    size = stat.size
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            # A suffix range: the last `-start` bytes.
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop))
+    return _merge_ranges(ranges)
+
+
+def _merge_ranges(ranges):
+    """Sort (start, stop) ranges and merge those that overlap or touch."""
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _read_range(storage, key, start, stop):
+    """Read a stored file from `start` to `stop` in chunks."""
+    return stream_with_context(_iter_range(storage, key, start, stop))
+
+
+def _iter_range(storage, key, start, stop):
+    with storage.get_stream(key, start, stop) as stream:
+        remaining = stop - start
+        while remaining > 0:
+            chunk = stream.read(min(core.CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _send_ranges(storage, key, stat, filename, ranges, package_hash):
+    """
+    Send parts of a package file as a `206 Partial Content` response.
+
+    A single range is sent as-is. Multiple ranges are sent as a
+    `multipart/byteranges` document.
+
+    Parameters
+    ----------
+    storage : :class:`storage.Storage`
+    key : str
+    stat : :class:`storage.ObjectStat`
+    filename : str
+    ranges : list of (start, stop) tuples
+        As returned by :func:`_requested_ranges`.
+    package_hash : str or None
+    """
+    size = stat.size
+    if not ranges:
+        resp = Response("Requested range not satisfiable", status=416)
+        resp.headers['Content-Range'] = "bytes */{}".format(size)
+        return resp
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        resp = Response(_read_range(storage, key, start, stop), status=206,
+                        mimetype="application/zip")
+        resp.content_length = stop - start
+        resp.content_range = ContentRange('bytes', start, stop, size)
+    else:
+        boundary = uuid4().hex
+        parts = []
+        length = 0
+        for start, stop in ranges:
+            head = ("\r\n--{}\r\n"
+                    "Content-Type: application/zip\r\n"
+                    "Content-Range: bytes {}-{}/{}\r\n"
+                    "\r\n").format(boundary, start, stop - 1, size)
+            head = head.encode('ascii')
+            parts.append((head, start, stop))
+            length += len(head) + stop - start
+        tail = "\r\n--{}--\r\n".format(boundary).encode('ascii')
+        length += len(tail)
+
+        def generate():
+            for head, start, stop in parts:
+                yield head
+                yield from _iter_range(storage, key, start, stop)
+            yield tail
+
+        content_type = "multipart/byteranges; boundary={}".format(boundary)
+        resp = Response(stream_with_context(generate()), status=206,
+                        content_type=content_type)
+        resp.content_length = length
+
+    resp.headers.set('Content-Disposition', 'attachment', filename=filename)
+    resp.accept_ranges = 'bytes'
+    if package_hash:
+        resp.set_etag(package_hash)
+    return resp
+
+
 @pages.route('/$metadata')
 def meta():
     """
@@ -111,8 +652,13 @@ def push():
         return "error: File not uploaded", 409
     file = request.files['package']
 
-    # Save the file to a temporary location
-    file = core.save_file(file, "_temp", str(uuid4()))
+    # The upload was hashed while it was written to a temporary file. See
+    # `core.UploadRequest`.
+    try:
+        file, hash_, filesize = core.save_upload(file)
+    except Exception as err:
+        logger.error("Exception: %s" % err)
+        return "api_error: Unable to save file", 500
 
     # Open the zip file that was sent and extract out the .nuspec file."
     try:
@@ -145,19 +691,21 @@ def push():
         logger.error("Package %s version %s already exists" % (pkg_name, version))
         return "api_error: Package version already exists", 409
 
-    # Hash the uploaded file and encode the hash in Base64. For some reason.
+    key = core.get_package_path(pkg_name, version).as_posix()
     try:
-        # rename our file.
-        # Check if the package's directory already exists. Create if needed.
-        new = file.parent.parent / pkg_name / (version + ".nupkg")
-        core.create_parent_dirs(new)
-        logger.debug("Renaming %s to %s" % (str(file), new))
-        file.rename(new)
-        hash_, filesize = core.hash_and_encode_file(str(new))
+        # Move our file into place. See `core.store_package`.
+        core.store_package(file, core.get_package_path(pkg_name, version),
+                           hash_)
     except Exception as err:
         logger.error("Exception: %s" % err)
         return "api_error: Unable to save file", 500
 
+    # Make sure the file can be found before the version is registered.
+    stat = core.get_storage().stat(key)
+    if stat is None:
+        logger.error("Package file %s is missing after saving it" % key)
+        return "api_error: Unable to save file", 500
+
     try:
         dependencies = core.determine_dependencies(metadata, ns)
     except Exception as err:
@@ -169,9 +717,11 @@ def push():
     # and finaly, update our database.
     logger.debug("Updating database entries.")
 
+    title = et_to_str(metadata.find('nuspec:title', ns))
+    fields = core.version_fields(metadata, ns, version, dependencies)
     db.insert_or_update_package(session,
                                 package_name=pkg_name,
-                                title=et_to_str(metadata.find('nuspec:title', ns)),
+                                title=title,
                                 latest_version=version)
     pkg_id = (session.query(db.Package)
               .filter(db.Package.name == pkg_name).one()
@@ -179,26 +729,22 @@ def push():
     logger.debug("package_id = %d" % pkg_id)
     db.insert_version(
         session,
-        authors=et_to_str(metadata.find('nuspec:authors', ns)),
-        copyright_=et_to_str(metadata.find('nuspec:copyright', ns)),
-        dependencies=dependencies,
-        description=et_to_str(metadata.find('nuspec:description', ns)),
         package_hash=hash_,
         package_hash_algorithm='SHA512',
         package_size=filesize,
-        icon_url=et_to_str(metadata.find('nuspec:iconUrl', ns)),
-        is_prerelease='-' in version,
-        license_url=et_to_str(metadata.find('nuspec:licenseUrl', ns)),
-        owners=et_to_str(metadata.find('nuspec:owners', ns)),
         package_id=pkg_id,
-        project_url=et_to_str(metadata.find('nuspec:projectUrl', ns)),
-        release_notes=et_to_str(metadata.find('nuspec:releaseNotes', ns)),
-        require_license_acceptance=et_to_str(metadata.find('nuspec:requireLicenseAcceptance', ns)) == 'true',
-        tags=et_to_str(metadata.find('nuspec:tags', ns)),
-        title=et_to_str(metadata.find('nuspec:id', ns)),
-        version=version,
+        # A version's metadata never changes, so render its feed entry now
+        # rather than every time it's part of a feed.
+        render_entry=render_entry_template,
+        **fields
     )
 
+    # Keep the parsed nuspec so that bulk operations don't have to open
+    # the package file again. See `db.PackageFile`.
+    db.save_package_file(session, key, stat, hash_,
+                         {'id': pkg_name, 'title': title, 'fields': fields})
+    _invalidate_feeds(pkg_name)
+
     logger.info("Sucessfully updated database entries for package %s version %s." % (pkg_name, version))
 
     resp = make_response('', 201)
@@ -211,11 +757,36 @@ def count():
     Not sure which nuget command uses this...
     """
     logger.debug("Route: /count")
-    resp = make_response(str(db.count_packages(session)))
+    def compute():
+        return str(db.count_packages(session)).encode(), [ALL_PACKAGES_TAG]
+
+    resp = make_response(_cached_value("count", compute))
     resp.headers['Content-Type'] = 'text/plain; charset=utf-8'
     return resp
 
 
+@pages.route('/stats', methods=['GET'])
+def stats():
+    """
+    Server statistics, used for sizing things like the connection pool.
+
+    Requires an API key, like pushing and deleting.
+    """
+    logger.debug("Route: /stats")
+    if not core.require_auth(request.headers):
+        return "api_error: Missing or Invalid API key", 401
+    ext = current_app.extensions['pynuget']
+    data = {
+        'db_pool': ext['db_pool_stats'].as_dict(),
+        'download_counter': ext['download_counter'].as_dict(),
+    }
+    if ext['response_cache'] is not None:
+        data['response_cache'] = ext['response_cache'].as_dict()
+    if ext['single_flight'] is not None:
+        data['single_flight'] = ext['single_flight'].as_dict()
+    return jsonify(data)
+
+
 @pages.route('/delete', methods=['DELETE'])
 @pages.route('/<package>/<version>', methods=['DELETE'])
 @pages.route('/api/v2/package/<package>/<version>', methods=['DELETE'])
@@ -234,17 +805,22 @@ def delete(package=None, version=None):
 
     if version is None:
         version = request.args.get('version')
-    path = core.get_package_path(pkg_name, version)
-    path = Path(current_app.config['SERVER_PATH']) / current_app.config['PACKAGE_DIR'] / path
-
-    if path.exists():
-        path.unlink()
+    key = core.get_package_path(pkg_name, version).as_posix()
+    core.get_storage().delete(key)
+    db.delete_package_file(session, key)
 
     try:
-        db.delete_version(session, pkg_name, version)
+        package_hash = db.delete_version(session, pkg_name, version)
     except NoResultFound:
         msg = "Version '{}' of Package '{}' was not found."
         return msg.format(pkg_name, version), 404
+    _invalidate_feeds(pkg_name)
+
+    # Other versions may share the same content-addressed file.
+    if (current_app.config['CONTENT_ADDRESSABLE_STORE']
+            and package_hash is not None
+            and not db.count_versions_by_hash(session, package_hash)):
+        core.remove_blob(package_hash)
 
     logger.info("Sucessfully deleted package %s version %s." % (pkg_name, version))
 
@@ -263,24 +839,64 @@ def download(pkg_id=None, version=None):
     if version is None:
         version = request.args.get('Version')
 
-    pkg_name = db.find_pkg_by_id(session, pkg_id).name
-
-    path = core.get_package_path(pkg_name, version)
-
-    # Make sure we're trying to download from our package direcory
-    path = Path(current_app.config['SERVER_PATH']) / current_app.config['PACKAGE_DIR'] / path
-    abs_path = Path.cwd() / path
-
-    logger.debug("Path to package: %s" % abs_path)
-    db.increment_download_count(session, pkg_name, version)
+    lookup = _download_lookup(pkg_id, version)
+    pkg_name = lookup['name']
+
+    key = core.get_package_path(pkg_name, version).as_posix()
+    storage = core.get_storage()
+    stat = storage.stat(key)
+    if stat is None:
+        logger.error("Package file %s is missing" % key)
+        return "api_error: Package file not found", 404
+
+    package_hash = lookup['package_hash']
+    ranges = _requested_ranges(stat, package_hash)
+
+    # Resuming a download (a range that doesn't start at the first byte)
+    # isn't another download. Counted in memory and written in batches,
+    # see `db.DownloadCounter`.
+    resumed = ranges is not None and all(start > 0 for start, _ in ranges)
+    if lookup['version_id'] is not None and not resumed:
+        ext = current_app.extensions['pynuget']
+        ext['download_counter'].add(lookup['package_id'],
+                                    lookup['version_id'])
     filename = "{}.{}.nupkg".format(pkg_name, version)
     logger.debug("File name: %s" % filename)
 
-    logger.debug("sending file")
-    result = send_file(str(abs_path),
-                       mimetype="application/zip",
-                       as_attachment=True,
-                       attachment_filename=filename)
+    # Let the client fetch the file from the storage directly.
+    url = storage.url(key, filename)
+    if url is not None:
+        logger.debug("Redirecting download to %s" % url)
+        return redirect(url)
+
+    local_path = storage.local_path(key)
+    if local_path is not None:
+        logger.debug("Path to package: %s" % local_path)
+        result = _offload_download(key, Path.cwd() / local_path, filename)
+        if result is not None:
+            logger.debug("Offloading download: %s" % dict(result.headers))
+            return result, 200
+
+    if ranges is not None:
+        return _send_ranges(storage, key, stat, filename, ranges,
+                            package_hash)
+
+    if local_path is not None:
+        logger.debug("sending file")
+        result = send_file(str(Path.cwd() / local_path),
+                           mimetype="application/zip",
+                           as_attachment=True,
+                           attachment_filename=filename,
+                           conditional=False)
+    else:
+        result = Response(_read_range(storage, key, 0, stat.size),
+                          mimetype="application/zip")
+        result.content_length = stat.size
+        result.headers.set('Content-Disposition', 'attachment',
+                           filename=filename)
+    result.accept_ranges = 'bytes'
+    if package_hash:
+        result.set_etag(package_hash)
 
     header_str = str(result.headers).replace("\r\n", "\r\n  ").strip()
     logger.debug("Header: \n  {}".format(header_str))
@@ -289,6 +905,8 @@ def download(pkg_id=None, version=None):
 
 @pages.route('/FindPackagesById()', methods=['GET'])
 @pages.route('/Packages(<func_args>)', methods=['GET'])
+@_conditional_feed
+@_cached_feed
 def find_by_id(func_args=None):
     """
     Used by `nuget install`.
@@ -332,12 +950,29 @@ def find_by_id(func_args=None):
 
     # Some terms are quoted
     pkg_name = pkg_name.strip("'")
+    g.feed_cache_tags = [package_tag(pkg_name)]
 
-    results = db.find_by_pkg_name(session, pkg_name, version)
-    logger.debug(results)
+    # Only page the results if the client asks for it.
+    try:
+        top = _get_int_arg('$top', None) if '$top' in request.args else None
+        after = _get_skiptoken_arg()
+    except ApiException as err:
+        return str(err), 400
+    if top is not None:
+        top = min(top, current_app.config['MAX_PAGE_SIZE'])
+
+    # Without a page size, rows are streamed from the database cursor
+    # straight into the response.
+    try:
+        results = db.find_by_pkg_name(session, pkg_name, version,
+                                      top=None if top is None else top + 1,
+                                      after=after,
+                                      stream=top is None)
+    except ValueError as err:
+        return "api_error: {}".format(err), 400
+    results, next_link = _page_results(results, top, db.PACKAGE_VERSION_ORDER)
     feed = FeedWriter('FindPackagesById', request.url_root)
-    resp = make_response(feed.write_to_output(results))
-    resp.headers['Content-Type']
+    resp = _feed_response(feed, results, next_link)
 
     # This will spam logs!
     #logger.debug(resp.data.decode('utf-8').replace('><',' >\n<'))
@@ -346,6 +981,8 @@ def find_by_id(func_args=None):
 
 
 @pages.route('/Search()', methods=['GET'])
+@_conditional_feed
+@_cached_feed
 def search():
     """
     Used by `nuget list`.
@@ -353,11 +990,17 @@ def search():
     logger.debug("Route: /search")
     logger.debug(request.args)
     # TODO: Cleanup this and db.search_pacakges call sig.
-    include_prerelease = request.args.get('includePrerelease', default=False)
-    order_by = request.args.get('$orderBy', default='Id')
+    include_prerelease = _get_bool_arg('includePrerelease')
+    # The NuGet clients aren't consistent about the case of this one.
+    order_by = request.args.get('$orderby',
+                                default=request.args.get('$orderBy', None))
     filter_ = request.args.get('$filter', default=None)
-    top = request.args.get('$top', default=30)
-    skip = request.args.get('$skip', default=0)
+    try:
+        top = min(_get_int_arg('$top', 30), current_app.config['MAX_PAGE_SIZE'])
+        skip = _get_int_arg('$skip', 0)
+        after = _get_skiptoken_arg()
+    except ApiException as err:
+        return str(err), 400
     sem_ver_level = request.args.get('semVerLevel', default='2.0.0')
     search_query = request.args.get('searchTerm', default=None)
     target_framework = request.args.get('targetFramework', default='')
@@ -366,17 +1009,35 @@ def search():
     search_query = search_query.strip("'")
     target_framework = target_framework.strip("'")
 
-    results = db.search_packages(session,
-                                 include_prerelease=include_prerelease,
-                                 #order_by=order_by,
-                                 filter_=filter_,
-                                 search_query=search_query,
-                                 )
-
+    if order_by:
+        sort_order = db.parse_odata_order(order_by)
+        if sort_order is None:
+            msg = "Unsupported $orderby '%s'. Using the default order."
+            logger.warning(msg % order_by)
+            sort_order = db.DOWNLOAD_COUNT_ORDER
+    elif search_query:
+        sort_order = db.RELEVANCE
+    else:
+        sort_order = db.DOWNLOAD_COUNT_ORDER
+    try:
+        results = db.search_packages(session,
+                                     include_prerelease=include_prerelease,
+                                     order_by=sort_order,
+                                     filter_=filter_,
+                                     search_query=search_query,
+                                     top=top + 1,
+                                     skip=skip,
+                                     after=after,
+                                     )
+    except ValueError as err:
+        return "api_error: {}".format(err), 400
+
+    results, next_link = _page_results(results, top, sort_order, skip)
+
+    # Any push or delete can change the search results.
+    g.feed_cache_tags = [ALL_PACKAGES_TAG]
     feed = FeedWriter('Search', request.url_root)
-    resp = make_response(feed.write_to_output(results))
-    logger.debug("Finished FeedWriter.write_to_output")
-    resp.headers['Content-Type'] = FEED_CONTENT_TYPE_HEADER
+    resp = _feed_response(feed, results, next_link)
 
     # Keep this line for future debugging. Will fill up the logs *very*
     # quickly if there are a lot of packages on the server.
@@ -385,21 +1046,36 @@ def search():
     return resp
 
 
-@pages.route('/updates', methods=['GET'])
+@pages.route('/updates', methods=['GET', 'POST'])
+@_conditional_feed
 def updates():
     """
-    I thought this was `nuget restore` but that looks to be
-    `GET http://localhost:5000/Packages(Id='xunit',Version='2.3.1')`
+    Find updates for a list of installed packages (NuGet `GetUpdates()`).
+
+    `GET` takes the packages in the query string::
+
+        /updates?packageids='pkg1'|'pkg2'&versions='vers1'|'vers2'
+
+    where "|" might be encoded as %7C. That gets too long for the web
+    server with a few hundred packages, so `POST` takes a JSON body
+    instead::
+
+        {"packages": [{"id": "pkg1", "version": "vers1"}, ...],
+         "includePrerelease": false}
+
+    Either way, the updates are found with a single query, see
+    :func:`db.package_updates`.
     """
     logger.debug("Route: /updates")
-    ids = request.args.get('packageids').strip("'").split('|')
-    versions = request.args.get('versions').strip("'").split('|')
-    include_prerelease = request.args.get('includeprerelease', default=False)
-    pkg_to_vers = {k: v for k, v in zip(ids, versions)}
+    try:
+        if request.method == 'POST':
+            packages, include_prerelease = _get_updates_body()
+        else:
+            packages, include_prerelease = _get_updates_args()
+    except ApiException as err:
+        return str(err), 400
 
-    results = db.package_updates(session, pkg_to_vers, include_prerelease)
+    results = db.package_updates(session, packages, include_prerelease)
 
     feed = FeedWriter('GetUpdates', request.url_root)
-    resp = make_response(feed.write_to_output(results))
-    resp.headers['Content-Type'] = FEED_CONTENT_TYPE_HEADER
-    return resp
+    return _feed_response(feed, results)
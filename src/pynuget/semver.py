@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+SemVer 2.0 version parsing and ordering.
+
+NuGet versions are SemVer 2.0 versions that may have only one or two
+numbers, or a fourth (revision) number, eg: "1.0", "1.2.3.4-beta.2+abc".
+Comparisons are case-insensitive and build metadata is ignored.
+"""
+import re
+from collections import namedtuple
+
+
+_VERSION_RE = re.compile(
+    r'^(?P<major>\d+)'
+    r'(?:\.(?P<minor>\d+))?'
+    r'(?:\.(?P<patch>\d+))?'
+    r'(?:\.(?P<revision>\d+))?'
+    r'(?:-(?P<prerelease>[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?'
+    r'(?:\+(?P<metadata>[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?$'
+)
+
+SemVer = namedtuple('SemVer', ['major', 'minor', 'patch', 'revision',
+                               'prerelease', 'metadata'])
+SemVer.__doc__ = """
+A parsed version. The numbers are ints, `prerelease` is a tuple of the
+dot-separated identifiers (empty for a release) and `metadata` is a str or
+None.
+"""
+
+# The sort key of a release sorts after that of any pre-release with the
+# same numbers, and versions that can't be parsed sort before all others.
+_RELEASE = "~"
+_PRERELEASE = "-"
+_INVALID = "!"
+# Joins pre-release identifiers. Sorts before every identifier character,
+# so "alpha" < "alpha.1" < "alpha-1" as SemVer requires.
+_SEPARATOR = "!"
+
+
+def parse_version(version):
+    """
+    Parse a NuGet version string.
+
+    Parameters
+    ----------
+    version : str
+
+    Returns
+    -------
+    :class:`SemVer`
+
+    Raises
+    ------
+    ValueError
+        If `version` is not a valid version.
+    """
+    match = _VERSION_RE.match(version.strip())
+    if match is None:
+        raise ValueError("Invalid version '{}'".format(version))
+    numbers = [int(match.group(name) or 0)
+               for name in ('major', 'minor', 'patch', 'revision')]
+    prerelease = match.group('prerelease')
+    prerelease = tuple(prerelease.split('.')) if prerelease else ()
+    return SemVer(*numbers, prerelease=prerelease,
+                  metadata=match.group('metadata'))
+
+
+def sort_key(version):
+    """
+    Get a string that sorts like the version does.
+
+    Comparing the sort keys of two versions as plain strings (for example
+    in an SQL ORDER BY) gives the same result as comparing the versions by
+    SemVer 2.0 precedence, so "1.10.0" sorts after "1.9.0" and "1.0.0"
+    after "1.0.0-rc.1". Versions that are equal by precedence, like "1.0"
+    and "1.0.0+build", have the same key.
+
+    Parameters
+    ----------
+    version : str
+
+    Returns
+    -------
+    str
+    """
+    try:
+        parsed = parse_version(version)
+    except ValueError:
+        return _INVALID + version.lower()
+
+    key = "".join(_encode_number(n) for n in parsed[:4])
+    if not parsed.prerelease:
+        return key + _RELEASE
+    identifiers = [_encode_identifier(i) for i in parsed.prerelease]
+    return key + _PRERELEASE + _SEPARATOR.join(identifiers)
+
+
+def is_prerelease(version):
+    """Return True if `version` is a pre-release version."""
+    try:
+        return bool(parse_version(version).prerelease)
+    except ValueError:
+        return '-' in version
+
+
+def _encode_number(number):
+    """Prefix a number with its length so that it sorts numerically."""
+    digits = str(int(number))
+    return "{:02d}{}".format(len(digits), digits)
+
+
+def _encode_identifier(identifier):
+    """Encode a pre-release identifier. Numeric ones sort first."""
+    if identifier.isdigit():
+        return "0" + _encode_number(identifier)
+    return "1" + identifier.lower()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+A cache shared by all worker processes.
+
+mod_wsgi (see `apache-example.conf`) can run the server in several
+processes, and the in-process :class:`pynuget.cache.ResponseCache` of one
+process is invisible to the others, as are its invalidations. A
+:class:`SharedResponseCache` keeps the entries in a store that all
+processes use: a Redis compatible server or an SQLite file.
+
+Invalidation uses tag versions. Each tag has a counter in the store, and
+an entry is saved with the versions of its tags at the time. Invalidating
+a tag increments its counter, which makes every entry saved with an older
+version stale for every process at once. Stale entries are never removed
+explicitly; they are ignored and expire.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pynuget import logger
+from pynuget.core import PyNuGetException
+
+
+# Incremented by every invalidation, see `SharedResponseCache.generation`.
+_GENERATION_KEY = "generation"
+# The generation when the store can't be read. Counters are never negative,
+# so values computed after getting it are never cached.
+_UNKNOWN_GENERATION = -1
+# Expired SQLite entries are deleted every this many writes.
+_PURGE_INTERVAL = 256
+
+
+class CacheError(PyNuGetException):
+    pass
+
+
+class CacheBackend(object):
+    """
+    Interface for the store of a :class:`SharedResponseCache`.
+
+    Subclasses must implement all methods. Values are bytes and counters
+    are ints that start at 0.
+    """
+
+    def get(self, key):
+        """Return the value of `key`, or None if it's missing or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """Store `value` under `key` for `ttl` seconds."""
+        raise NotImplementedError
+
+    def get_counters(self, keys):
+        """Return the values of several counters, read at the same time."""
+        raise NotImplementedError
+
+    def incr(self, key):
+        """Add 1 to a counter."""
+        raise NotImplementedError
+
+
+class RedisBackend(CacheBackend):
+    """
+    Store the cache in a Redis compatible server.
+
+    Requires `redis`, unless a client is given.
+
+    Parameters
+    ----------
+    url : str
+        For example "redis://localhost:6379/0".
+    prefix : str
+        Prepended to every key, so several servers can share a database.
+    client : Redis client or None
+        Defaults to `redis.Redis.from_url(url)`.
+    """
+
+    def __init__(self, url=None, prefix="", client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                msg = "The redis shared cache backend requires redis."
+                raise CacheError(msg)
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000))
+
+    def get_counters(self, keys):
+        if not keys:
+            return []
+        values = self.client.mget([self.prefix + key for key in keys])
+        return [int(value or 0) for value in values]
+
+    def incr(self, key):
+        self.client.incr(self.prefix + key)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Store the cache in an SQLite file.
+
+    For servers without Redis. Put the file on a tmpfs, such as `/dev/shm`,
+    to keep it in memory. Each thread of each process uses its own
+    connection.
+
+    Parameters
+    ----------
+    path : str
+    timeout : float
+        Seconds to wait for another process's write to finish.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entry ("
+                         " key TEXT PRIMARY KEY,"
+                         " value BLOB NOT NULL,"
+                         " expires REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_counter ("
+                         " key TEXT PRIMARY KEY,"
+                         " value INTEGER NOT NULL)")
+
+    def _connect(self):
+        """Get this thread's connection. Forked processes reconnect."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM cache_entry WHERE key = ? AND expires > ?",
+            (key, time.time()),
+        ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def set(self, key, value, ttl):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO cache_entry VALUES (?, ?, ?)",
+                     (key, value, now + ttl))
+        self._writes += 1
+        if self._writes % _PURGE_INTERVAL == 0:
+            conn.execute("DELETE FROM cache_entry WHERE expires <= ?",
+                         (now, ))
+
+    def get_counters(self, keys):
+        params = ",".join("?" * len(keys))
+        rows = self._connect().execute(
+            "SELECT key, value FROM cache_counter"
+            " WHERE key IN ({})".format(params),
+            list(keys),
+        )
+        values = dict(rows)
+        return [values.get(key, 0) for key in keys]
+
+    def incr(self, key):
+        # Not an upsert (`ON CONFLICT ... DO UPDATE`), which needs SQLite
+        # 3.24 or newer.
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO cache_counter VALUES (?, 0)",
+                         (key, ))
+            conn.execute("UPDATE cache_counter SET value = value + 1"
+                         " WHERE key = ?", (key, ))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class SharedResponseCache(object):
+    """
+    A cache of bytes values that all worker processes share.
+
+    Has the interface of :class:`pynuget.cache.ResponseCache` and is used
+    in its place. Errors of the store are logged and treated as cache
+    misses, so the server keeps working, uncached, if the store is down.
+
+    Parameters
+    ----------
+    backend : :class:`CacheBackend`
+    ttl : float
+        Seconds until an entry expires.
+    """
+
+    def __init__(self, backend, ttl=60.0):
+        self.backend = backend
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    def _call(self, method, *args, default=None):
+        """Call a backend method. Returns `default` if it fails."""
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception as err:
+            self.errors += 1
+            logger.warning("Shared cache %s failed: %s" % (method, err))
+            return default
+
+    def generation(self):
+        """Get a token that changes whenever entries are invalidated."""
+        return self._call('get_counters', [_GENERATION_KEY],
+                          default=[_UNKNOWN_GENERATION])[0]
+
+    def get(self, key):
+        """Return the cached value for `key`, or None."""
+        raw = self._call('get', "entry:" + key)
+        if raw is not None:
+            header, _, value = raw.partition(b"\n")
+            try:
+                versions = json.loads(header.decode('utf-8'))
+            except ValueError as err:
+                versions = None
+                logger.warning("Invalid shared cache entry %s: %s"
+                               % (key, err))
+            if not isinstance(versions, dict):
+                self.errors += 1
+                self.misses += 1
+                return None
+            tags = sorted(versions)
+            current = self._call('get_counters', [_tag_key(t) for t in tags])
+            if current == [versions[tag] for tag in tags]:
+                self.hits += 1
+                return value
+            self.stale += 1
+        self.misses += 1
+        return None
+
+    def set(self, key, value, tags=(), generation=None):
+        """
+        Cache a value.
+
+        Parameters
+        ----------
+        key : str
+        value : bytes
+        tags : iterable of str
+        generation : int or None
+            The value of :meth:`generation` from before `value` was
+            computed. If entries were invalidated since, in any process,
+            `value` is not cached.
+
+        Returns
+        -------
+        bool
+            True if the value was cached.
+        """
+        tags = sorted(set(tags))
+        # Read in one go: an invalidation increments the generation before
+        # the tags, so if the generation is unchanged the tag versions
+        # don't include any invalidation made after `value` was computed.
+        keys = [_GENERATION_KEY] + [_tag_key(tag) for tag in tags]
+        counters = self._call('get_counters', keys)
+        if counters is None:
+            return False
+        if generation is not None and generation != counters[0]:
+            logger.debug("Not caching %s: invalidated meanwhile" % key)
+            return False
+        header = json.dumps(dict(zip(tags, counters[1:])))
+        raw = header.encode('utf-8') + b"\n" + value
+        return self._call('set', "entry:" + key, raw, self.ttl,
+                          default=False) is not False
+
+    def invalidate(self, tags):
+        """Make all entries that have any of `tags` stale, in all processes."""
+        self._call('incr', _GENERATION_KEY)
+        for tag in tags:
+            self._call('incr', _tag_key(tag))
+        self.invalidations += 1
+        logger.debug("Invalidated shared cache entries for %s"
+                     % sorted(tags))
+
+    def as_dict(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'invalidations': self.invalidations,
+            'errors': self.errors,
+        }
+
+
+def _tag_key(tag):
+    return "tag:" + tag
+
+
+def create_backend(config):
+    """
+    Create the store selected by the `SHARED_CACHE_BACKEND` setting.
+
+    Parameters
+    ----------
+    config : :class:`flask.Config` or dict
+
+    Returns
+    -------
+    :class:`CacheBackend` or None
+        None if no shared cache is configured.
+    """
+    backend = config['SHARED_CACHE_BACKEND']
+    logger.debug("shared_cache.create_backend(%s)" % backend)
+    if not backend:
+        return None
+    elif backend == 'redis':
+        return RedisBackend(config['SHARED_CACHE_URL'],
+                            prefix=config['SHARED_CACHE_PREFIX'])
+    elif backend == 'sqlite':
+        path = os.path.join(config['SERVER_PATH'],
+                            config['SHARED_CACHE_PATH'])
+        return SQLiteBackend(path)
+    else:
+        msg = "Unknown SHARED_CACHE_BACKEND: {}".format(backend)
+        raise CacheError(msg)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Package file storage backends.
+
+Package files are addressed by a key: a relative, `/` separated path such
+as `NuGetTest/0.0.1.nupkg` (see :func:`core.get_package_path`).
+"""
+import os
+import shutil
+from collections import namedtuple
+from pathlib import Path
+
+from flask import current_app
+
+from pynuget import logger
+from pynuget.core import CHUNK_SIZE
+from pynuget.core import PyNuGetException
+
+
+#: The size (bytes), modification time (POSIX timestamp) and, for local
+#: files, the inode number of a file.
+ObjectStat = namedtuple('ObjectStat', ['size', 'modified', 'inode'])
+ObjectStat.__new__.__defaults__ = (None, )
+
+
+class StorageError(PyNuGetException):
+    pass
+
+
+class Storage(object):
+    """
+    Interface for storing package files.
+
+    Subclasses must implement :meth:`put_stream`, :meth:`get_stream`,
+    :meth:`stat` and :meth:`delete`.
+    """
+
+    def put_stream(self, key, stream):
+        """
+        Store the contents of a readable binary stream under `key`.
+
+        Any existing file with the same key is replaced.
+        """
+        raise NotImplementedError
+
+    def put_file(self, key, path):
+        """
+        Store a local file under `key`. The local file is removed.
+
+        Parameters
+        ----------
+        key : str
+        path : :class:`pathlib.Path`
+        """
+        with open(str(path), 'rb') as openf:
+            self.put_stream(key, openf)
+        path.unlink()
+
+    def get_stream(self, key, start=0, stop=None):
+        """
+        Open a stored file for reading.
+
+        Parameters
+        ----------
+        key : str
+        start : int
+            The first byte to read.
+        stop : int or None
+            Stop reading before this byte. None reads to the end.
+
+        Returns
+        -------
+        A readable binary file-like object. The caller must close it, and
+        must not read more than `stop - start` bytes from it.
+        """
+        raise NotImplementedError
+
+    def stat(self, key):
+        """Return an :class:`ObjectStat`, or None if `key` doesn't exist."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete a stored file. Does nothing if `key` doesn't exist."""
+        raise NotImplementedError
+
+    def link(self, src_key, dst_key):
+        """
+        Make `dst_key` have the same contents as `src_key`.
+
+        Backends that can share the data between the keys should do so.
+        The default copies it.
+        """
+        with self.get_stream(src_key) as stream:
+            self.put_stream(dst_key, stream)
+
+    def url(self, key, filename=None):
+        """
+        Get a URL that clients can download `key` from directly.
+
+        Returns None if the backend doesn't support it, in which case the
+        file is sent by the server.
+        """
+        return None
+
+    def local_path(self, key):
+        """
+        Get the path of a stored file on the local filesystem.
+
+        Returns None if the backend doesn't store files locally.
+        """
+        return None
+
+
+class LocalStorage(Storage):
+    """
+    Store package files in a directory.
+
+    Parameters
+    ----------
+    root : str, :class:`pathlib.Path` or None
+        The directory. If None, `SERVER_PATH/PACKAGE_DIR` of the current
+        app is used.
+    """
+
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        if self._root is not None:
+            return Path(self._root)
+        return (Path(current_app.config['SERVER_PATH'])
+                / Path(current_app.config['PACKAGE_DIR']))
+
+    def local_path(self, key):
+        return self.root / key
+
+    def put_stream(self, key, stream):
+        path = self._make_parent(key)
+        with open(str(path), 'wb') as openf:
+            shutil.copyfileobj(stream, openf, CHUNK_SIZE)
+
+    def put_file(self, key, path):
+        dest = self._make_parent(key)
+        logger.debug("Renaming %s to %s" % (str(path), str(dest)))
+        path.rename(dest)
+
+    def get_stream(self, key, start=0, stop=None):
+        openf = open(str(self.local_path(key)), 'rb')
+        openf.seek(start)
+        return openf
+
+    def stat(self, key):
+        try:
+            stat = self.local_path(key).stat()
+        except FileNotFoundError:
+            return None
+        return ObjectStat(stat.st_size, stat.st_mtime, stat.st_ino)
+
+    def delete(self, key):
+        path = self.local_path(key)
+        if path.exists():
+            path.unlink()
+
+    def link(self, src_key, dst_key):
+        src = self.local_path(src_key)
+        dst = self._make_parent(dst_key)
+        logger.debug("Linking %s to %s" % (str(dst), str(src)))
+        if dst.exists():
+            dst.unlink()
+        try:
+            os.link(str(src), str(dst))
+        except OSError as err:
+            logger.warning("Unable to hard link, copying instead: %s" % err)
+            shutil.copyfile(str(src), str(dst))
+
+    def _make_parent(self, key):
+        path = self.local_path(key)
+        os.makedirs(str(path.parent), mode=0o0755, exist_ok=True)
+        return path
+
+
+class S3Storage(Storage):
+    """
+    Store package files in an S3 compatible object store.
+
+    Requires `boto3`, unless a client is given.
+
+    Parameters
+    ----------
+    bucket : str
+    prefix : str
+        Prepended to every key.
+    client : S3 client or None
+        Defaults to `boto3.client('s3', **client_kwargs)`.
+    presign_expires : int
+        How long (seconds) the download URLs from :meth:`url` are valid.
+        If 0, :meth:`url` returns None and the server sends the files.
+    client_kwargs :
+        Passed to `boto3.client`, for example `endpoint_url`.
+    """
+
+    def __init__(self, bucket, prefix="", client=None, presign_expires=300,
+                 **client_kwargs):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                msg = "The S3 storage backend requires boto3."
+                raise StorageError(msg)
+            client = boto3.client('s3', **client_kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.presign_expires = presign_expires
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def put_stream(self, key, stream):
+        # Multipart upload, so the file is never read into memory.
+        self.client.upload_fileobj(stream, self.bucket, self._key(key))
+
+    def get_stream(self, key, start=0, stop=None):
+        kwargs = {}
+        if start or stop is not None:
+            end = "" if stop is None else str(stop - 1)
+            kwargs['Range'] = "bytes={}-{}".format(start, end)
+        result = self.client.get_object(Bucket=self.bucket,
+                                        Key=self._key(key),
+                                        **kwargs)
+        return result['Body']
+
+    def stat(self, key):
+        try:
+            result = self.client.head_object(Bucket=self.bucket,
+                                             Key=self._key(key))
+        except Exception as err:
+            if _is_not_found(err):
+                return None
+            raise
+        return ObjectStat(result['ContentLength'],
+                          result['LastModified'].timestamp())
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def link(self, src_key, dst_key):
+        # Copied by the object store. The data never goes through us.
+        source = {'Bucket': self.bucket, 'Key': self._key(src_key)}
+        self.client.copy_object(CopySource=source,
+                                Bucket=self.bucket,
+                                Key=self._key(dst_key))
+
+    def url(self, key, filename=None):
+        if not self.presign_expires:
+            return None
+        params = {'Bucket': self.bucket, 'Key': self._key(key)}
+        if filename is not None:
+            disposition = 'attachment; filename="{}"'.format(filename)
+            params['ResponseContentDisposition'] = disposition
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params=params,
+            ExpiresIn=self.presign_expires,
+        )
+
+
+def _is_not_found(err):
+    """Check if a botocore `ClientError` is a 404."""
+    response = getattr(err, 'response', None) or {}
+    code = str(response.get('Error', {}).get('Code', ''))
+    return code in ('404', 'NoSuchKey', 'NotFound')
+
+
+def create_storage(config):
+    """
+    Create the storage backend selected by the `STORAGE_BACKEND` setting.
+
+    Parameters
+    ----------
+    config : :class:`flask.Config` or dict
+
+    Returns
+    -------
+    :class:`Storage`
+    """
+    backend = config['STORAGE_BACKEND']
+    logger.debug("storage.create_storage(%s)" % backend)
+    # Other backends can't link keys, so each package would be stored twice.
+    if config['CONTENT_ADDRESSABLE_STORE'] and backend != 'local':
+        msg = "CONTENT_ADDRESSABLE_STORE requires the 'local' STORAGE_BACKEND"
+        raise StorageError(msg)
+    if backend == 'local':
+        return LocalStorage()
+    elif backend == 's3':
+        client_kwargs = {}
+        if config['S3_ENDPOINT_URL']:
+            client_kwargs['endpoint_url'] = config['S3_ENDPOINT_URL']
+        if config['S3_REGION']:
+            client_kwargs['region_name'] = config['S3_REGION']
+        return S3Storage(config['S3_BUCKET'],
+                         prefix=config['S3_PREFIX'],
+                         presign_expires=config['S3_PRESIGN_EXPIRES'],
+                         **client_kwargs)
+    else:
+        raise StorageError("Unknown STORAGE_BACKEND '{}'".format(backend))
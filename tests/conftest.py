@@ -11,6 +11,7 @@ import sqlalchemy as sa
 
 from . import helpers
 from pynuget import create_app
+from pynuget import app_factory
 from pynuget import commands
 from pynuget import db
 from pynuget import feedwriter as fw
@@ -60,9 +61,15 @@ def client():
                         app.config['DB_NAME'],
                         server_path)
 
+    # The engine was created by create_app() with the old paths.
+    app_factory.init_db(app)
+
     client = app.test_client()
     yield client
 
+    app.extensions['pynuget']['download_counter'].stop()
+    app.extensions['pynuget']['db_engine'].dispose()
+
     # Cleanup
     os.remove(os.path.join(server_path, app.config['DB_NAME']))
     shutil.rmtree(str(server_path), ignore_errors=False)
@@ -136,9 +143,9 @@ def package_dir(package_data):
     """A dummy package directory with packages."""
     pkg_dir = Path(DATA_DIR) / Path('pkgs')
     for pkg, versions in package_data.items():
+        os.makedirs(str(pkg_dir / Path(pkg)), exist_ok=True)
         for version in versions:
-            path = pkg_dir / Path(pkg) / Path(version)
-            os.makedirs(str(path), exist_ok=True)
+            (pkg_dir / Path(pkg) / Path(version + ".nupkg")).touch()
     yield pkg_dir
     shutil.rmtree(str(pkg_dir), ignore_errors=False)
 
@@ -160,6 +167,8 @@ def version_row():
         description="Some description",
         icon_url="no url",
         is_prerelease=False,
+        is_latest=True,
+        is_absolute_latest=True,
         package_hash="abc123",
         package_hash_algorithm="Michael Jackson",
         package_size=1024,
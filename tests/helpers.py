@@ -2,6 +2,11 @@
 """
 """
 import os
+from datetime import datetime
+from datetime import timezone
+from io import BytesIO
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
 
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
@@ -27,3 +32,93 @@ def check_push(expected_code, client, header, file=None):
         pass
 
     assert rv.status_code == expected_code
+
+
+def make_nupkg(name, version, description=None, title=None):
+    """
+    Build a copy of `good.nupkg` with a different package name and version,
+    and optionally description and title.
+
+    Returns the package file contents as bytes.
+    """
+    good = os.path.join(DATA_DIR, 'good.nupkg')
+    out = BytesIO()
+    with ZipFile(good, 'r') as src, ZipFile(out, 'w', ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            data = src.read(info.filename)
+            if info.filename.endswith('.nuspec'):
+                data = data.replace(b'<id>NuGetTest</id>',
+                                    '<id>{}</id>'.format(name).encode())
+                data = data.replace(b'<version>0.0.1</version>',
+                                    '<version>{}</version>'.format(version).encode())
+                if description is not None:
+                    data = data.replace(
+                        b'<description>Package Description</description>',
+                        '<description>{}</description>'.format(description).encode())
+                if title is not None:
+                    data = data.replace(
+                        b'</version>',
+                        '</version><title>{}</title>'.format(title).encode(), 1)
+            dst.writestr(info, data)
+    return out.getvalue()
+
+
+def push_pkg(client, header, name, version, expected_code=201, **kwargs):
+    """Push a generated package, see :func:`make_nupkg`."""
+    nupkg = make_nupkg(name, version, **kwargs)
+    data = {'package': (BytesIO(nupkg), 'filename.nupkg')}
+    rv = client.put(
+        '/api/v2/package/',
+        headers=header,
+        follow_redirects=True,
+        data=data,
+    )
+    assert rv.status_code == expected_code
+    return rv
+
+
+class FakeS3Client(object):
+    """
+    An in-memory stand-in for a boto3 S3 client.
+
+    Only implements the calls used by :class:`storage.S3Storage`.
+    """
+
+    class NotFound(Exception):
+        response = {'Error': {'Code': '404'}}
+
+    def __init__(self):
+        # {(bucket, key): (data, last_modified)}
+        self.objects = {}
+
+    def _get(self, bucket, key):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise self.NotFound(key)
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        now = datetime.now(timezone.utc)
+        self.objects[(bucket, key)] = (fileobj.read(), now)
+
+    def get_object(self, Bucket, Key, Range=None):
+        data, _ = self._get(Bucket, Key)
+        if Range is not None:
+            start, _, end = Range[len('bytes='):].partition('-')
+            data = data[int(start):int(end) + 1 if end else None]
+        return {'Body': BytesIO(data)}
+
+    def head_object(self, Bucket, Key):
+        data, last_modified = self._get(Bucket, Key)
+        return {'ContentLength': len(data), 'LastModified': last_modified}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def copy_object(self, CopySource, Bucket, Key):
+        src = self._get(CopySource['Bucket'], CopySource['Key'])
+        self.objects[(Bucket, Key)] = src
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        return "https://s3.example.com/{}/{}?expires={}".format(
+            Params['Bucket'], Params['Key'], ExpiresIn)
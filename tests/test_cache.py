@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import threading
+import time
+
+from pynuget import cache
+
+
+def test_response_cache_lru():
+    c = cache.ResponseCache(max_entries=2, ttl=60)
+    c.set('a', b'A')
+    c.set('b', b'B')
+    assert c.get('a') == b'A'
+    c.set('c', b'C')
+
+    # 'b' was the least recently used.
+    assert c.get('b') is None
+    assert c.get('a') == b'A'
+    assert c.get('c') == b'C'
+
+    stats = c.as_dict()
+    assert stats['entries'] == 2
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 1
+
+
+def test_response_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    c = cache.ResponseCache(ttl=10)
+    c.set('a', b'A')
+    now[0] += 9
+    assert c.get('a') == b'A'
+    now[0] += 1
+    assert c.get('a') is None
+    assert c.as_dict()['expirations'] == 1
+    assert c.as_dict()['entries'] == 0
+
+
+def test_response_cache_invalidate():
+    c = cache.ResponseCache()
+    c.set('find-a', b'1', [cache.package_tag('PkgA')])
+    c.set('find-b', b'2', [cache.package_tag('PkgB')])
+    c.set('search', b'3', [cache.ALL_PACKAGES_TAG])
+
+    removed = c.invalidate([cache.package_tag('pkga'),
+                            cache.ALL_PACKAGES_TAG])
+    assert removed == 2
+    assert c.get('find-a') is None
+    assert c.get('search') is None
+    assert c.get('find-b') == b'2'
+    assert c.as_dict()['invalidations'] == 2
+
+
+def test_response_cache_generation():
+    c = cache.ResponseCache()
+    generation = c.generation()
+    c.invalidate(['unrelated'])
+
+    # The value was computed before the invalidation.
+    assert c.set('a', b'A', ['tag'], generation) is False
+    assert c.get('a') is None
+
+    assert c.set('a', b'A', ['tag'], c.generation()) is True
+    assert c.get('a') == b'A'
+
+    c.clear()
+    assert c.get('a') is None
+
+
+def test_single_flight():
+    flight = cache.SingleFlight()
+    call, leader = flight.begin('a')
+    assert leader is True
+
+    results = []
+    followers = [threading.Thread(target=lambda: results.append(
+        flight.begin('a')[0].wait(10))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.as_dict()['followers'] < 3:
+        time.sleep(0.01)
+
+    flight.finish('a', call, b'A')
+    for thread in followers:
+        thread.join()
+    assert results == [b'A'] * 3
+
+    # Only the first finish counts.
+    flight.finish('a', call, None)
+    assert call.wait(0) == b'A'
+
+    # The next request starts a new computation.
+    call, leader = flight.begin('a')
+    assert leader is True
+    assert flight.as_dict() == {'in_flight': 1, 'leaders': 2,
+                                'followers': 3}
+
+
+def test_single_flight_failure_and_forget():
+    flight = cache.SingleFlight()
+    call, _ = flight.begin('a')
+    follower, leader = flight.begin('a')
+    assert leader is False
+    assert follower.wait(0) is None
+
+    # A failed leader gives its followers nothing to share.
+    flight.finish('a', call, None)
+    assert follower.wait(0) is None
+
+    call, _ = flight.begin('a')
+    flight.forget()
+    new_call, leader = flight.begin('a')
+    assert leader is True
+    # Finishing the forgotten call doesn't end the new one.
+    flight.finish('a', call, b'old')
+    assert flight.as_dict()['in_flight'] == 1
+    assert not new_call.done.is_set()
@@ -4,11 +4,17 @@
 import filecmp
 import os
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
+import requests
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
 from freezegun import freeze_time
 
+from . import helpers
 from pynuget import commands
+from pynuget import core
 from pynuget import db
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
@@ -29,6 +35,273 @@ def test__get_packages_from_files(package_data, package_dir):
         assert set(value) == set(package_data[key])
 
 
+class FakeSession(object):
+    """Records `put` calls and answers with the given status codes."""
+
+    def __init__(self, *status_codes):
+        self.status_codes = list(status_codes)
+        self.calls = []
+
+    def put(self, url, headers=None, data=None):
+        self.calls.append((url, headers))
+        code = self.status_codes.pop(0) if self.status_codes else 201
+        if isinstance(code, Exception):
+            raise code
+        return SimpleNamespace(status_code=code, text="")
+
+
+@pytest.mark.parametrize("name", [
+    "a.1.nupkg",
+    'a"; name="other.nupkg',
+    "a\r\nContent-Type: text-plain\r\n.nupkg",
+])
+def test__multipart_body(tmp_path, name):
+    file = tmp_path / name
+    file.write_bytes(b"x" * 100000)
+
+    with commands._MultipartBody(file) as body:
+        chunks = iter(lambda: body.read(4096), b'')
+        data = b''.join(chunks)
+        assert len(data) == len(body)
+
+    # Werkzeug parses it like a `requests` multipart body.
+    environ = EnvironBuilder(method='PUT', data=data,
+                             content_type=body.content_type).get_environ()
+    files = Request(environ).files
+    assert list(files) == ['package']
+    assert files['package'].filename == "package.nupkg"
+    assert files['package'].content_type == "application/octet-stream"
+    assert files['package'].read() == b"x" * 100000
+
+
+def test_push_gzip(client, tmp_path):
+    file = tmp_path / "good.nupkg"
+    file.write_bytes(helpers.make_nupkg("Zipped", "1.0.0"))
+
+    class TestClientSession(object):
+        def put(self, url, headers=None, data=None):
+            assert headers['Content-Encoding'] == 'gzip'
+            rv = client.put(url, headers=headers, data=data.read())
+            return SimpleNamespace(status_code=rv.status_code,
+                                   text=rv.get_data(as_text=True))
+
+    assert commands.push(str(file), "http://localhost", "no_key",
+                         session=TestClientSession(), compress=True)
+    rv = client.get('/download/1/1.0.0')
+    assert rv.status_code == 200
+    assert rv.data == file.read_bytes()
+    rv.close()
+
+    # Not gzip.
+    with commands._MultipartBody(file) as body:
+        header = {'X-Nuget-ApiKey': 'no_key',
+                  'Content-Type': body.content_type,
+                  'Content-Encoding': 'gzip'}
+        rv = client.put('/api/v2/package/', headers=header, data=body.read())
+    assert rv.status_code == 400
+
+
+def test__expand_push_paths(tmp_path):
+    for name in ("a.1.nupkg", "b.1.nupkg", "sub/c.1.nupkg", "d.txt"):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).touch()
+
+    result = commands._expand_push_paths([
+        str(tmp_path / "a.*.nupkg"),
+        str(tmp_path),
+        str(tmp_path / "missing.nupkg"),
+    ])
+    assert result == [str(tmp_path / "a.1.nupkg"),
+                      str(tmp_path / "b.1.nupkg"),
+                      str(tmp_path / "sub" / "c.1.nupkg")]
+
+
+def test_push_many(tmp_path):
+    for name in ("a.1.nupkg", "b.1.nupkg", "c.1.nupkg"):
+        (tmp_path / name).write_bytes(b"data")
+
+    session = FakeSession()
+    assert commands.push_many([str(tmp_path)], "http://server/", "key",
+                              jobs=2, session=session)
+    assert len(session.calls) == 3
+    assert {url for url, _ in session.calls} == {
+        "http://server/api/v2/package/"}
+
+
+def test_push_many_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(commands, 'PUSH_RETRY_BACKOFF', 0)
+    file = tmp_path / "a.1.nupkg"
+    file.write_bytes(b"data")
+
+    # Unavailable servers and connection errors are retried.
+    error = requests.exceptions.ConnectionError("reset")
+    session = FakeSession(503, error, 201)
+    assert commands.push_many([str(file)], "http://server", "key",
+                              retries=2, session=session)
+    assert len(session.calls) == 3
+
+    # Running out of retries fails.
+    session = FakeSession(502, 504)
+    assert not commands.push_many([str(file)], "http://server", "key",
+                                  retries=1, session=session)
+    assert len(session.calls) == 2
+
+    # Other errors are not retried: a 500 may come after the package was
+    # saved.
+    for code in (409, 500):
+        session = FakeSession(code)
+        assert not commands.push_many([str(file)], "http://server", "key",
+                                      retries=2, session=session)
+        assert len(session.calls) == 1
+
+    # A conflict after a retry means an earlier attempt was saved.
+    session = FakeSession(error, 409)
+    assert commands.push_many([str(file)], "http://server", "key",
+                              retries=2, session=session)
+    assert len(session.calls) == 2
+
+
+def test_push_many_no_files(tmp_path):
+    session = FakeSession()
+    assert not commands.push_many([str(tmp_path / "*.nupkg")],
+                                  "http://server", "key", session=session)
+    assert session.calls == []
+
+
+def _write_nupkg(pkg_dir, name, version, key=None, description=None):
+    path = pkg_dir / (key or "{}/{}.nupkg".format(name, version))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(helpers.make_nupkg(name, version, description))
+    return path
+
+
+def _versions(session):
+    data = db.search_packages(session, include_prerelease=True)
+    return {k: set(v) for k, v in commands._db_data_to_dict(data).items()}
+
+
+def test__scan_package_dir(tmp_path):
+    _write_nupkg(tmp_path, "PkgA", "1.0.0")
+    (tmp_path / "PkgA" / "notes.txt").touch()
+    (tmp_path / "_temp").mkdir()
+    (tmp_path / "_temp" / "upload.nupkg").touch()
+    (tmp_path / "_blobs" / "ab").mkdir(parents=True)
+
+    files = commands._scan_package_dir(tmp_path)
+    assert list(files) == ["PkgA/1.0.0.nupkg"]
+    assert files["PkgA/1.0.0.nupkg"].size > 0
+
+    assert commands._scan_package_dir(tmp_path / "missing") == {}
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test__rebuild(session, tmp_path, jobs):
+    _write_nupkg(tmp_path, "PkgA", "1.0.0")
+    _write_nupkg(tmp_path, "PkgA", "1.1.0")
+    _write_nupkg(tmp_path, "PkgB", "0.1.0")
+
+    # The dummy versions don't have package files.
+    added, deleted = commands._rebuild(session, tmp_path, jobs)
+    assert (added, deleted) == (3, 3)
+    assert _versions(session) == {'PkgA': {'1.0.0', '1.1.0'},
+                                  'PkgB': {'0.1.0'}}
+
+    pkg = session.query(db.Package).filter(db.Package.name == "PkgA").one()
+    assert pkg.latest_version == "1.1.0"
+    version = db.find_version(session, pkg.package_id, "1.0.0")
+    assert version.package_hash
+    assert version.package_size > 0
+    assert version.feed_entry is not None
+    assert set(db.get_package_files(session)) == {
+        "PkgA/1.0.0.nupkg", "PkgA/1.1.0.nupkg", "PkgB/0.1.0.nupkg"}
+
+    # Nothing changed, so nothing is read.
+    assert commands._rebuild(session, tmp_path, jobs) == (0, 0)
+
+
+def test__rebuild_changes(session, tmp_path, monkeypatch):
+    _write_nupkg(tmp_path, "PkgA", "1.0.0")
+    _write_nupkg(tmp_path, "PkgA", "1.1.0")
+    commands._rebuild(session, tmp_path, 1)
+
+    parsed = []
+    original = commands._parse_package_file
+
+    def counted(path):
+        parsed.append(path)
+        return original(path)
+
+    monkeypatch.setattr(commands, '_parse_package_file', counted)
+
+    # A deleted file deletes its version, the package's latest version is
+    # updated.
+    (tmp_path / "PkgA" / "1.1.0.nupkg").unlink()
+    assert commands._rebuild(session, tmp_path, 1) == (0, 1)
+    assert _versions(session) == {'PkgA': {'1.0.0'}}
+    pkg = session.query(db.Package).one()
+    assert pkg.latest_version == "1.0.0"
+
+    # A version deleted from the database is re-added from the saved
+    # nuspec, without reading the file.
+    db.delete_version(session, "PkgA", "1.0.0")
+    assert commands._rebuild(session, tmp_path, 1) == (1, 0)
+    assert _versions(session) == {'PkgA': {'1.0.0'}}
+    assert parsed == []
+
+    # A file that doesn't match its nuspec is skipped.
+    _write_nupkg(tmp_path, "PkgC", "2.0.0", key="PkgC/9.9.9.nupkg")
+    assert commands._rebuild(session, tmp_path, 1) == (0, 0)
+    assert len(parsed) == 1
+    assert _versions(session) == {'PkgA': {'1.0.0'}}
+
+
+def test__rebuild_updates_search_index(session, tmp_path):
+    path = _write_nupkg(tmp_path, "PkgA", "1.0.0", description="apples")
+    commands._rebuild(session, tmp_path, 1)
+    assert len(db.search_packages(session, search_query="apples")) == 1
+
+    # A changed nuspec updates the existing version in place.
+    path.write_bytes(helpers.make_nupkg("PkgA", "1.0.0", "oranges"))
+    os.utime(str(path), (1, 1))
+    assert commands._rebuild(session, tmp_path, 1) == (1, 0)
+    result = db.search_packages(session, search_query="oranges")
+    assert [r.version for r in result] == ["1.0.0"]
+    assert db.search_packages(session, search_query="apples") == []
+
+
+def test__rebuild_removes_unused_blobs(session, tmp_path):
+    path = _write_nupkg(tmp_path, "PkgA", "1.0.0")
+    hash_, _ = core.hash_and_encode_file(path)
+    blob = tmp_path / core.get_blob_path(hash_)
+    blob.parent.mkdir(parents=True)
+    os.link(str(path), str(blob))
+    unused = tmp_path / core.get_blob_path(core.hash_and_encode_file(
+        _write_nupkg(tmp_path, "Other", "1.0.0", key="other.tmp"))[0])
+    unused.parent.mkdir(parents=True, exist_ok=True)
+    unused.touch()
+
+    commands._rebuild(session, tmp_path, 1)
+    assert blob.exists()
+    assert not unused.exists()
+
+    # The last version using the file is gone.
+    path.unlink()
+    assert commands._rebuild(session, tmp_path, 1) == (0, 1)
+    assert not blob.exists()
+
+
+def test__rebuild_batches(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(commands, 'REBUILD_BATCH_SIZE', 2)
+    for version in ('1.0.0', '1.0.1', '1.0.2', '1.0.3', '1.0.4'):
+        _write_nupkg(tmp_path, "PkgA", version)
+
+    before, _ = db.get_catalog_state(session)
+    assert commands._rebuild(session, tmp_path, 1) == (5, 3)
+    after, _ = db.get_catalog_state(session)
+    # one delete batch (3 dummy versions in 2 batches) and 3 save batches
+    assert after - before == 5
+
+
 def test__db_data_to_dict(session):
     expected = {'dummy': ['0.0.1', '0.0.2', '0.0.3']}
     data = db.search_packages(session, include_prerelease=True)
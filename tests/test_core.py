@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 """
 """
+import base64
+import gzip
+import hashlib
 import os
 import shutil
 from binascii import hexlify
+from io import BytesIO
 from pathlib import Path
 from unittest.mock import MagicMock
+from zipfile import ZipFile
+from zipfile import ZIP_BZIP2
+from zipfile import ZIP_DEFLATED
 
 import pytest
+from flask import request
 from lxml import etree as et
 from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from pynuget import create_app
 from pynuget import core
@@ -162,3 +172,144 @@ def test_determine_dependencies():
         {'framework': None, 'id': 'E', 'version': '0.0.5'},
     ]
     assert result == expected
+
+
+def test_skiptoken():
+    values = (3, "it's", '0.0.1', None)
+    token = core.format_skiptoken(values)
+    assert token == "3,'it''s','0.0.1',null"
+    assert core.parse_skiptoken(token) == values
+
+    for bad in ('', 'abc', "'a' 'b'"):
+        with pytest.raises(core.ApiException):
+            core.parse_skiptoken(bad)
+
+
+def test_hashing_file():
+    out = BytesIO()
+    file = core.HashingFile(out)
+    file.write(b"abc")
+    file.write(b"def")
+    assert out.getvalue() == b"abcdef"
+    assert file.size == 6
+
+    expected = base64.b64encode(hashlib.sha512(b"abcdef").digest())
+    assert file.encoded_hash() == (expected.decode('utf-8'), 6)
+
+
+def test_save_upload(tmpdir):
+    good = os.path.join(DATA_DIR, "good.nupkg")
+    expected = core.hash_and_encode_file(good)
+
+    app = create_app()
+    app.config['SERVER_PATH'] = str(tmpdir)
+    with open(good, 'rb') as openf:
+        file = FileStorage(openf)
+        with app.app_context():
+            path, hash_, filesize = core.save_upload(file)
+    assert path.parent.name == core.TEMP_DIR
+    assert (hash_, filesize) == expected
+    assert core.hash_and_encode_file(path) == expected
+
+    # Uploads received by `UploadRequest` are hashed while they're parsed.
+    with open(good, 'rb') as openf:
+        data = {'package': (openf, 'good.nupkg')}
+        with app.test_request_context('/', method='PUT', data=data):
+            file = request.files['package']
+            assert isinstance(file.stream, core.HashingFile)
+            path, hash_, filesize = core.save_upload(file)
+            assert (hash_, filesize) == expected
+            assert core.hash_and_encode_file(path) == expected
+
+
+def test_store_package_content_addressable(tmpdir):
+    app = create_app()
+    app.config['SERVER_PATH'] = str(tmpdir)
+    app.config['CONTENT_ADDRESSABLE_STORE'] = True
+    good = os.path.join(DATA_DIR, "good.nupkg")
+    hash_, _ = core.hash_and_encode_file(good)
+    pkg_dir = Path(str(tmpdir)) / app.config['PACKAGE_DIR']
+
+    with app.app_context():
+        paths = []
+        for version in ("1.0.0", "1.0.1"):
+            upload = Path(str(tmpdir)) / (version + ".tmp")
+            shutil.copyfile(good, str(upload))
+            path = pkg_dir / "Foo" / (version + ".nupkg")
+            core.store_package(upload, path, hash_)
+            assert not upload.exists()
+            paths.append(path)
+
+        blob = pkg_dir / core.get_blob_path(hash_)
+        assert blob.parent.parent.name == core.BLOB_DIR
+        # One copy of the data, three names for it.
+        assert blob.stat().st_nlink == 3
+        assert all(p.samefile(blob) for p in paths)
+
+        core.remove_blob(hash_)
+        assert not blob.exists()
+        assert paths[0].read_bytes() == Path(good).read_bytes()
+
+
+def test_extract_nuspec_fast_path(tmpdir):
+    good = os.path.join(DATA_DIR, "good.nupkg")
+    path = str(tmpdir.join("many.nupkg"))
+    with ZipFile(good) as src, ZipFile(path, 'w', ZIP_DEFLATED) as dst:
+        for n in range(100):
+            dst.writestr("lib/file{}.dll".format(n), b"")
+        # Only root-level .nuspec files count.
+        dst.writestr("content/other.nuspec", b"<package/>")
+        for info in src.infolist():
+            dst.writestr(info, src.read(info.filename))
+        dst.comment = b"a comment"
+
+    with open(path, 'rb') as openf:
+        data = core._read_root_nuspec(openf)
+    assert data == core._read_root_nuspec_zipfile(path)
+    assert et.iselement(core.extract_nuspec(path))
+
+    for name in ("no_nuspec.nupkg", "multiple_nuspec.nupkg"):
+        with open(os.path.join(DATA_DIR, name), 'rb') as openf:
+            with pytest.raises(core.ApiException):
+                core._read_root_nuspec(openf)
+
+
+def test_extract_nuspec_fallback(tmpdir):
+    # Stored with bzip2, which the fast path leaves to `zipfile`.
+    path = str(tmpdir.join("bzip2.nupkg"))
+    with ZipFile(os.path.join(DATA_DIR, "good.nupkg")) as src:
+        with ZipFile(path, 'w', ZIP_BZIP2) as dst:
+            for info in src.infolist():
+                dst.writestr(info.filename, src.read(info.filename))
+
+    with open(path, 'rb') as openf:
+        with pytest.raises(core._UnsupportedZip):
+            core._read_root_nuspec(openf)
+    assert et.iselement(core.extract_nuspec(path))
+
+
+def test_read_package_metadata():
+    parsed = core.read_package_metadata(os.path.join(DATA_DIR, "good.nupkg"))
+    assert parsed['id'] == "NuGetTest"
+    fields = parsed['fields']
+    assert fields['version'] == "0.0.1"
+    assert fields['authors'] == "Douglas Thor"
+    assert fields['is_prerelease'] is False
+    assert fields['dependencies'] == []
+
+
+def test_gzip_decoding_stream():
+    data = os.urandom(200000) * 2
+    compressed = gzip.compress(data)
+
+    stream = core.GzipDecodingStream(BytesIO(compressed))
+    assert stream.read() == data
+
+    with pytest.raises(RequestEntityTooLarge):
+        core.GzipDecodingStream(BytesIO(compressed), max_size=1000).read()
+
+    with pytest.raises(BadRequest):
+        core.GzipDecodingStream(BytesIO(compressed[:1000])).read()
+
+    with pytest.raises(BadRequest):
+        core.GzipDecodingStream(BytesIO(data[:1000])).read()
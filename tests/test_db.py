@@ -2,10 +2,14 @@
 """
 """
 
+import threading
+import time
+
 import pytest
 import sqlalchemy as sa
 
 from pynuget import db
+from pynuget import storage
 
 
 def test_count_packages(session):
@@ -60,7 +64,7 @@ def test_package_updates(session):
     session.add(db.Version(package_id=pkg.package_id, version="0.1.4"))
     session.commit()
 
-    data = {1: '0.0.2', 2: '0.1.3'}
+    data = {'dummy': '0.0.2', 'test_proj': '0.1.3'}
 
     result = db.package_updates(session, data)
     assert len(result) == 2
@@ -72,10 +76,45 @@ def test_package_updates(session):
 
     # if we currently have the latest version, return nothing. Do not return
     # packages that we don't have installed.
-    data = {1: '0.0.3'}
+    data = {'dummy': '0.0.3'}
     result = db.package_updates(session, data)
     assert len(result) == 0
 
+    # Packages that don't exist on the server are ignored.
+    result = db.package_updates(session, [('missing', '1.0.0')])
+    assert len(result) == 0
+    assert db.package_updates(session, {}) == []
+
+
+def test_package_updates_semver(session):
+    pkg = db.Package(name="semver", latest_version="1.10.0")
+    session.add(pkg)
+    session.commit()
+    for version, prerelease in (("1.9.0", False), ("1.10.0", False),
+                                ("2.0.0-beta", True)):
+        session.add(db.Version(package_id=pkg.package_id, version=version,
+                               is_prerelease=prerelease))
+    session.commit()
+
+    # "1.10.0" is newer than "1.9.0"...
+    result = db.package_updates(session, [('semver', '1.9.0')])
+    assert [r.version for r in result] == ["1.10.0"]
+    # ... and not older than "1.9.5".
+    result = db.package_updates(session, [('semver', '1.9.5')])
+    assert [r.version for r in result] == ["1.10.0"]
+    result = db.package_updates(session, [('semver', '1.10.0')])
+    assert result == []
+
+    result = db.package_updates(session, [('semver', '1.10.0')],
+                                include_prerelease=True)
+    assert [r.version for r in result] == ["2.0.0-beta"]
+
+    # Many packages in one call.
+    data = [('pkg{}'.format(i), '1.0') for i in range(2000)]
+    data.append(('semver', '1.0'))
+    result = db.package_updates(session, data)
+    assert [r.version for r in result] == ["1.10.0"]
+
 
 def test_find_by_pkg_name(session):
     result_1 = db.find_by_pkg_name(session, 'dummy')
@@ -149,6 +188,21 @@ def test_insert_version(session):
     assert version_count + 1 == sql.scalar()
 
 
+def test_insert_version_render_entry(session):
+    commits = []
+    sa.event.listen(session, 'after_commit', commits.append)
+
+    def render(row):
+        assert commits == []
+        return "entry for {}".format(row.version_id).encode()
+
+    row = db.insert_version(session, package_id=1, version="0.0.4",
+                            render_entry=render)
+    # Saved with its feed entry in a single transaction.
+    assert len(commits) == 1
+    assert row.feed_entry == "entry for {}".format(row.version_id).encode()
+
+
 def test_delete_version(session):
     # Add additional dummy data.
     pkg = db.Package(name="Foo", latest_version="0.9.6")
@@ -193,3 +247,479 @@ def test_delete_version(session):
     db.delete_version(session, pkg_id, '0.0.1')
     assert version_count.scalar() == 0
     assert package_count.scalar() == 1
+
+
+def _flags(session, package_name):
+    rows = (session.query(db.Version).join(db.Package)
+            .filter(db.Package.name == package_name))
+    latest = {r.version for r in rows if r.is_latest}
+    absolute = {r.version for r in rows if r.is_absolute_latest}
+    return latest, absolute
+
+
+def test_latest_version_flags(session):
+    pkg = db.Package(name="semver", latest_version="1.9.0")
+    session.add(pkg)
+    session.commit()
+
+    for version in ("1.9.0", "1.10.0", "1.2.0"):
+        db.insert_version(session, package_id=pkg.package_id,
+                          version=version)
+    assert _flags(session, "semver") == ({"1.10.0"}, {"1.10.0"})
+    assert pkg.latest_version == "1.10.0"
+
+    # Pre-releases are only the absolute latest version.
+    db.insert_version(session, package_id=pkg.package_id,
+                      version="2.0.0-beta", is_prerelease=True)
+    assert _flags(session, "semver") == ({"1.10.0"}, {"2.0.0-beta"})
+    assert pkg.latest_version == "2.0.0-beta"
+
+    result = db.search_packages(session, include_prerelease=True,
+                                filter_='IsLatestVersion')
+    assert [r.version for r in result
+            if r.package.name == "semver"] == ["1.10.0"]
+    result = db.search_packages(session, include_prerelease=True,
+                                filter_='IsAbsoluteLatestVersion')
+    assert [r.version for r in result
+            if r.package.name == "semver"] == ["2.0.0-beta"]
+
+    # Deleting uses SemVer order, not string order.
+    db.delete_version(session, "semver", "2.0.0-beta")
+    db.delete_version(session, "semver", "1.10.0")
+    assert _flags(session, "semver") == ({"1.9.0"}, {"1.9.0"})
+    assert pkg.latest_version == "1.9.0"
+
+    # Only pre-releases left.
+    db.insert_version(session, package_id=pkg.package_id,
+                      version="3.0.0-rc", is_prerelease=True)
+    db.delete_version(session, "semver", "1.9.0")
+    db.delete_version(session, "semver", "1.2.0")
+    assert _flags(session, "semver") == (set(), {"3.0.0-rc"})
+
+
+def test_insert_or_update_package_keeps_highest(session):
+    db.insert_or_update_package(session, "Foo", "Foo", "1.10.0")
+    db.insert_or_update_package(session, "Foo", "Foo", "1.9.0")
+    pkg = session.query(db.Package).filter(db.Package.name == "Foo").one()
+    assert pkg.latest_version == "1.10.0"
+
+
+def test_upgrade_schema_backfills_sort_keys(tmpdir):
+    engine = sa.create_engine("sqlite:///" + str(tmpdir.join("old.db")))
+    with engine.begin() as conn:
+        conn.execute("CREATE TABLE package (package_id INTEGER PRIMARY KEY,"
+                     " name VARCHAR(256), title VARCHAR(256),"
+                     " download_count INTEGER, latest_version TEXT)")
+        conn.execute("CREATE TABLE version (version_id INTEGER PRIMARY KEY,"
+                     " package_id INTEGER, version VARCHAR(32),"
+                     " is_prerelease BOOLEAN,"
+                     " version_download_count INTEGER)")
+        conn.execute("INSERT INTO package VALUES (1, 'old', 'old', 0, '1.9')")
+        conn.execute("INSERT INTO version (version_id, package_id, version)"
+                     " VALUES (1, 1, '1.9'), (2, 1, '1.10')")
+
+    db.upgrade_schema(engine)
+
+    session = sa.orm.Session(bind=engine)
+    rows = session.query(db.Version).order_by(db.Version.sort_key).all()
+    assert [r.version for r in rows] == ['1.9', '1.10']
+    assert [r.is_latest for r in rows] == [False, True]
+    assert session.query(db.Package).one().latest_version == '1.10'
+    session.close()
+    engine.dispose()
+
+
+def test_upgrade_schema_concurrent(tmpdir):
+    path = str(tmpdir.join("old.sqlite"))
+    engine = sa.create_engine("sqlite:///" + path)
+    engine.execute("CREATE TABLE package (package_id INTEGER PRIMARY KEY)")
+    engine.dispose()
+
+    # One engine per worker process.
+    engines = [sa.create_engine("sqlite:///" + path,
+                                connect_args={'timeout': 30})
+               for _ in range(4)]
+    errors = []
+
+    def upgrade(engine):
+        try:
+            db.upgrade_schema(engine)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=upgrade, args=(engine, ))
+               for engine in engines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    columns = sa.inspect(engines[0]).get_columns('package')
+    assert 'latest_version' in {c['name'] for c in columns}
+    for engine in engines:
+        engine.dispose()
+
+
+def test_create_db_engine():
+    stats = db.PoolStats()
+    engine = db.create_db_engine('sqlite:///:memory:', stats=stats)
+    assert isinstance(engine.pool, sa.pool.SingletonThreadPool)
+
+    session = sa.orm.Session(bind=engine)
+    db.checkout_connection(session, stats)
+    result = stats.as_dict()
+    assert result['connects'] == 1
+    assert result['checkouts'] == 1
+    assert result['checked_out'] == 1
+    assert result['wait_count'] == 1
+
+    session.close()
+    result = stats.as_dict()
+    assert result['checkins'] == 1
+    assert result['checked_out'] == 0
+
+    engine = db.create_db_engine('sqlite:////tmp/pynuget.sqlite')
+    assert isinstance(engine.pool, sa.pool.QueuePool)
+
+    engine = db.create_db_engine('sqlite:////tmp/pynuget.sqlite',
+                                 sqlite_thread_pool=True)
+    assert isinstance(engine.pool, sa.pool.SingletonThreadPool)
+
+
+def test_create_db_engine_threads(tmpdir):
+    # More threads than `pool_size` must not close each other's connections.
+    url = "sqlite:///" + str(tmpdir.join("threads.sqlite"))
+    engine = db.create_db_engine(url, pool_size=2, max_overflow=10)
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def work():
+        try:
+            with engine.connect() as conn:
+                barrier.wait(5)
+                conn.execute("SELECT 1").scalar()
+                barrier.wait(5)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    assert errors == []
+
+
+def test_search_packages_top_skip(session):
+    order_by = sa.asc(db.Version.version)
+    result = db.search_packages(session, order_by=order_by, top=2)
+    assert [r.version for r in result] == ['0.0.1', '0.0.2']
+
+    result = db.search_packages(session, order_by=order_by, top=2, skip=2)
+    assert [r.version for r in result] == ['0.0.3']
+
+
+def test_search_packages_keyset(session):
+    order_by = db.PACKAGE_VERSION_ORDER
+    result = db.search_packages(session, order_by=order_by, top=2)
+    assert [r.version for r in result] == ['0.0.1', '0.0.2']
+
+    after = db.sort_values(result[-1], order_by)
+    assert after == ('dummy', result[-1].sort_key, result[-1].version_id)
+    result = db.search_packages(session, order_by=order_by, after=after)
+    assert [r.version for r in result] == ['0.0.3']
+
+    with pytest.raises(ValueError):
+        db.search_packages(session, order_by=order_by, after=('dummy', ))
+
+    with pytest.raises(ValueError):
+        db.search_packages(session, order_by=sa.desc(db.Version.version),
+                           after=('dummy', '0.0.2'))
+
+
+def test_find_by_pkg_name_keyset(session):
+    result = db.find_by_pkg_name(session, 'dummy', top=2)
+    assert [r.version for r in result] == ['0.0.1', '0.0.2']
+    after = db.sort_values(result[-1], db.PACKAGE_VERSION_ORDER)
+    result = db.find_by_pkg_name(session, 'dummy', after=after)
+    assert [r.version for r in result] == ['0.0.3']
+
+
+def test_version_orders_semver(session):
+    pkg = db.Package(name="Ordered", latest_version="1.10.0")
+    session.add(pkg)
+    session.commit()
+    for version in ("1.10.0", "1.9.0", "1.10.0-beta"):
+        session.add(db.Version(package_id=pkg.package_id, version=version))
+    session.commit()
+    expected = ["1.9.0", "1.10.0-beta", "1.10.0"]
+
+    result = db.find_by_pkg_name(session, "Ordered")
+    assert [r.version for r in result] == expected
+    result = db.search_packages(session, order_by=db.VERSION_ORDER,
+                                include_prerelease=True)
+    result = [r.version for r in result if r.package.name == "Ordered"]
+    assert result == expected
+
+    # Keyset paging follows the same order.
+    result = db.find_by_pkg_name(session, "Ordered", top=1)
+    after = db.sort_values(result[-1], db.PACKAGE_VERSION_ORDER)
+    result = db.find_by_pkg_name(session, "Ordered", after=after, top=1)
+    assert [r.version for r in result] == ["1.10.0-beta"]
+    after = db.sort_values(result[-1], db.PACKAGE_VERSION_ORDER)
+    result = db.find_by_pkg_name(session, "Ordered", after=after)
+    assert [r.version for r in result] == ["1.10.0"]
+
+
+def test_search_index(session):
+    pkg = db.Package(name="Some.Logging", title="Logging Helpers",
+                     latest_version="1.0.0")
+    session.add(pkg)
+    session.commit()
+    session.add(db.Version(package_id=pkg.package_id, version="1.0.0",
+                           tags="log nlog", authors="Jane",
+                           description="Structured logging"))
+    session.commit()
+
+    # Prefix match on the last word only.
+    result = db.search_packages(session, search_query='logg')
+    assert [r.package.name for r in result] == ["Some.Logging"]
+    result = db.search_packages(session, search_query='jane struct')
+    assert len(result) == 1
+    result = db.search_packages(session, search_query='struct jane')
+    assert len(result) == 0
+
+    # Ranked results
+    result = db.search_packages(session, search_query='nlog',
+                                order_by=db.RELEVANCE)
+    assert [r.version for r in result] == ["1.0.0"]
+
+    # Deleting a version removes it from the index.
+    db.delete_version(session, "Some.Logging", "1.0.0")
+    assert db.search_packages(session, search_query='logging') == []
+
+
+def test_rebuild_search_index(session):
+    session.execute("DELETE FROM version_search")
+    session.commit()
+    assert db.search_packages(session, search_query='dummy') == []
+
+    assert db.rebuild_search_index(session) == 3
+    assert len(db.search_packages(session, search_query='dummy')) == 3
+
+
+def test_search_without_index(session):
+    session.execute("DROP TABLE version_search")
+    session.commit()
+    result = db.search_packages(session, search_query='umm')
+    assert len(result) == 3
+
+
+@pytest.mark.parametrize("order_by, expected", [
+    ("Id", db.ID_ORDER),
+    ("id", db.ID_ORDER),
+    ("concat(Title,Id)", db.ID_ORDER),
+    ("DownloadCount desc,Id", db.PACKAGE_DOWNLOAD_COUNT_ORDER),
+    ("DownloadCount  desc, Id", db.PACKAGE_DOWNLOAD_COUNT_ORDER),
+    ("Published desc", db.PUBLISHED_ORDER),
+    ("Version", db.VERSION_ORDER),
+    ("Title desc", None),
+])
+def test_parse_odata_order(order_by, expected):
+    assert db.parse_odata_order(order_by) == expected
+
+
+def test_search_packages_orders(session):
+    pkg = db.Package(name="another", latest_version="0.1.0",
+                     download_count=50)
+    session.add(pkg)
+    session.commit()
+    session.add(db.Version(package_id=pkg.package_id, version="0.1.0",
+                           created="2018-01-01 00:00:00"))
+    session.commit()
+
+    result = db.search_packages(session, order_by=db.ID_ORDER)
+    assert [r.package.name for r in result] == ["another"] + ["dummy"] * 3
+
+    result = db.search_packages(session,
+                                order_by=db.PACKAGE_DOWNLOAD_COUNT_ORDER)
+    assert result[0].package.name == "another"
+
+    result = db.search_packages(session, order_by=db.VERSION_ORDER)
+    assert [r.version for r in result] == ['0.0.1', '0.0.2', '0.0.3',
+                                           '0.1.0']
+
+    result = db.search_packages(session, order_by=db.PUBLISHED_ORDER,
+                                top=1)
+    assert result[0].version == "0.1.0"
+    after = db.sort_values(result[0], db.PUBLISHED_ORDER)
+    result = db.search_packages(session, order_by=db.PUBLISHED_ORDER,
+                                after=after)
+    assert "0.1.0" not in [r.version for r in result]
+
+
+def _count_feed_statements(session, func):
+    """
+    Count the SELECT statements needed to query and render a feed.
+
+    Statements that only fill in temporary tables aren't counted.
+    """
+    from pynuget.feedwriter import FeedWriter
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append(statement)
+
+    engine = session.get_bind()
+    session.expire_all()
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        FeedWriter('Test').write_to_output(func())
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute',
+                        before_cursor_execute)
+    return len(statements)
+
+
+def test_feed_statement_count(session):
+    def search():
+        return db.search_packages(session, include_prerelease=True)
+
+    def find():
+        return db.find_by_pkg_name(session, 'dummy')
+
+    def updates():
+        return db.package_updates(session, {'dummy': '0.0.1'})
+
+    counts = [_count_feed_statements(session, f)
+              for f in (search, find, updates)]
+
+    # Add more packages and make sure no extra statements are needed.
+    for i in range(10):
+        pkg = db.Package(name="pkg_{}".format(i), latest_version="1.0")
+        session.add(pkg)
+        session.commit()
+        session.add(db.Version(package_id=pkg.package_id, version="1.0"))
+        session.add(db.Version(package_id=1, version="0.1.{}".format(i)))
+        session.commit()
+
+    def updates():
+        return db.package_updates(session, {'pkg_{}'.format(i): '0.0.1'
+                                            for i in range(10)})
+
+    assert [_count_feed_statements(session, f)
+            for f in (search, find, updates)] == counts
+    assert counts == [1, 1, 1]
+
+
+def test_catalog_state(session):
+    # The fixture adds its versions directly, so nothing's been counted yet.
+    assert db.get_catalog_state(session) == (0, None)
+
+    version = db.insert_version(session, package_id=1, version="0.0.4")
+    counter, last_modified = db.get_catalog_state(session)
+    assert counter == 1
+    assert last_modified is not None
+
+    db.delete_version(session, "dummy", "0.0.4")
+    counter, _ = db.get_catalog_state(session)
+    assert counter == 2
+
+
+def test_upgrade_schema(tmpdir):
+    path = str(tmpdir.join("old.sqlite"))
+    engine = sa.create_engine("sqlite:///" + path)
+    engine.execute("CREATE TABLE package (package_id INTEGER PRIMARY KEY)")
+
+    db.upgrade_schema(engine)
+
+    inspector = sa.inspect(engine)
+    columns = {c['name'] for c in inspector.get_columns('package')}
+    assert {'name', 'latest_version', 'download_count'} <= columns
+    indexes = {i['name'] for i in inspector.get_indexes('package')}
+    assert 'ix_package_download_count_name' in indexes
+    assert 'catalog_state' in inspector.get_table_names()
+
+    # Running it again doesn't change anything.
+    db.upgrade_schema(engine)
+
+
+def test_download_counter(tmpdir):
+    engine = sa.create_engine("sqlite:///" + str(tmpdir.join("db.sqlite")))
+    db.Base.metadata.create_all(engine)
+    session = sa.orm.Session(bind=engine)
+    pkg = db.Package(name="dummy", latest_version="0.0.2")
+    session.add(pkg)
+    session.commit()
+    v1 = db.Version(package_id=pkg.package_id, version="0.0.1")
+    v2 = db.Version(package_id=pkg.package_id, version="0.0.2")
+    session.add_all([v1, v2])
+    session.commit()
+
+    counter = db.DownloadCounter(engine, flush_interval=60, flush_size=3)
+    counter.add(pkg.package_id, v1.version_id)
+    counter.add(pkg.package_id, v2.version_id)
+    assert counter.as_dict()['pending'] == 2
+
+    # Hitting the size threshold wakes up the background thread.
+    counter.add(pkg.package_id, v1.version_id)
+    for _ in range(100):
+        if counter.as_dict()['flushed'] == 3:
+            break
+        time.sleep(0.01)
+    assert counter.as_dict() == {'pending': 0, 'flushes': 1, 'flushed': 3,
+                                 'errors': 0}
+
+    # Stopping writes whatever is left.
+    counter.add(pkg.package_id, v2.version_id)
+    counter.stop()
+
+    session.expire_all()
+    assert v1.version_download_count == 2
+    assert v2.version_download_count == 2
+    assert pkg.download_count == 4
+
+
+def test_package_file(session):
+    stat = storage.ObjectStat(10, 1234.5, 42)
+    parsed = {'id': 'dummy', 'title': None, 'fields': {'version': '0.0.1'}}
+    db.save_package_file(session, "dummy/0.0.1.nupkg", stat, "abc", parsed)
+
+    rows = db.get_package_files(session)
+    row = rows["dummy/0.0.1.nupkg"]
+    assert row.parsed == parsed
+    assert row.is_unchanged(stat)
+    assert not row.is_unchanged(stat._replace(modified=1235.0))
+    assert not row.is_unchanged(stat._replace(inode=43))
+    assert not row.is_unchanged(None)
+
+    # Saving again replaces the row.
+    db.save_package_file(session, "dummy/0.0.1.nupkg", stat, "def", parsed)
+    assert len(db.get_package_files(session)) == 1
+    assert row.package_hash == "def"
+
+    db.delete_package_file(session, "dummy/0.0.1.nupkg")
+    assert db.get_package_files(session) == {}
+
+
+def test_iter_package_versions(session):
+    statements = []
+
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(session.bind, 'before_cursor_execute', before_execute)
+    try:
+        result = sorted(db.iter_package_versions(session))
+    finally:
+        sa.event.remove(session.bind, 'before_cursor_execute',
+                        before_execute)
+    assert result == [("dummy", "0.0.1"), ("dummy", "0.0.2"),
+                      ("dummy", "0.0.3")]
+    # The pre-rendered feed entries are not loaded.
+    assert len(statements) == 1
+    assert "feed_entry" not in statements[0]
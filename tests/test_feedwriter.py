@@ -5,6 +5,7 @@
 import datetime as dt
 
 import pytest
+from freezegun import freeze_time
 from lxml import etree as et
 
 from pynuget import feedwriter as fw
@@ -31,6 +32,14 @@ def test_begin_feed(feedwriter):
     assert b'xml:base="https://www.nuget.org/api/v2/"' in result
     assert b'http://schemas.microsoft.com/ado/2007/08/dataservices' in result
     assert b'microsoft.com/ado/2007/08/dataservices/metadata' in result
+    assert b'rel="next"' not in result
+
+
+def test_begin_feed_next_link(feedwriter):
+    feedwriter.begin_feed("http://localhost/Search()?$skip=30")
+    result = et.tostring(feedwriter.feed)
+    assert b'rel="next"' in result
+    assert b'href="http://localhost/Search()?$skip=30"' in result
 
 
 @pytest.mark.xfail
@@ -184,3 +193,63 @@ def test_add_meta(feedwriter):
     )
     feedwriter.add_meta(node, name, value, type_)
     assert et.tostring(node) == expected_2
+
+
+@freeze_time("2018-05-06 14:56:43")
+def test_write_stream(feedwriter, version_row):
+    version_row.dependencies = '[{"id": "A", "version": "0.2.3"}]'
+    chunks = list(feedwriter.write_stream([version_row, version_row],
+                                          "http://localhost/next"))
+    # Header, one chunk per entry and the closing tag.
+    assert len(chunks) == 4
+    streamed = b"".join(chunks)
+    assert streamed.startswith(b"<?xml version='1.0' encoding='utf-8'?>")
+    assert b'rel="next"' in chunks[0]
+
+    expected = feedwriter.write([version_row, version_row],
+                                "http://localhost/next")
+    assert (et.tostring(et.fromstring(streamed), method='c14n')
+            == et.tostring(et.fromstring(expected), method='c14n'))
+
+
+def test_write_stream_empty(feedwriter):
+    result = b"".join(feedwriter.write_stream([]))
+    feed = et.fromstring(result)
+    assert feed.tag == "{http://www.w3.org/2005/Atom}feed"
+    assert feed.find("{http://www.w3.org/2005/Atom}entry") is None
+
+
+def test_entry_template(feedwriter, version_row):
+    version_row.dependencies = '[{"id": "A", "version": "0.2.3"}]'
+    template = fw.render_entry_template(version_row)
+    assert isinstance(template, bytes)
+    assert b"\x00base_url\x00" in template
+    assert b"\x00DownloadCount\x00" in template
+    assert b"localhost" not in template
+
+    # Volatile values are filled in when the template is used.
+    version_row.feed_entry = template
+    version_row.package.download_count = 42
+    expected = et.tostring(feedwriter.make_entry(version_row))
+    assert feedwriter.fill_entry_template(version_row) == expected
+    assert b'<d:DownloadCount type="Edm.Int32">42<' in expected
+
+
+def test_entry_template_user_text(feedwriter, version_row):
+    # Text from the nuspec that looks like a placeholder is left alone.
+    version_row.dependencies = '[{"id": "A", "version": "0.2.3"}]'
+    version_row.description = "{{pynuget:DownloadCount}} {{pynuget:base_url}}"
+    version_row.feed_entry = fw.render_entry_template(version_row)
+    version_row.package.download_count = 42
+    result = feedwriter.fill_entry_template(version_row)
+    assert b"{{pynuget:DownloadCount}} {{pynuget:base_url}}" in result
+    assert result == et.tostring(feedwriter.make_entry(version_row))
+
+
+def test_entry_template_old_format(feedwriter, version_row):
+    # Entries rendered with the old placeholders are rendered again.
+    version_row.dependencies = '[{"id": "A", "version": "0.2.3"}]'
+    version_row.feed_entry = (b"<entry>{{pynuget:DownloadCount}}"
+                              b"{{pynuget:base_url}}</entry>")
+    result = feedwriter.fill_entry_template(version_row)
+    assert result == et.tostring(feedwriter.make_entry(version_row))
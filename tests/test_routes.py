@@ -1,17 +1,29 @@
 # -*- coding: utf-8 -*-
 """
 """
+import json
 import os
+import re
+import threading
+import time
 from io import BytesIO
 
 import pytest
+from flask import _request_ctx_stack
+from werkzeug.test import EnvironBuilder
 
 from . import helpers
 from .helpers import check_push
+from pynuget import app_factory
+from pynuget import core
+from pynuget import db
 from pynuget import routes
+from pynuget import shared_cache
+from pynuget import storage
 
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+API_KEY_HEADER = {'X-Nuget-ApiKey': 'no_key'}
 
 
 @pytest.mark.parametrize("url", ['/', '/index'])
@@ -81,6 +93,41 @@ def test_push_duplicate_pkg_version(client, put_header):
     check_push(409, client, put_header, 'good.nupkg')
 
 
+def test_push_file_not_visible(client, put_header, monkeypatch):
+    # eg. an object store that doesn't show the new file yet.
+    storage_ = client.application.extensions['pynuget']['storage']
+    monkeypatch.setattr(storage_, 'stat', lambda key: None)
+    check_push(500, client, put_header, 'good.nupkg')
+
+    # Nothing was registered, so the push can be retried.
+    with client.application.app_context():
+        assert not db.validate_id_and_version(routes.session, 'NuGetTest',
+                                              '0.0.1')
+    monkeypatch.undo()
+    check_push(201, client, put_header, 'good.nupkg')
+
+
+@pytest.mark.parametrize("filename, expected_code", [
+    ('good.nupkg', 201),
+    ('no_nuspec.nupkg', 400),
+    ('invalid_name.nupkg', 400),
+])
+def test_push_removes_uploads(client, put_header, filename, expected_code):
+    config = client.application.config
+    temp_dir = os.path.join(config['SERVER_PATH'], config['PACKAGE_DIR'],
+                            core.TEMP_DIR)
+    # The second push of a good package is a duplicate.
+    codes = [expected_code, 409 if expected_code == 201 else expected_code]
+    for code in codes:
+        with open(os.path.join(DATA_DIR, filename), 'rb') as openf:
+            data = {'package': (openf, filename),
+                    'extra': (BytesIO(b'Extra'), 'extra.nupkg')}
+            rv = client.put('/api/v2/package/', headers=put_header,
+                            data=data)
+        assert rv.status_code == code
+        assert os.listdir(temp_dir) == []
+
+
 @pytest.mark.skip("Gotta figure this one out...")
 def test_push_fail_to_save_file(client, put_header):
     pass
@@ -238,9 +285,41 @@ def test_search_not_found(populated_db):
     assert b"<d:Id>NuGetTest</d:Id>" not in rv.data
 
 
-@pytest.mark.skip("Test not written")
-def test_updates(client):
-    pass
+def test_updates(client, put_header):
+    for version in ("0.0.1", "0.0.9", "0.0.10", "0.1.0-beta"):
+        helpers.push_pkg(client, put_header, "Upd", version)
+    helpers.push_pkg(client, put_header, "Other", "1.0.0")
+
+    rv = client.get("/updates?packageids='Upd'|'Other'"
+                    "&versions='0.0.9'|'1.0.0'&includePrerelease=false")
+    assert rv.status_code == 200
+    assert b"<d:Version>0.0.10</d:Version>" in rv.data
+    assert rv.data.count(b"<entry>") == 1
+
+    rv = client.get("/updates?packageids='Upd'&versions='0.0.9'"
+                    "&includePrerelease=true")
+    assert b"<d:Version>0.1.0-beta</d:Version>" in rv.data
+
+    rv = client.get("/updates?packageids='Upd'|'Other'&versions='0.0.9'")
+    assert rv.status_code == 400
+
+
+def test_updates_post(client, put_header):
+    for version in ("0.0.9", "0.0.10"):
+        helpers.push_pkg(client, put_header, "Upd", version)
+
+    packages = [{'id': 'Pkg{}'.format(i), 'version': '1.0'}
+                for i in range(2000)]
+    packages.append({'id': 'Upd', 'version': '0.0.9'})
+    rv = client.post("/updates", json={'packages': packages})
+    assert rv.status_code == 200
+    assert b"<d:Version>0.0.10</d:Version>" in rv.data
+    assert rv.data.count(b"<entry>") == 1
+
+    rv = client.post("/updates", json={'packages': [{'id': 'Upd'}]})
+    assert rv.status_code == 400
+    rv = client.post("/updates", data="not json")
+    assert rv.status_code == 400
 
 
 @pytest.mark.integration
@@ -255,3 +334,540 @@ def test_list(populated_db):
 
     assert b"Douglas Thor" in rv.data
     assert b"<d:Id>NuGetTest</d:Id>" in rv.data
+
+
+def test_search_include_prerelease(client, put_header):
+    helpers.push_pkg(client, put_header, 'Pre', '1.0.0-beta')
+
+    for value in ('false', "'false'", 'False'):
+        rv = client.get("/Search()?searchTerm=''&includePrerelease=" + value)
+        assert b"<d:Version>1.0.0-beta</d:Version>" not in rv.data
+    rv = client.get("/Search()?searchTerm=''&includePrerelease=true")
+    assert b"<d:Version>1.0.0-beta</d:Version>" in rv.data
+
+
+def test_stats(populated_db):
+    client = populated_db
+
+    assert client.get("/stats").status_code == 401
+
+    rv = client.get("/stats", headers=API_KEY_HEADER)
+    assert rv.status_code == 200
+    pool = rv.get_json()['db_pool']
+    assert pool['checkouts'] >= 1
+    assert pool['wait_count'] >= 1
+    assert pool['checked_out'] == 0
+
+    # The per-thread SQLite pool reuses the connection between requests.
+    connects = pool['connects']
+    client.get("/count")
+    rv = client.get("/stats", headers=API_KEY_HEADER)
+    assert rv.get_json()['db_pool']['connects'] == connects
+
+
+def test_search_paging(client, put_header):
+    for version in ('0.0.1', '0.0.2', '0.0.3'):
+        helpers.push_pkg(client, put_header, 'Paged', version)
+
+    url = "/Search()?searchTerm=''&includePrerelease=true&$skip=0&$top=2"
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.data.count(b"<entry>") == 2
+    assert b'rel="next"' in rv.data
+    assert b"$skiptoken=0,2" in rv.data
+
+    url = "/Search()?searchTerm=''&includePrerelease=true&$skip=2&$top=2"
+    rv = client.get(url)
+    assert rv.data.count(b"<entry>") == 1
+    assert b'rel="next"' not in rv.data
+
+    rv = client.get("/Search()?searchTerm=''&$top=abc")
+    assert rv.status_code == 400
+
+
+def test_search_skiptoken(client, put_header):
+    for version in ('0.0.1', '0.0.2', '0.0.3'):
+        helpers.push_pkg(client, put_header, 'Paged', version)
+
+    url = ("/Search()?searchTerm=''&includePrerelease=true&$top=2"
+           "&$skiptoken=0,2")
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.data.count(b"<entry>") == 1
+    assert b"<d:Version>0.0.3</d:Version>" in rv.data
+    assert b'rel="next"' not in rv.data
+
+    rv = client.get("/Search()?searchTerm=''&$skiptoken='Paged'")
+    assert rv.status_code == 400
+    rv = client.get("/Search()?searchTerm=''&$skiptoken=bad")
+    assert rv.status_code == 400
+
+
+def test_find_by_id_paging(client, put_header):
+    for version in ('0.0.1', '0.0.2', '0.0.3'):
+        helpers.push_pkg(client, put_header, 'Paged', version)
+
+    rv = client.get("/FindPackagesById()?id='Paged'")
+    assert rv.data.count(b"<entry>") == 3
+    assert b'rel="next"' not in rv.data
+
+    rv = client.get("/FindPackagesById()?id='Paged'&$top=2")
+    assert rv.data.count(b"<entry>") == 2
+    skiptoken = re.search(rb"\$skiptoken=('Paged',[^\"&]+)", rv.data)
+    assert skiptoken is not None
+
+    rv = client.get("/FindPackagesById()?id='Paged'&$top=2"
+                    "&$skiptoken=" + skiptoken.group(1).decode())
+    assert rv.data.count(b"<entry>") == 1
+    assert b"<d:Version>0.0.3</d:Version>" in rv.data
+
+
+def test_find_by_id_semver_order(client, put_header):
+    for version in ('1.10.0', '1.9.0', '1.10.0-beta'):
+        helpers.push_pkg(client, put_header, 'Ordered', version)
+
+    rv = client.get("/FindPackagesById()?id='Ordered'")
+    versions = re.findall(rb"<d:Version>([^<]+)</d:Version>", rv.data)
+    assert versions == [b'1.9.0', b'1.10.0-beta', b'1.10.0']
+
+
+@pytest.mark.parametrize("order_by, expected", [
+    ("Id", [b"Aaa", b"Bbb"]),
+    ("Published%20desc", [b"Bbb", b"Aaa"]),
+    ("Unknown", [b"Aaa", b"Bbb"]),
+])
+def test_search_order_by(client, put_header, order_by, expected):
+    helpers.push_pkg(client, put_header, 'Aaa', '0.0.1')
+    helpers.push_pkg(client, put_header, 'Bbb', '0.0.1')
+
+    rv = client.get("/Search()?searchTerm=''&$orderby=" + order_by)
+    assert rv.status_code == 200
+    ids = re.findall(rb"<d:Id>(\w+)</d:Id>", rv.data)
+    assert ids == expected
+
+
+def test_find_by_id_streamed(populated_db):
+    rv = populated_db.get("/FindPackagesById()?id='NuGetTest'",
+                          buffered=False)
+    assert rv.is_streamed
+    assert rv.headers['Content-Type'].startswith('application/atom+xml')
+    chunks = list(rv.response)
+    assert chunks[0].startswith(b"<?xml")
+    assert b"<d:Id>NuGetTest</d:Id>" in b"".join(chunks)
+    rv.close()
+
+
+def test_feed_uses_entry_template(populated_db):
+    client = populated_db
+    with client.application.app_context():
+        session = routes.get_db_session()
+        version = db.find_by_pkg_name(session, 'NuGetTest')[0]
+        assert version.feed_entry is not None
+
+    client.get("download/1/0.0.1")
+    client.application.extensions['pynuget']['download_counter'].flush()
+    rv = client.get("/FindPackagesById()?id='NuGetTest'")
+    assert b"\x00" not in rv.data
+    assert b'<d:DownloadCount type="Edm.Int32">1<' in rv.data
+    assert b"http://localhost/download/1/0.0.1" in rv.data
+
+
+def test_feed_etag(populated_db, put_header):
+    client = populated_db
+    url = "/FindPackagesById()?id='NuGetTest'"
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+    last_modified = rv.headers['Last-Modified']
+    assert not etag.startswith('W/')
+
+    rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+    assert rv.headers['ETag'] == etag
+
+    rv = client.get(url, headers={'If-Modified-Since': last_modified})
+    assert rv.status_code == 304
+
+    # Pushing a new version changes the ETag.
+    helpers.push_pkg(client, put_header, 'NuGetTest', '0.0.2')
+    rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+    rv = client.get("/Search()?searchTerm=''",
+                    headers={'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == 304
+
+
+def test_search_after_title_change(client, put_header):
+    helpers.push_pkg(client, put_header, 'Renamed', '1.0.0', title="Apples")
+    helpers.push_pkg(client, put_header, 'Renamed', '1.1.0', title="Oranges")
+
+    def search(term):
+        rv = client.get("/Search()?searchTerm='{}'".format(term))
+        return sorted(re.findall(rb"<d:Version>([^<]+)<", rv.data))
+
+    # The package's title applies to all of its versions.
+    assert search("Apples") == []
+    assert search("Oranges") == [b"1.0.0", b"1.1.0"]
+
+
+def test_feed_cache(client, put_header):
+    helpers.push_pkg(client, put_header, 'CacheA', '1.0.0')
+    helpers.push_pkg(client, put_header, 'CacheB', '1.0.0')
+    cache = client.application.extensions['pynuget']['response_cache']
+    url_a = "/FindPackagesById()?id='CacheA'"
+    url_b = "/FindPackagesById()?id='CacheB'"
+    search = "/Search()?searchTerm=''&includePrerelease=true"
+
+    first = {url: client.get(url).data for url in (url_a, url_b, search)}
+    assert cache.as_dict()['entries'] == 3
+    hits = cache.as_dict()['hits']
+    for url, data in first.items():
+        assert client.get(url).data == data
+    assert cache.as_dict()['hits'] == hits + 3
+
+    # Only the pushed package's feeds and the searches are evicted.
+    helpers.push_pkg(client, put_header, 'CacheA', '2.0.0')
+    assert cache.as_dict()['entries'] == 1
+    assert b"<d:Version>2.0.0</d:Version>" in client.get(url_a).data
+    assert b"<d:Version>2.0.0</d:Version>" in client.get(search).data
+    assert client.get(url_b).data == first[url_b]
+
+    rv = client.delete('/api/v2/package/CacheA/2.0.0', headers=put_header)
+    assert rv.status_code == 204
+    assert b"<d:Version>2.0.0</d:Version>" not in client.get(url_a).data
+
+    # The base URL is part of the key.
+    rv = client.get(url_b, base_url="http://other.example/")
+    assert b"http://other.example/" in rv.data
+
+    rv = client.get("/stats", headers=API_KEY_HEADER)
+    stats = rv.get_json()['response_cache']
+    assert stats['invalidations'] >= 3
+
+
+@pytest.mark.parametrize("url", [
+    "/Search()?searchTerm=''&includePrerelease=true",
+    "/FindPackagesById()?id='HeadA'",
+])
+def test_feed_head(client, put_header, url):
+    helpers.push_pkg(client, put_header, 'HeadA', '1.0.0')
+    path, query_string = url.split("?")
+
+    # Like a WSGI server: the body of a HEAD response is closed unread.
+    for _ in range(2):
+        environ = EnvironBuilder(path=path, query_string=query_string,
+                                 method='HEAD').get_environ()
+        app_iter = client.application(environ, lambda *args: None)
+        assert b''.join(app_iter) == b''
+        app_iter.close()
+        assert _request_ctx_stack.top is None
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert b"<d:Version>1.0.0</d:Version>" in rv.data
+
+
+def test_fill_cache_closes_chunks():
+    closed = []
+
+    def chunks():
+        try:
+            yield b"<feed />"
+        finally:
+            closed.append(True)
+
+    # The wrapped chunks are closed when the body is sent...
+    body = routes._fill_cache(None, "key", [], None, 1024, chunks())
+    assert b''.join(body) == b"<feed />"
+    assert closed == [True]
+
+    # ... or abandoned part way.
+    inner = chunks()
+    body = routes._fill_cache(None, "key", [], None, 1024, inner)
+    next(body)
+    body.close()
+    assert closed == [True, True]
+
+
+def test_feed_single_flight(client, put_header):
+    helpers.push_pkg(client, put_header, 'FlightA', '1.0.0')
+    ext = client.application.extensions['pynuget']
+    ext['response_cache'] = None
+    flight = ext['single_flight']
+    url = "/FindPackagesById()?id='FlightA'"
+    with client.application.test_request_context(url):
+        key = routes._feed_cache_key()
+
+    # Another request for the same feed is in flight: wait for its result.
+    call, leader = flight.begin(key)
+    assert leader is True
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        client.get(url).data))
+    thread.start()
+    while flight.as_dict()['followers'] < 1:
+        time.sleep(0.01)
+    flight.finish(key, call, b"<feed />")
+    thread.join()
+    assert results == [b"<feed />"]
+
+    # Without one the request computes the feed and shares it when done.
+    rv = client.get(url)
+    assert b"<d:Version>1.0.0</d:Version>" in rv.data
+    assert flight.as_dict()['in_flight'] == 0
+
+    # A failed leader makes the follower compute the feed itself.
+    call, _ = flight.begin(key)
+    thread = threading.Thread(target=lambda: results.append(
+        client.get(url).data))
+    thread.start()
+    while flight.as_dict()['followers'] < 2:
+        time.sleep(0.01)
+    flight.finish(key, call, None)
+    thread.join()
+    assert b"<d:Version>1.0.0</d:Version>" in results[-1]
+
+    # A HEAD request doesn't leave its computation in flight.
+    client.head(url).close()
+    assert flight.as_dict()['in_flight'] == 0
+
+
+def test_shared_cache(client, put_header, tmpdir):
+    app = client.application
+    app.config['SHARED_CACHE_BACKEND'] = 'sqlite'
+    app.config['SHARED_CACHE_PATH'] = str(tmpdir.join("shared.sqlite"))
+    app_factory.init_cache(app)
+    cache = app.extensions['pynuget']['response_cache']
+    # Another worker process of the same server.
+    other = shared_cache.SharedResponseCache(
+        shared_cache.create_backend(app.config))
+
+    helpers.push_pkg(client, put_header, 'SharedA', '1.0.0')
+    url = "/FindPackagesById()?id='SharedA'"
+    data = client.get(url).data
+    with app.test_request_context(url):
+        key = routes._feed_cache_key()
+    assert other.get(key) == data
+    assert client.get('/count').data == b'1'
+    assert client.get('/download/1/1.0.0').status_code == 200
+    assert client.get('/download/1/1.0.0').status_code == 200
+    assert cache.as_dict()['hits'] == 1
+
+    # A push in this worker invalidates the entries for the other one.
+    helpers.push_pkg(client, put_header, 'SharedB', '1.0.0')
+    assert other.get(key) == data
+    assert other.get("count") is None
+    helpers.push_pkg(client, put_header, 'SharedA', '2.0.0')
+    assert other.get(key) is None
+    assert other.get("download 1 1.0.0") is None
+    assert client.get('/count').data == b'2'
+
+    rv = client.get("/stats", headers=API_KEY_HEADER)
+    stats = rv.get_json()['response_cache']
+    assert stats['backend'] == 'SQLiteBackend'
+    assert stats['errors'] == 0
+
+
+@pytest.mark.parametrize("offload, header, expected", [
+    ("x-sendfile", "X-Sendfile", "/NuGetTest/0.0.1.nupkg"),
+    ("x-accel-redirect", "X-Accel-Redirect",
+     "/nuget_packages_internal/NuGetTest/0.0.1.nupkg"),
+])
+def test_download_offload(populated_db, offload, header, expected):
+    client = populated_db
+    client.application.config['DOWNLOAD_OFFLOAD'] = offload
+
+    rv = client.get("download/1/0.0.1")
+    assert rv.status_code == 200
+    assert rv.data == b''
+    assert rv.headers[header].endswith(expected)
+    assert rv.headers['Content-Type'] == 'application/zip'
+    assert 'NuGetTest.0.0.1.nupkg' in rv.headers['Content-Disposition']
+
+    # The download is still counted.
+    client.application.extensions['pynuget']['download_counter'].flush()
+    with client.application.app_context():
+        assert db.find_pkg_by_id(routes.session, 1).download_count == 1
+
+
+def test_download_count_batched(populated_db):
+    client = populated_db
+    counter = client.application.extensions['pynuget']['download_counter']
+
+    for _ in range(3):
+        assert client.get("download/1/0.0.1").status_code == 200
+    assert counter.as_dict()['pending'] == 3
+
+    counter.flush()
+    with client.application.app_context():
+        assert db.find_pkg_by_id(routes.session, 1).download_count == 3
+
+    rv = client.get("/stats", headers=API_KEY_HEADER)
+    assert rv.get_json()['download_counter']['flushed'] == 3
+
+
+def test_download_range(populated_db):
+    client = populated_db
+    counter = client.application.extensions['pynuget']['download_counter']
+    with open(os.path.join(DATA_DIR, 'good.nupkg'), 'rb') as openf:
+        data = openf.read()
+    size = len(data)
+
+    rv = client.get("download/1/0.0.1")
+    assert rv.status_code == 200
+    assert rv.data == data
+    assert rv.headers['Accept-Ranges'] == 'bytes'
+    etag = rv.headers['ETag']
+
+    # Resume a download.
+    rv = client.get("download/1/0.0.1",
+                    headers={'Range': 'bytes=100-', 'If-Range': etag})
+    assert rv.status_code == 206
+    assert rv.data == data[100:]
+    assert rv.headers['Content-Range'] == "bytes 100-{}/{}".format(size - 1,
+                                                                  size)
+
+    # Suffix range.
+    rv = client.get("download/1/0.0.1", headers={'Range': 'bytes=-10'})
+    assert rv.status_code == 206
+    assert rv.data == data[-10:]
+
+    # Resumed downloads aren't counted again.
+    assert counter.as_dict()['pending'] == 1
+
+    # A stale If-Range gets the whole file.
+    rv = client.get("download/1/0.0.1",
+                    headers={'Range': 'bytes=100-', 'If-Range': '"abc"'})
+    assert rv.status_code == 200
+    assert rv.data == data
+    assert counter.as_dict()['pending'] == 2
+
+    rv = client.get("download/1/0.0.1",
+                    headers={'Range': 'bytes={}-'.format(size)})
+    assert rv.status_code == 416
+    assert rv.headers['Content-Range'] == "bytes */{}".format(size)
+
+
+def test_download_multiple_ranges(populated_db):
+    client = populated_db
+    with open(os.path.join(DATA_DIR, 'good.nupkg'), 'rb') as openf:
+        data = openf.read()
+
+    rv = client.get("download/1/0.0.1", headers={'Range': 'bytes=0-9,20-29'})
+    assert rv.status_code == 206
+    assert rv.mimetype == 'multipart/byteranges'
+    assert int(rv.headers['Content-Length']) == len(rv.data)
+
+    boundary = rv.mimetype_params['boundary'].encode('ascii')
+    parts = rv.data.split(b'--' + boundary)
+    assert parts[-1] == b'--\r\n'
+    bodies = [part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts[1:-1]]
+    assert bodies == [data[0:10], data[20:30]]
+    assert b'Content-Range: bytes 20-29/' in parts[2]
+
+
+def test_download_ranges_merged(populated_db):
+    client = populated_db
+    with open(os.path.join(DATA_DIR, 'good.nupkg'), 'rb') as openf:
+        data = openf.read()
+
+    # Adjacent ranges are sent as one.
+    rv = client.get("download/1/0.0.1", headers={'Range': 'bytes=0-9,10-19'})
+    assert rv.status_code == 206
+    assert rv.headers['Content-Range'] == 'bytes 0-19/{}'.format(len(data))
+    assert rv.data == data[0:20]
+
+    # Too many ranges get the whole file.
+    ranges = ",".join("{0}-{0}".format(i * 2)
+                      for i in range(routes.MAX_RANGES + 1))
+    rv = client.get("download/1/0.0.1", headers={'Range': 'bytes=' + ranges})
+    assert rv.status_code == 200
+    assert rv.data == data
+
+
+@pytest.mark.parametrize("ranges, expected", [
+    ([], []),
+    ([(0, 10), (10, 20)], [(0, 20)]),
+    ([(30, 40), (0, 10), (35, 50)], [(0, 10), (30, 50)]),
+    ([(0, 100), (10, 20)], [(0, 100)]),
+    ([(0, 10), (11, 20)], [(0, 10), (11, 20)]),
+])
+def test__merge_ranges(ranges, expected):
+    assert routes._merge_ranges(ranges) == expected
+
+
+def test_push_delete_content_addressable(client, put_header):
+    client.application.config['CONTENT_ADDRESSABLE_STORE'] = True
+    check_push(201, client, put_header, 'good.nupkg')
+
+    with client.application.app_context():
+        version = db.find_by_pkg_name(routes.session, 'NuGetTest')[0]
+        blob = core.get_blob_path(version.package_hash)
+    pkg_dir = os.path.join(client.application.config['SERVER_PATH'],
+                           client.application.config['PACKAGE_DIR'])
+    blob = os.path.join(pkg_dir, str(blob))
+    path = os.path.join(pkg_dir, 'NuGetTest', '0.0.1.nupkg')
+    assert os.path.samefile(blob, path)
+
+    rv = client.get("download/1/0.0.1")
+    with open(os.path.join(DATA_DIR, 'good.nupkg'), 'rb') as openf:
+        assert rv.data == openf.read()
+
+    rv = client.delete('/api/v2/package/NuGetTest/0.0.1', headers=put_header)
+    assert rv.status_code == 204
+    assert not os.path.exists(path)
+    assert not os.path.exists(blob)
+
+
+def test_s3_storage(client, put_header):
+    fake = helpers.FakeS3Client()
+    ext = client.application.extensions['pynuget']
+    ext['storage'] = storage.S3Storage("bucket", client=fake,
+                                       presign_expires=0)
+    with open(os.path.join(DATA_DIR, 'good.nupkg'), 'rb') as openf:
+        data = openf.read()
+
+    check_push(201, client, put_header, 'good.nupkg')
+    assert fake.objects[('bucket', 'NuGetTest/0.0.1.nupkg')][0] == data
+
+    rv = client.get("download/1/0.0.1")
+    assert rv.status_code == 200
+    assert rv.data == data
+
+    rv = client.get("download/1/0.0.1", headers={'Range': 'bytes=10-19'})
+    assert rv.status_code == 206
+    assert rv.data == data[10:20]
+
+    # Clients can be sent to the object store instead.
+    ext['storage'].presign_expires = 60
+    rv = client.get("download/1/0.0.1")
+    assert rv.status_code == 302
+    assert rv.headers['Location'].startswith(
+        "https://s3.example.com/bucket/NuGetTest/0.0.1.nupkg")
+
+    rv = client.delete('/api/v2/package/NuGetTest/0.0.1', headers=put_header)
+    assert rv.status_code == 204
+    assert fake.objects == {}
+
+
+def test_push_saves_package_file(client, put_header):
+    check_push(201, client, put_header, 'good.nupkg')
+    key = 'NuGetTest/0.0.1.nupkg'
+
+    with client.application.app_context():
+        row = db.get_package_files(routes.session)[key]
+        assert row.is_unchanged(core.get_storage().stat(key))
+        version = db.find_by_pkg_name(routes.session, 'NuGetTest')[0]
+        assert row.package_hash == version.package_hash
+    good = os.path.join(DATA_DIR, 'good.nupkg')
+    assert row.parsed == json.loads(json.dumps(
+        core.read_package_metadata(good)))
+
+    rv = client.delete('/api/v2/package/NuGetTest/0.0.1', headers=put_header)
+    assert rv.status_code == 204
+    with client.application.app_context():
+        assert db.get_package_files(routes.session) == {}
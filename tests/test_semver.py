@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import pytest
+
+from pynuget import semver
+
+
+def test_parse_version():
+    result = semver.parse_version("1.2.3.4-beta.2+abc.5")
+    assert result == semver.SemVer(1, 2, 3, 4, ('beta', '2'), 'abc.5')
+
+    result = semver.parse_version("1.0")
+    assert result == semver.SemVer(1, 0, 0, 0, (), None)
+
+    for bad in ("", "vers1", "1.0.0.0.0", "1.0-", "1.0-beta..1", "1.0+"):
+        with pytest.raises(ValueError):
+            semver.parse_version(bad)
+
+
+def test_sort_key():
+    # In SemVer 2.0 precedence order.
+    versions = [
+        "not-a-version",
+        "0.9.0",
+        "1.0.0-1",
+        "1.0.0-2",
+        "1.0.0-10",
+        "1.0.0-alpha",
+        "1.0.0-alpha.1",
+        "1.0.0-alpha.beta",
+        "1.0.0-alpha-1",
+        "1.0.0-Beta",
+        "1.0.0-beta.2",
+        "1.0.0-beta.11",
+        "1.0.0-rc.1",
+        "1.0.0",
+        "1.0.0.1",
+        "1.0.1",
+        "1.9.0",
+        "1.10.0",
+        "10.0.0",
+    ]
+    keys = [semver.sort_key(v) for v in versions]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+
+
+def test_sort_key_equal_versions():
+    assert semver.sort_key("1.0") == semver.sort_key("1.0.0")
+    assert semver.sort_key("1.0.0.0") == semver.sort_key("1.0.0+build.1")
+    assert semver.sort_key("01.0.0") == semver.sort_key("1.0.0")
+    assert semver.sort_key("1.0.0-RC") == semver.sort_key("1.0.0-rc")
+
+
+def test_is_prerelease():
+    assert semver.is_prerelease("1.0.0-beta")
+    assert not semver.is_prerelease("1.0.0")
+    assert not semver.is_prerelease("1.0.0+build-5")
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import os
+import threading
+
+import pytest
+
+from pynuget import shared_cache
+
+
+class FakeRedis(object):
+    """The part of a `redis.Redis` client that the backend uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key, None)
+
+    def set(self, key, value, px=None):
+        self.data[key] = value
+
+    def mget(self, keys):
+        return [self.data.get(key, None) for key in keys]
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+
+class BrokenBackend(shared_cache.CacheBackend):
+
+    def __getattribute__(self, name):
+        raise ConnectionError("Connection refused")
+
+
+@pytest.fixture
+def sqlite_path(tmpdir):
+    return str(tmpdir.join("shared_cache.sqlite"))
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def backends(request, sqlite_path):
+    """Two backends for the same store, as two worker processes have."""
+    if request.param == 'sqlite':
+        return (shared_cache.SQLiteBackend(sqlite_path),
+                shared_cache.SQLiteBackend(sqlite_path))
+    client = FakeRedis()
+    return (shared_cache.RedisBackend(prefix="test:", client=client),
+            shared_cache.RedisBackend(prefix="test:", client=client))
+
+
+def test_backend(backends):
+    backend, _ = backends
+    assert backend.get('a') is None
+    backend.set('a', b'A', 60)
+    assert backend.get('a') == b'A'
+
+    assert backend.get_counters(['x', 'y']) == [0, 0]
+    backend.incr('y')
+    backend.incr('y')
+    assert backend.get_counters(['x', 'y']) == [0, 2]
+
+
+def test_sqlite_backend_expires(sqlite_path):
+    backend = shared_cache.SQLiteBackend(sqlite_path)
+    backend.set('a', b'A', -1)
+    assert backend.get('a') is None
+
+
+def test_sqlite_backend_incr_concurrent(sqlite_path):
+    backends = [shared_cache.SQLiteBackend(sqlite_path) for _ in range(4)]
+
+    def work(backend):
+        for _ in range(25):
+            backend.incr('tag')
+
+    threads = [threading.Thread(target=work, args=(backend, ))
+               for backend in backends]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert backends[0].get_counters(['tag']) == [100]
+
+
+def test_shared_response_cache(backends):
+    worker_1 = shared_cache.SharedResponseCache(backends[0], ttl=60)
+    worker_2 = shared_cache.SharedResponseCache(backends[1], ttl=60)
+
+    assert worker_1.set('find-a', b'1', ['pkg:a'], worker_1.generation())
+    assert worker_1.set('search', b'2', ['pkg:a', '*'])
+    assert worker_1.set('find-b', b'3', ['pkg:b'])
+    assert worker_2.get('find-a') == b'1'
+
+    # An invalidation in one worker is seen by the others.
+    worker_1.invalidate(['pkg:b', '*'])
+    assert worker_2.get('find-a') == b'1'
+    assert worker_2.get('search') is None
+    assert worker_2.get('find-b') is None
+    assert worker_2.as_dict()['stale'] == 2
+
+    # The value was computed before another worker's invalidation.
+    generation = worker_2.generation()
+    worker_1.invalidate(['unrelated'])
+    assert worker_2.set('find-b', b'3', ['pkg:b'], generation) is False
+    assert worker_2.set('find-b', b'3', ['pkg:b'],
+                        worker_2.generation()) is True
+    assert worker_1.get('find-b') == b'3'
+
+
+def test_shared_response_cache_errors():
+    cache = shared_cache.SharedResponseCache(BrokenBackend())
+    generation = cache.generation()
+    assert generation is not None
+    assert cache.get('a') is None
+    assert cache.set('a', b'A', ['tag']) is False
+    cache.invalidate(['tag'])
+    stats = cache.as_dict()
+    assert stats['backend'] == 'BrokenBackend'
+    assert stats['misses'] == 1
+    assert stats['errors'] == 5
+
+
+def test_shared_response_cache_unknown_generation(sqlite_path, monkeypatch):
+    backend = shared_cache.SQLiteBackend(sqlite_path)
+    cache = shared_cache.SharedResponseCache(backend)
+
+    def refused(keys):
+        raise ConnectionError("Connection refused")
+
+    # The store is down while the value is computed, and back up after.
+    with monkeypatch.context() as m:
+        m.setattr(backend, 'get_counters', refused)
+        generation = cache.generation()
+    assert cache.set('a', b'A', ['tag'], generation) is False
+    assert cache.get('a') is None
+
+
+@pytest.mark.parametrize("raw", [b'{"tag"\nA', b'\xff\nA', b'[1]\nA'])
+def test_shared_response_cache_invalid_entry(sqlite_path, raw):
+    backend = shared_cache.SQLiteBackend(sqlite_path)
+    backend.set("entry:a", raw, 60)
+    cache = shared_cache.SharedResponseCache(backend)
+    assert cache.get('a') is None
+    assert cache.misses == 1
+
+    assert cache.set('a', b'A', ['tag'])
+    assert cache.get('a') == b'A'
+
+
+def test_create_backend(sqlite_path):
+    config = {
+        'SHARED_CACHE_BACKEND': None,
+        'SHARED_CACHE_URL': "redis://localhost:6379/0",
+        'SHARED_CACHE_PREFIX': "pynuget:",
+        'SHARED_CACHE_PATH': sqlite_path,
+        'SERVER_PATH': "/var/www/pynuget",
+    }
+    assert shared_cache.create_backend(config) is None
+
+    config['SHARED_CACHE_BACKEND'] = 'sqlite'
+    backend = shared_cache.create_backend(config)
+    assert isinstance(backend, shared_cache.SQLiteBackend)
+    assert backend.path == sqlite_path
+
+    config['SHARED_CACHE_BACKEND'] = 'memcached'
+    with pytest.raises(shared_cache.CacheError):
+        shared_cache.create_backend(config)
+
+
+@pytest.mark.skipif(not os.getenv('PYNUGET_TEST_REDIS_URL'),
+                    reason="Set PYNUGET_TEST_REDIS_URL to test with Redis")
+def test_redis_server():
+    url = os.getenv('PYNUGET_TEST_REDIS_URL')
+    worker_1 = shared_cache.SharedResponseCache(
+        shared_cache.RedisBackend(url, prefix="pynuget-test:"))
+    worker_2 = shared_cache.SharedResponseCache(
+        shared_cache.RedisBackend(url, prefix="pynuget-test:"))
+
+    worker_1.invalidate(['pkg:a'])
+    assert worker_1.set('find-a', b'1', ['pkg:a'], worker_1.generation())
+    assert worker_2.get('find-a') == b'1'
+    worker_2.invalidate(['pkg:a'])
+    assert worker_1.get('find-a') is None
+    assert worker_1.as_dict()['errors'] == 0
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+from pynuget import create_app
+from pynuget import storage
+from .helpers import FakeS3Client
+
+
+@pytest.fixture(params=['local', 's3'])
+def store(request, tmpdir):
+    if request.param == 'local':
+        return storage.LocalStorage(str(tmpdir))
+    return storage.S3Storage("bucket", prefix="pkgs/", client=FakeS3Client())
+
+
+def test_put_get_stat_delete(store):
+    assert store.stat("Foo/1.0.0.nupkg") is None
+
+    store.put_stream("Foo/1.0.0.nupkg", BytesIO(b"0123456789"))
+    stat = store.stat("Foo/1.0.0.nupkg")
+    assert stat.size == 10
+    assert stat.modified > 0
+
+    with store.get_stream("Foo/1.0.0.nupkg") as stream:
+        assert stream.read() == b"0123456789"
+    with store.get_stream("Foo/1.0.0.nupkg", 2, 5) as stream:
+        assert stream.read(3) == b"234"
+
+    store.delete("Foo/1.0.0.nupkg")
+    assert store.stat("Foo/1.0.0.nupkg") is None
+    # Deleting something that doesn't exist is fine.
+    store.delete("Foo/1.0.0.nupkg")
+
+
+def test_put_file_and_link(store, tmpdir):
+    path = Path(str(tmpdir)) / "upload.tmp"
+    path.write_bytes(b"data")
+
+    store.put_file("_blobs/ab/abc.nupkg", path)
+    assert not path.exists()
+
+    store.link("_blobs/ab/abc.nupkg", "Foo/1.0.0.nupkg")
+    with store.get_stream("Foo/1.0.0.nupkg") as stream:
+        assert stream.read() == b"data"
+
+    # The link survives the original going away.
+    store.delete("_blobs/ab/abc.nupkg")
+    assert store.stat("Foo/1.0.0.nupkg").size == 4
+
+
+def test_local_storage_default_root(tmpdir):
+    app = create_app()
+    app.config['SERVER_PATH'] = str(tmpdir)
+    store = storage.LocalStorage()
+    with app.app_context():
+        store.put_stream("Foo/1.0.0.nupkg", BytesIO(b"data"))
+        path = store.local_path("Foo/1.0.0.nupkg")
+    pkg_dir = Path(str(tmpdir)) / app.config['PACKAGE_DIR']
+    assert path == pkg_dir / "Foo" / "1.0.0.nupkg"
+    assert path.read_bytes() == b"data"
+
+
+def test_s3_storage_url():
+    store = storage.S3Storage("bucket", prefix="pkgs/", client=FakeS3Client())
+    url = store.url("Foo/1.0.0.nupkg", "Foo.1.0.0.nupkg")
+    assert url.startswith("https://s3.example.com/bucket/pkgs/Foo/1.0.0.nupkg")
+    assert storage.LocalStorage().url("Foo/1.0.0.nupkg") is None
+
+    store.presign_expires = 0
+    assert store.url("Foo/1.0.0.nupkg") is None
+
+
+def test_create_storage():
+    app = create_app()
+    assert isinstance(storage.create_storage(app.config),
+                      storage.LocalStorage)
+
+    app.config['STORAGE_BACKEND'] = 'foo'
+    with pytest.raises(storage.StorageError):
+        storage.create_storage(app.config)
+
+    app.config['STORAGE_BACKEND'] = 's3'
+    app.config['CONTENT_ADDRESSABLE_STORE'] = True
+    with pytest.raises(storage.StorageError):
+        storage.create_storage(app.config)